@@ -0,0 +1,71 @@
+"""
+Benchmark syncing several accounts with sync_accounts(), in one process and in parallel.
+
+Every account is an offline fake mailbox with its own cache in a temporary
+directory. The same accounts are synced once with a single worker process (one
+account after the other) and once with one process per account, and the wall
+times and the combined report of both runs are printed.
+
+Run from the root of the project:
+    python -m benchmarks.bench_accounts [--accounts 4] [--messages 20000] [--latency 0.0]
+"""
+import argparse
+import contextlib
+import functools
+import io
+import os
+import tempfile
+import time
+
+from src.accounts import AccountProfile, sync_accounts
+from src.fake_gmail import FakeMailbox, FakeGmailService
+from src.gmail_db import GmailCacheDB
+from src.MessageAccesor import MessageAccesor
+
+
+def fake_accessor(message_count, latency, profile):
+    """Return a MessageAccesor syncing a fake mailbox into the profile's cache (seeded by the account name)."""
+    mailbox = FakeMailbox(message_count, seed=sum(map(ord, profile.name)))
+    service = FakeGmailService(mailbox, latency=latency)
+    return MessageAccesor(service=service, service_factory=service.clone, db=GmailCacheDB(profile.db_path),
+                          token_path=profile.token_path)
+
+
+def run_once(args, processes, directory):
+    """Sync every account into fresh caches under `directory`; return (wall seconds, report lines)."""
+    profiles = [AccountProfile(f'account-{number}', token_path=os.path.join(directory, f'{number}.pickle'),
+                               db_path=os.path.join(directory, f'{number}.db'),
+                               quota_units_per_second=args.units_per_second)
+                for number in range(1, args.accounts + 1)]
+    factory = functools.partial(fake_accessor, args.messages, args.latency)
+    output = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        sync_accounts(profiles, {'workers': args.workers}, processes=processes, accessor_factory=factory)
+    elapsed = time.perf_counter() - start
+    lines = output.getvalue().splitlines()
+    return elapsed, lines[next(i for i, line in enumerate(lines) if line.startswith('Account ')):]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sequential vs parallel multi-account sync.")
+    parser.add_argument("--accounts", type=int, default=4, help="Number of fake accounts. Default: 4")
+    parser.add_argument("--messages", type=int, default=20000, help="Messages per account. Default: 20000")
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated seconds per HTTP request. Default: 0")
+    parser.add_argument("--workers", type=int, default=4, help="Batch-get workers per account. Default: 4")
+    parser.add_argument("--units-per-second", type=float, default=1e9, help="Quota budget per account. Default: unlimited")
+    parser.add_argument("--processes", type=int, help="Processes of the parallel run. Default: one per account")
+    parser.add_argument("--dir", help="Directory for the temporary caches. Default: the system temp directory")
+    args = parser.parse_args()
+
+    timings = {}
+    for label, processes in (('sequential', 1), ('parallel', args.processes or args.accounts)):
+        with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+            timings[label], report = run_once(args, processes, directory)
+        print(f"\n{label} ({processes} processes): {timings[label]:.1f}s")
+        print('\n'.join(report))
+    print(f"\nSpeed-up: {timings['sequential'] / timings['parallel']:.2f}x on {os.cpu_count()} CPU cores.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Benchmark near-duplicate clustering and per-cluster classification on a synthetic cache.
+
+The cache is filled with template mail (each template sent by one sender, with varying
+numbers, names and links, and some templates reworded) plus a share of one-off personal
+mail. It is then clustered, and the clusters are classified by the keyword classifier
+with a simulated per-call latency, as a model call would have. The number of classifier
+calls and their time are compared with classifying every message. Finally a day of new
+mail is added and clustered and classified incrementally.
+
+Run from the root of the project:
+    python -m benchmarks.bench_clustering [--messages 200000] [--templates 3000] [--latency 0.5]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from src.classification import ClassificationPipeline, KeywordClassifier
+from src.clustering import Clusterer
+from src.config import CLASSIFY_BATCH_SIZE, CLASSIFY_WORKERS
+from src.gmail_db import GmailCacheDB
+
+WORDS = ('order invoice receipt shipped delivery account security alert weekly digest update offer sale '
+         'meeting invitation statement payment reminder newsletter report summary activity new your the '
+         'for is ready has been from with on about').split()
+NAMES = ('Alex', 'Sam', 'Jordan', 'Taylor', 'Morgan', 'Casey')
+
+
+class SlowClassifier(KeywordClassifier):
+    """The keyword classifier with a fixed delay per call, like a remote model."""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def classify(self, items):
+        time.sleep(self.latency)
+        return super().classify(items)
+
+
+def make_rows(count, template_count, personal_share, rng, offset=0):
+    """Build synthetic rich metadata rows: template mail and one-off personal mail."""
+    rows = []
+    for i in range(offset, offset + count):
+        if rng.random() < personal_share:
+            sender = f'{rng.choice(NAMES)} <person{rng.randrange(5000)}@mail{rng.randrange(50)}.org>'
+            subject = ' '.join(rng.sample(WORDS, 5))
+            snippet = ' '.join(rng.choices(WORDS, k=25))
+        else:
+            # Pareto-distributed template popularity, like real senders
+            template = min(int(rng.paretovariate(1.1)) - 1, template_count - 1)
+            words = random.Random(template).sample(WORDS, 8)
+            if rng.random() < 0.1:
+                words[rng.randrange(8)] = rng.choice(WORDS)  # A reworded variant
+            sender = f'Service {template} <noreply@service{template}.com>'
+            subject = f"{rng.choice(NAMES)}, {' '.join(words[:4])} #{rng.randrange(10 ** 6)}"
+            snippet = (f"Hi {rng.choice(NAMES)}, {' '.join(words)} {rng.randrange(10 ** 4)} "
+                       f"details at https://service{template}.com/t/{rng.randrange(10 ** 9):x} {' '.join(words[2:])}")
+        rows.append((f'{i:016x}', snippet, 1600000000000 + i * 1000, 20000, sender, subject, '["INBOX"]', 0, '[]', '[]', 1))
+    return rows
+
+
+def fill(db, rows):
+    """Write rows (and their stubs) to the cache."""
+    with db.write_transaction() as conn:
+        db.upsert_stubs(conn, [{'id': row[0], 'threadId': row[0]} for row in rows])
+        db.upsert_rich_metadata(conn, rows)
+
+
+def cluster_and_classify(db, args, label):
+    """Cluster new messages, classify new clusters and print what it took."""
+    cluster_stats = Clusterer(db).run()
+    pipeline = ClassificationPipeline(db, SlowClassifier(args.latency), batch_size=args.batch_size, workers=args.workers)
+    classify_stats = pipeline.run()
+    print(f"\n{label}: {cluster_stats['messages']} messages clustered in {cluster_stats['seconds']:.2f}s "
+          f"({cluster_stats['messages'] / max(cluster_stats['seconds'], 1e-9):,.0f}/sec: "
+          f"{cluster_stats['by_template']} by template, {cluster_stats['by_similarity']} by similarity, "
+          f"{cluster_stats['new_clusters']} new clusters)")
+    print(f"{label}: {classify_stats['clusters']} clusters classified with {classify_stats['calls']} calls "
+          f"in {classify_stats['seconds']:.1f}s")
+    return cluster_stats, classify_stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark clustering and per-cluster classification.")
+    parser.add_argument("--messages", type=int, default=200000, help="Number of cached messages. Default: 200000")
+    parser.add_argument("--templates", type=int, default=3000, help="Number of distinct mail templates. Default: 3000")
+    parser.add_argument("--personal", type=float, default=0.05, help="Share of one-off personal mail. Default: 0.05")
+    parser.add_argument("--latency", type=float, default=0.5, help="Simulated seconds per classifier call. Default: 0.5")
+    parser.add_argument("--batch-size", type=int, default=CLASSIFY_BATCH_SIZE, help=f"Clusters per classifier call. Default: {CLASSIFY_BATCH_SIZE}")
+    parser.add_argument("--workers", type=int, default=CLASSIFY_WORKERS, help=f"Concurrent classifier calls. Default: {CLASSIFY_WORKERS}")
+    parser.add_argument("--dir", help="Directory for the temporary cache. Default: the system temp directory")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        db = GmailCacheDB(os.path.join(directory, 'gmail_cache.db'))
+        fill(db, make_rows(args.messages, args.templates, args.personal, rng))
+        _, classify_stats = cluster_and_classify(db, args, 'Full')
+
+        per_message_calls = -(-args.messages // args.batch_size)
+        print(f"Classifying every message would take {per_message_calls} calls, "
+              f"about {per_message_calls * args.latency / args.workers:,.0f}s: "
+              f"{per_message_calls / max(classify_stats['calls'], 1):.0f}x the calls.")
+
+        new_count = max(1, args.messages // 100)
+        fill(db, make_rows(new_count, args.templates, args.personal, rng, offset=args.messages))
+        cluster_and_classify(db, args, 'Incremental')
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Benchmark cache write throughput before and after the SQLite tuning.
+
+"before" reproduces the original write pattern: default rollback journal and
+synchronous=FULL, a commit after every 100-stub page and every 50-message batch.
+"after" uses GmailCacheDB as the sync pipeline does: WAL mode, tuned pragmas and
+the shared writer connection with large grouped transactions.
+
+Run from the root of the project:
+    python -m benchmarks.bench_db_writes [--messages 50000]
+"""
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+from src.gmail_db import GmailCacheDB
+
+STUB_PAGE_SIZE = 100
+RICH_BATCH_SIZE = 50
+GROUPED_COMMIT_ROWS = 5000
+
+
+def make_rows(count):
+    """Build synthetic stubs and rich metadata rows of a realistic size."""
+    headers = json.dumps([{'name': f'X-Header-{i}', 'value': 'v' * 60} for i in range(20)])
+    stubs = [{'id': f'{i:016x}', 'threadId': f'{i // 3:016x}'} for i in range(count)]
+    rich = [
+        (stub['id'], 'snippet ' * 12, 1600000000000 + i * 1000, 20000 + i % 5000,
+         f'Sender {i % 500} <sender{i % 500}@example{i % 50}.com>', f'Subject {i}',
+         json.dumps(['INBOX', 'UNREAD'] if i % 3 else ['INBOX']), i % 7 == 0, None, headers, 1000 + i)
+        for i, stub in enumerate(stubs)
+    ]
+    return stubs, rich
+
+
+def bench_before(db_path, stubs, rich):
+    """Original pattern: default journal settings and many small commits."""
+    db = GmailCacheDB(db_path)
+    # A plain connection, switched back to the default rollback journal
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=DELETE")
+    start = time.perf_counter()
+    for i in range(0, len(stubs), STUB_PAGE_SIZE):
+        db.upsert_stubs(conn, stubs[i:i + STUB_PAGE_SIZE])
+        conn.commit()
+    for i in range(0, len(rich), RICH_BATCH_SIZE):
+        db.upsert_rich_metadata(conn, rich[i:i + RICH_BATCH_SIZE])
+        conn.commit()
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return elapsed
+
+
+def bench_after(db_path, stubs, rich):
+    """Tuned pattern: WAL, pragmas and grouped transactions on the shared writer."""
+    db = GmailCacheDB(db_path)
+    start = time.perf_counter()
+    for i in range(0, len(stubs), GROUPED_COMMIT_ROWS):
+        with db.write_transaction() as conn:
+            db.upsert_stubs(conn, stubs[i:i + GROUPED_COMMIT_ROWS])
+    for i in range(0, len(rich), GROUPED_COMMIT_ROWS):
+        with db.write_transaction() as conn:
+            db.upsert_rich_metadata(conn, rich[i:i + GROUPED_COMMIT_ROWS])
+    elapsed = time.perf_counter() - start
+    db.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cache write throughput.")
+    parser.add_argument("--messages", type=int, default=50000, help="Number of synthetic messages. Default: 50000")
+    parser.add_argument("--dir", help="Directory for the temporary databases (use a real disk, not tmpfs).")
+    args = parser.parse_args()
+
+    stubs, rich = make_rows(args.messages)
+    rows = len(stubs) + len(rich)
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp_dir:
+        results = {
+            'before': bench_before(os.path.join(tmp_dir, 'before.db'), stubs, rich),
+            'after': bench_after(os.path.join(tmp_dir, 'after.db'), stubs, rich),
+        }
+
+    print(f"{args.messages} messages ({rows} rows written)")
+    for name, elapsed in results.items():
+        print(f"  {name:<7} {elapsed:8.2f} s  {rows / elapsed:12,.0f} rows/sec")
+    print(f"  speedup {results['before'] / results['after']:8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""
+Benchmark CLI startup: import time and wall-clock latency of cache-only commands.
+
+A cache is synced from the offline fake Gmail service into a temporary directory.
+Each command then runs in a fresh interpreter (like a real invocation, with the
+cache pointed at the temporary file) and the median wall time over several runs
+is reported, together with whether the Google auth/discovery stack was imported.
+The import-time breakdown comes from `python -X importtime`. The project is
+byte-compiled first, as it is after the first real run, so the numbers do not
+depend on PYTHONDONTWRITEBYTECODE or stale .pyc files.
+
+Run from the root of the project:
+    python -m benchmarks.bench_startup [--messages 10000] [--runs 7] [--target-ms 100]
+"""
+import argparse
+import compileall
+import contextlib
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from src.fake_gmail import FakeMailbox, FakeGmailService
+from src.gmail_db import GmailCacheDB
+from src.MessageAccesor import MessageAccesor
+from src.quota_scheduler import QuotaScheduler
+
+# Modules only commands that talk to Gmail should load
+AUTH_STACK_MODULES = ['google.auth.transport.requests', 'google_auth_oauthlib', 'googleapiclient.discovery']
+
+# Runs the CLI in a fresh interpreter against the cache file given as argv[1]
+CHILD_CODE = '''
+import contextlib, io, json, sys
+import src.gmail_db
+src.gmail_db.DEFAULT_DB_PATH = sys.argv[1]
+from src.MessageAccesor import main
+sys.argv = ['MessageAccesor.py'] + sys.argv[2:]
+with contextlib.redirect_stdout(io.StringIO()):
+    try:
+        main()
+    except SystemExit:
+        pass
+print(json.dumps([name for name in %r if name in sys.modules]))
+''' % (AUTH_STACK_MODULES,)
+
+
+def prepare_cache(directory, message_count):
+    """Sync a fake mailbox into a cache in `directory` and return (cache path, a message ID)."""
+    db_path = os.path.join(directory, 'gmail_cache.db')
+    service = FakeGmailService(FakeMailbox(message_count))
+    accessor = MessageAccesor(service=service, service_factory=service.clone, db=GmailCacheDB(db_path))
+    accessor.scheduler = QuotaScheduler(units_per_second=1e9)
+    with contextlib.redirect_stdout(io.StringIO()):
+        accessor.get_all_messages()
+        accessor.list_labels()
+    conn = accessor.db.get_read_connection()
+    try:
+        message_id = conn.execute("SELECT message_id FROM message_rich_metadata LIMIT 1").fetchone()[0]
+    finally:
+        accessor.db.close_connection(conn)
+    accessor.db.close()
+    return db_path, message_id
+
+
+def time_command(db_path, command, runs):
+    """Run a CLI command `runs` times in fresh interpreters; return (wall times in ms, auth modules loaded)."""
+    timings, loaded = [], []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', CHILD_CODE, db_path, *command],
+                                capture_output=True, text=True, check=True)
+        timings.append((time.perf_counter() - start) * 1000)
+        loaded = json.loads(result.stdout.strip().splitlines()[-1])
+    return timings, loaded
+
+
+def import_breakdown(module, top):
+    """Return (total ms, [(ms, name)] of the slowest direct imports) from python -X importtime."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, check=True)
+    total, direct = 0.0, []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        if name.strip() == module:
+            total = int(cumulative) / 1000
+        elif depth == 1:
+            direct.append((int(cumulative) / 1000, name.strip()))
+    return total, sorted(direct, reverse=True)[:top]
+
+
+def time_service_builds(directory, count):
+    """Return ms per service built with build() and with the cached discovery document."""
+    from google.oauth2.credentials import Credentials
+    from googleapiclient.discovery import build
+    from src.gmail_service import build_gmail_service, load_discovery_document
+    credentials = Credentials(token='benchmark')
+    # Load the document once, like the first service of a run (cached in `directory`)
+    load_discovery_document(path=os.path.join(directory, 'gmail_discovery.json'))
+    results = {}
+    for name, builder in (('build()', lambda: build('gmail', 'v1', credentials=credentials)),
+                          ('build_gmail_service()', lambda: build_gmail_service(credentials))):
+        start = time.perf_counter()
+        for _ in range(count):
+            builder()
+        results[name] = (time.perf_counter() - start) * 1000 / count
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CLI startup and cache-only command latency.")
+    parser.add_argument("--messages", type=int, default=10000, help="Messages in the benchmark cache. Default: 10000")
+    parser.add_argument("--runs", type=int, default=7, help="Runs per command (the median is reported). Default: 7")
+    parser.add_argument("--target-ms", type=float, default=100, help="Latency target for cache-only commands. Default: 100")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest imports to list. Default: 10")
+    args = parser.parse_args()
+
+    compileall.compile_dir(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'), quiet=1)
+    total, direct = import_breakdown('src.MessageAccesor', args.top)
+    print(f"import src.MessageAccesor: {total:.1f} ms")
+    for milliseconds, name in direct:
+        print(f"  {milliseconds:8.1f} ms  {name}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        print("\nService construction:")
+        for name, milliseconds in time_service_builds(directory, 20).items():
+            print(f"  {milliseconds:8.2f} ms  {name}")
+
+        print(f"\nSyncing {args.messages} fake messages into a temporary cache...")
+        db_path, message_id = prepare_cache(directory, args.messages)
+        commands = [
+            ['--help'],
+            ['report'],
+            ['search', 'invoice'],
+            ['rules', os.path.join(directory, 'rules.json')],
+            ['list-labels', '--offline'],
+            ['list-messages', '--offline'],
+            ['get-message', message_id, '--offline'],
+        ]
+        with open(commands[3][1], 'w') as f:
+            json.dump({'rules': [{'name': 'old', 'action': 'archive', 'match': {'older_than_days': 365}}]}, f)
+
+        print(f"\n{'command':<40} {'median':>9} {'max':>9}  auth stack")
+        failures = 0
+        for command in commands:
+            timings, loaded = time_command(db_path, command, args.runs)
+            median = statistics.median(timings)
+            over_target = command != ['--help'] and median > args.target_ms
+            failures += over_target
+            label = ' '.join('ID' if part == message_id else os.path.basename(part) for part in command)
+            print(f"{label:<40} {median:>6.1f} ms {max(timings):>6.1f} ms  "
+                  f"{', '.join(loaded) or 'not loaded'}{'  (over target)' if over_target else ''}")
+        print(f"\n{len(commands) - 1 - failures} of {len(commands) - 1} cache-only commands under {args.target_ms:.0f} ms.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Benchmark a full get_all_messages() sync against the offline fake Gmail service.
+
+For each mailbox size the sync runs in a fresh subprocess (so peak RSS is per
+run) on an empty cache, and reports messages/sec, API calls per method, HTTP
+requests, quota units, response bytes, time spent writing to the cache and
+peak RSS, and the time per pipeline stage and mean queue depths recorded by
+src/metrics.py. Latency and injected 429/500 rates simulate a real account.
+
+Run from the root of the project:
+    python -m benchmarks.bench_sync [--sizes 1000 100000 1000000] [--latency 0.05] [--error-rate 0.01]
+                                    [--mode thread] [--thread-size 10]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from src import metrics
+from src.config import SYNC_MODES, DEFAULT_SYNC_MODE
+from src.fake_gmail import FakeMailbox, FakeGmailService
+from src.gmail_db import GmailCacheDB
+from src.MessageAccesor import MessageAccesor
+from src.quota_scheduler import QuotaScheduler
+
+DEFAULT_SIZES = [1000, 100000]
+# Stage timers from src/metrics.py shown in the breakdown
+BREAKDOWN_TIMERS = ['pipeline.list', 'pipeline.fetch', 'pipeline.write', 'extract.headers', 'extract.json',
+                    'extract.attachments', 'db.upsert_stubs', 'db.upsert_rich', 'db.commit', 'quota.wait', 'api.backoff']
+
+
+def run_once(args, message_count):
+    """Sync a fresh cache from a fake mailbox and return the measurements."""
+    mailbox = FakeMailbox(message_count, seed=args.seed, extra_headers=args.extra_headers,
+                          header_size=args.header_size, attachment_rate=args.attachment_rate,
+                          thread_size=args.thread_size)
+    service = FakeGmailService(mailbox, error_rate=args.error_rate, server_error_rate=args.server_error_rate,
+                               latency=args.latency, seed=args.seed)
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp_dir:
+        db = GmailCacheDB(os.path.join(tmp_dir, 'bench.db'))
+        accessor = MessageAccesor(service=service, service_factory=service.clone, db=db)
+        accessor.scheduler = QuotaScheduler(units_per_second=args.units_per_second, base_delay=args.base_delay)
+
+        metrics.reset()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            accessor.get_all_messages(workers=args.workers, batch_size=args.batch_size, projection=args.projection,
+                                      mode=args.mode)
+        elapsed = time.perf_counter() - start
+
+        conn = db.get_read_connection()
+        cached = conn.execute("SELECT COUNT(*) FROM message_rich_metadata").fetchone()[0]
+        db.close_connection(conn)
+        db.close()
+
+    stats = service.stats.summary()
+    snapshot = metrics.snapshot()
+    timers = snapshot['timers']
+    return {
+        'messages': message_count,
+        'cached': cached,
+        'seconds': elapsed,
+        'messages_per_sec': cached / elapsed if elapsed else 0.0,
+        'db_write_seconds': sum(timers.get(name, {}).get('seconds', 0.0) for name in ('db.upsert_stubs', 'db.upsert_rich', 'db.commit')),
+        'stage_seconds': {name: timers[name]['seconds'] for name in BREAKDOWN_TIMERS if name in timers},
+        'queue_depths': {name: gauge['mean'] for name, gauge in snapshot['gauges'].items()},
+        'retries': sum(value for name, value in snapshot['counters'].items() if name.startswith('api.retries.')),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        **stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a full sync against the fake Gmail service.")
+    parser.add_argument("--sizes", type=int, nargs='+', default=DEFAULT_SIZES, help="Mailbox sizes to sync. Default: 1000 100000")
+    parser.add_argument("--workers", type=int, default=4, help="Number of batch-get workers. Default: 4")
+    parser.add_argument("--batch-size", type=int, default=50, help="Messages per batch request. Default: 50")
+    parser.add_argument("--projection", default='lean', help="Projection profile. Default: lean")
+    parser.add_argument("--mode", choices=SYNC_MODES, default=DEFAULT_SYNC_MODE, help=f"Sync strategy. Default: {DEFAULT_SYNC_MODE}")
+    parser.add_argument("--thread-size", type=int, default=3, help="Messages per thread in the fake mailbox. Default: 3")
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated seconds per HTTP request. Default: 0")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability of a 429 per request. Default: 0")
+    parser.add_argument("--server-error-rate", type=float, default=0.0, help="Probability of a 500 per request. Default: 0")
+    parser.add_argument("--units-per-second", type=float, default=1e9, help="Quota units per second. Default: unlimited (use 250 for Gmail's real limit)")
+    parser.add_argument("--base-delay", type=float, default=0.05, help="Backoff delay for the first retry, in seconds. Default: 0.05")
+    parser.add_argument("--extra-headers", type=int, default=20, help="Received/DKIM headers per message. Default: 20")
+    parser.add_argument("--header-size", type=int, default=200, help="Bytes per extra header. Default: 200")
+    parser.add_argument("--attachment-rate", type=float, default=0.1, help="Share of messages with attachments. Default: 0.1")
+    parser.add_argument("--seed", type=int, default=0, help="Mailbox seed. Default: 0")
+    parser.add_argument("--dir", help="Directory for the temporary databases.")
+    parser.add_argument("--single", type=int, help=argparse.SUPPRESS) # Used internally: run one size and print JSON
+    args = parser.parse_args()
+
+    if args.single is not None:
+        print(json.dumps(run_once(args, args.single)))
+        return
+
+    base_argv = sys.argv[1:]
+    for size in args.sizes:
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.bench_sync', *base_argv, '--single', str(size)],
+            check=True, capture_output=True, text=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        calls = ', '.join(f"{method} {count}" for method, count in sorted(result['calls'].items()))
+        errors = ', '.join(f"{status}: {count}" for status, count in sorted(result['errors_injected'].items())) or 'none'
+        print(f"{size} messages ({result['cached']} cached)")
+        print(f"  {result['seconds']:10.2f} s  {result['messages_per_sec']:12,.0f} messages/sec")
+        print(f"  API calls     {result['api_calls']} ({calls})")
+        print(f"  HTTP requests {result['http_requests']}  quota units {result['quota_units']}  "
+              f"bytes {result['bytes'] / 1024 / 1024:.1f} MB  injected errors {errors}")
+        print(f"  DB writes     {result['db_write_seconds']:.2f} s  peak RSS {result['peak_rss_mb']:.0f} MB  retries {result['retries']}")
+        # Summed over threads, so concurrent stages can add up to more than the wall time
+        print(f"  Stage time    {', '.join(f'{name} {seconds:.2f} s' for name, seconds in result['stage_seconds'].items())}")
+        print(f"  Queue depth   {', '.join(f'{name} {depth:.1f}' for name, depth in result['queue_depths'].items())}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Check that the memory of a full sync does not grow with the size of the mailbox.
+
+get_all_messages() streams stub pages and missing IDs through the pipeline
+instead of holding the mailbox in memory, so syncing a large mailbox should
+peak at about the same memory as syncing a small one. Each size is synced from
+the offline fake Gmail service in a fresh subprocess on an empty cache, and two
+peaks are compared:
+
+*   the Python heap, from tracemalloc (the number a regression would move), and
+*   peak RSS, with SQLite's page cache and memory map pinned low. With the
+    normal CONNECTION_PRAGMAS (64 MB of page cache and a 256 MB mmap) RSS grows
+    with the database file and would hide a regression in the sync code.
+
+The check fails (exit status 1) if either peak of the largest size exceeds that
+of the smallest by more than the allowed growth.
+
+Run from the root of the project:
+    python -m benchmarks.bench_sync_memory [--sizes 2000 40000] [--max-heap-growth-mb 4] [--max-rss-growth-mb 16]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+from src import gmail_db
+from src.fake_gmail import FakeMailbox, FakeGmailService
+from src.gmail_db import GmailCacheDB
+from src.MessageAccesor import MessageAccesor
+from src.quota_scheduler import QuotaScheduler
+
+DEFAULT_SIZES = [2000, 40000]
+# Small enough that SQLite's own caches cannot hide growth in the sync code
+PINNED_PRAGMAS = {
+    'cache_size': -2000,    # ~2 MB of page cache
+    'mmap_size': 0,         # No memory-mapped reads
+}
+
+
+def run_once(args, message_count):
+    """Sync a fresh cache from a fake mailbox and return the memory peaks in MB."""
+    gmail_db.CONNECTION_PRAGMAS.update(PINNED_PRAGMAS)
+    service = FakeGmailService(FakeMailbox(message_count, seed=args.seed))
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp_dir:
+        db = GmailCacheDB(os.path.join(tmp_dir, 'bench.db'))
+        accessor = MessageAccesor(service=service, service_factory=service.clone, db=db)
+        accessor.scheduler = QuotaScheduler(units_per_second=1e9)
+
+        tracemalloc.start()
+        with contextlib.redirect_stdout(io.StringIO()):
+            accessor.get_all_messages(workers=args.workers, batch_size=args.batch_size)
+        heap_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        conn = db.get_read_connection()
+        cached = conn.execute("SELECT COUNT(*) FROM message_rich_metadata").fetchone()[0]
+        db.close_connection(conn)
+        db.close()
+
+    return {
+        'messages': message_count,
+        'cached': cached,
+        'heap_peak_mb': heap_peak / 1024 / 1024,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that sync memory does not grow with the mailbox size.")
+    parser.add_argument("--sizes", type=int, nargs='+', default=DEFAULT_SIZES, help="Mailbox sizes to sync. Default: 2000 40000")
+    parser.add_argument("--max-heap-growth-mb", type=float, default=4, help="Allowed growth of the Python heap peak. Default: 4")
+    parser.add_argument("--max-rss-growth-mb", type=float, default=16, help="Allowed growth of peak RSS. Default: 16")
+    parser.add_argument("--workers", type=int, default=4, help="Number of batch-get workers. Default: 4")
+    parser.add_argument("--batch-size", type=int, default=50, help="Messages per batch request. Default: 50")
+    parser.add_argument("--seed", type=int, default=0, help="Mailbox seed. Default: 0")
+    parser.add_argument("--dir", help="Directory for the temporary databases.")
+    parser.add_argument("--single", type=int, help=argparse.SUPPRESS) # Used internally: run one size and print JSON
+    args = parser.parse_args()
+
+    if args.single is not None:
+        print(json.dumps(run_once(args, args.single)))
+        return
+
+    base_argv = sys.argv[1:]
+    results = []
+    for size in sorted(args.sizes):
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.bench_sync_memory', *base_argv, '--single', str(size)],
+            check=True, capture_output=True, text=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        print(f"{size:>9} messages ({result['cached']} cached)  heap peak {result['heap_peak_mb']:7.2f} MB  "
+              f"peak RSS {result['peak_rss_mb']:7.1f} MB")
+
+    smallest, largest = results[0], results[-1]
+    heap_growth = largest['heap_peak_mb'] - smallest['heap_peak_mb']
+    rss_growth = largest['peak_rss_mb'] - smallest['peak_rss_mb']
+    print(f"\nGrowth from {smallest['messages']} to {largest['messages']} messages: "
+          f"heap {heap_growth:+.2f} MB (allowed {args.max_heap_growth_mb:g}), "
+          f"RSS {rss_growth:+.1f} MB (allowed {args.max_rss_growth_mb:g})")
+    failures = []
+    # Only the default sync labels are cached, so compare against the smaller run rather than the mailbox size
+    if largest['cached'] <= smallest['cached']:
+        failures.append("the larger mailbox did not sync more messages")
+    if heap_growth > args.max_heap_growth_mb:
+        failures.append("the Python heap grows with the mailbox size")
+    if rss_growth > args.max_rss_growth_mb:
+        failures.append("peak RSS grows with the mailbox size")
+    if failures:
+        print(f"FAILED: {'; '.join(failures)}.")
+        sys.exit(1)
+    print("OK: sync memory does not grow with the mailbox size.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Check that widening the synced labels caches every message of the new scope.
+
+A fake mailbox is synced with INBOX only, then with more labels added one step
+at a time (by default CATEGORY_PROMOTIONS, then ALL_MAIL). After each step the
+cache is compared with the messages of the fake mailbox that are in the synced
+labels (gmail_db.in_sync_scope), and the API calls of the step are reported.
+In thread mode this covers threads that were fetched under the narrower scope
+and have not changed since: their members in the new labels must still be
+fetched.
+
+The check fails (exit status 1) if any in-scope message is missing from the
+cache after a step.
+
+Run from the root of the project:
+    python -m benchmarks.bench_sync_scope [--messages 1500] [--modes {message,thread} ...] [--labels CATEGORY_PROMOTIONS ALL_MAIL]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+
+from src.config import SYNC_MODES, ALL_MAIL
+from src.fake_gmail import FakeMailbox, FakeGmailService
+from src.gmail_db import GmailCacheDB, in_sync_scope
+from src.MessageAccesor import MessageAccesor
+from src.quota_scheduler import QuotaScheduler
+
+DEFAULT_STEPS = ['CATEGORY_PROMOTIONS', ALL_MAIL]
+
+
+def missing_messages(mailbox, db):
+    """Return the IDs of the mailbox's messages in the synced labels that are not cached."""
+    conn = db.get_read_connection()
+    try:
+        sync_labels = db.get_sync_labels(conn)
+        cached = {row[0] for row in conn.execute("SELECT message_id FROM message_rich_metadata")}
+    finally:
+        db.close_connection(conn)
+    return [mailbox.message_id(index) for index in range(mailbox.message_count)
+            if mailbox.exists(index) and in_sync_scope(mailbox.labels_of(index), sync_labels)
+            and mailbox.message_id(index) not in cached]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that widening the synced labels caches the whole new scope.")
+    parser.add_argument("--messages", type=int, default=1500, help="Messages in the fake mailbox. Default: 1500")
+    parser.add_argument("--modes", choices=SYNC_MODES, nargs='+', default=list(SYNC_MODES), help="Sync strategies to check. Default: all")
+    parser.add_argument("--labels", nargs='+', default=DEFAULT_STEPS,
+                        help=f"Labels added after the INBOX sync, one step each. Default: {' '.join(DEFAULT_STEPS)}")
+    parser.add_argument("--seed", type=int, default=0, help="Mailbox seed. Default: 0")
+    args = parser.parse_args()
+
+    failures = 0
+    for mode in args.modes:
+        mailbox = FakeMailbox(args.messages, seed=args.seed)
+        service = FakeGmailService(mailbox)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = GmailCacheDB(os.path.join(tmp_dir, 'bench.db'))
+            accessor = MessageAccesor(service=service, service_factory=service.clone, db=db)
+            accessor.scheduler = QuotaScheduler(units_per_second=1e9)
+            print(f"{mode} mode")
+            for label_id in ['INBOX', *args.labels]:
+                calls_before = service.stats.summary()['api_calls']
+                with contextlib.redirect_stdout(io.StringIO()):
+                    accessor.get_all_messages(mode=mode, label_ids=[label_id])
+                missing = missing_messages(mailbox, db)
+                failures += bool(missing)
+                print(f"  + {label_id:<22} {service.stats.summary()['api_calls'] - calls_before:>6} API calls  "
+                      f"{len(missing):>6} in-scope messages not cached")
+            db.close()
+
+    if failures:
+        print(f"\nFAILED: {failures} steps left in-scope messages out of the cache.")
+        sys.exit(1)
+    print("\nOK: every step cached all messages of the synced labels.")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,74 @@
 import os.path
-import pickle # Using pickle for token storage as per common Google examples
-
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-from googleapiclient.http import BatchHttpRequest  # For batch requests
 
 import base64 # For decoding message body
 import email # For parsing raw email data if you fetch 'raw' format
 import argparse # For command-line interface
+import contextlib
 import json # For handling JSON string conversions
+import time
 
-from src.config import TOKEN_FILENAME, SCOPES, CREDENTIALS_FILENAME
-from src.gmail_db import GmailCacheDB
+from src.config import TOKEN_FILENAME, SCOPES, CREDENTIALS_FILENAME, PROJECTION_PROFILES, DEFAULT_PROJECTION
+from src.config import MODIFY_SCOPES, FULL_ACCESS_SCOPES, SCOPE_LEVELS, BATCH_ACTION_CHUNK_SIZE
+from src.config import CACHE_TTL_SECONDS, CACHED_MESSAGE_FORMATS, BODY_STORE_BUDGET_MB
+from src.config import SYNC_MODES, DEFAULT_SYNC_MODE, LIST_PAGE_SIZE, QUOTA_UNITS_PER_METHOD, ALL_MAIL
+from src.config import DEFAULT_SYNC_LABELS, ACCOUNTS_FILENAME, CLASSIFY_BATCH_SIZE, CLASSIFY_WORKERS
+from src.config import LABEL_CHECK_MAX_AGE_SECONDS, LABEL_CHECK_FIELDS
+from src.gmail_db import GmailCacheDB, in_sync_scope
+# The Google client libraries are slow to import; gmail_service and get_gmail_service
+# only import them when a command actually talks to Gmail
+from src import gmail_service
+from src import metrics
+from src.sync_pipeline import MetadataPipeline, ThreadPipeline, LabelRefreshPipeline
+from src.quota_scheduler import QuotaScheduler, is_retryable_error
+from src.insights import InsightsReport, DEFAULT_LARGE_EMAIL_MB, format_size
+from src.actions import ActionEngine, ACTIONS, FULL_ACCESS_ACTIONS, build_selection
+from src.rules import RuleEngine, load_rules
+from src.search import CacheSearch, ORDERINGS
+from src.accounts import load_accounts, select_accounts, authorize_accounts, sync_accounts
  
 class MessageAccesor:
-    def __init__(self):
-        if os.path.exists(CREDENTIALS_FILENAME):
-            self.flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILENAME, SCOPES)
-            # Set a default redirect URI if not present, common for installed apps
-            if not self.flow.redirect_uri:
-                self.flow.redirect_uri = 'http://localhost:0' # Or a specific port
-        else:
+    def __init__(self, service=None, service_factory=None, db=None, scopes=None, offline=False, token_path=None):
+        """Sets up the quota scheduler and cache database.
+        
+        The OAuth flow and the Gmail service are only set up when a command first
+        needs the API (see get_gmail_service), so commands answered from the cache
+        start without loading the Google client libraries.
+        
+        Args:
+            service (optional): A ready Gmail service object (e.g. src.fake_gmail.FakeGmailService).
+                                When given, no credentials or OAuth flow are needed.
+            service_factory (callable, optional): Returns an additional service object for a
+                                                  worker thread. Required with `service`.
+            db (GmailCacheDB, optional): The cache database. Defaults to the standard cache file.
+            scopes (list, optional): OAuth scopes to request. Defaults to read-only access.
+            offline (bool): Only answer from the local cache and never contact Gmail.
+                            No credentials are needed.
+            token_path (str, optional): Where the account's OAuth token is saved.
+                                        Defaults to TOKEN_FILENAME.
+        """
+        self.flow = None
+        self.scopes = scopes or SCOPES
+        self.offline = offline
+        if service is not None:
+            if service_factory is None:
+                raise ValueError("service_factory is required when a service is passed in")
+        elif offline:
+            pass # Cache-only reads need no OAuth flow
+        elif not os.path.exists(CREDENTIALS_FILENAME):
             raise FileNotFoundError(f"Credentials file not found at {CREDENTIALS_FILENAME}")
         
-        self.service = None  # Initialize service as None
-        self.all_messages_metadata = [] # To store metadata of all fetched messages
+        self.service = service  # Built lazily by get_gmail_service() unless passed in
+        self.service_factory = service_factory
+        self.creds = None  # Credentials shared by worker services
+        self.token_path = token_path or TOKEN_FILENAME
+        # Every API call goes through the scheduler to stay under the per-user quota
+        self.scheduler = QuotaScheduler()
+        # Which headers and fields metadata fetches request and store
+        self.projection = PROJECTION_PROFILES[DEFAULT_PROJECTION]
         # Create a database connection
-        self.db = GmailCacheDB()
+        self.db = db or GmailCacheDB()
+        # Cached data younger than this is served by the read commands without an API call
+        self.cache_ttl = CACHE_TTL_SECONDS
         
     def _get_header(self, headers, name):
         """Helper function to extract header value by name (case-insensitive)
@@ -57,11 +96,17 @@ class MessageAccesor:
         # Return existing service if already created
         if self.service:
             return self.service
+        import pickle # Using pickle for token storage as per common Google examples
+        from google.auth.transport.requests import Request
             
         creds = None
-        if os.path.exists(TOKEN_FILENAME):
-            with open(TOKEN_FILENAME, 'rb') as token:
+        if os.path.exists(self.token_path):
+            with open(self.token_path, 'rb') as token:
                 creds = pickle.load(token)
+            # A token granted for a narrower scope (e.g. read-only) needs a new consent
+            if creds and not self._has_scopes(creds):
+                print("The saved token does not grant the access this command needs, re-authenticating.")
+                creds = None
 
         if not creds or not creds.valid:
             # Case 1: Try refreshing expired credentials
@@ -76,20 +121,24 @@ class MessageAccesor:
             # Case 2: No valid credentials available, need to run auth flow
             if not creds or not creds.valid:
                 try:
-                    creds = self.flow.run_local_server(port=0)  # port=0 finds a free port
+                    creds = self._get_flow().run_local_server(port=0)  # port=0 finds a free port
                 except Exception as e:
                     raise RuntimeError(f"Error during authentication flow: {e}. " 
                                       f"Please ensure your credentials.json is configured correctly.")
             
             # Save the credentials for the next run
-            with open(TOKEN_FILENAME, 'wb') as token:
+            token_dir = os.path.dirname(self.token_path)
+            if token_dir:
+                os.makedirs(token_dir, exist_ok=True)
+            with open(self.token_path, 'wb') as token:
                 pickle.dump(creds, token)
-                print(f"Token saved to {TOKEN_FILENAME}")
+                print(f"Token saved to {self.token_path}")
 
+        self.creds = creds
         try:
-            self.service = build('gmail', 'v1', credentials=creds)
+            self.service = gmail_service.build_gmail_service(creds)
             return self.service
-        except HttpError as error:
+        except gmail_service.HttpError as error:
             print(f'An API error occurred: {error}')
             # Details for common errors
             if error.resp.status == 403:
@@ -101,8 +150,89 @@ class MessageAccesor:
             print(f"An unexpected error occurred while building the service: {e}")
             return None
 
+    def _get_flow(self):
+        """Creates the OAuth flow from the client secrets file, on first use.
+        
+        Returns:
+            google_auth_oauthlib.flow.InstalledAppFlow: The flow for the requested scopes.
+        """
+        if self.flow is None:
+            from google_auth_oauthlib.flow import InstalledAppFlow
+            self.flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILENAME, self.scopes)
+            # Set a default redirect URI if not present, common for installed apps
+            if not self.flow.redirect_uri:
+                self.flow.redirect_uri = 'http://localhost:0' # Or a specific port
+        return self.flow
+
+    def _has_scopes(self, creds):
+        """Checks whether credentials grant the requested scopes (or broader ones).
+        
+        Args:
+            creds (google.oauth2.credentials.Credentials): The credentials to check.
+            
+        Returns:
+            bool: True if every requested scope is covered by a granted scope.
+        """
+        granted = getattr(creds, 'granted_scopes', None) or creds.scopes or []
+        granted_level = max((SCOPE_LEVELS.index(scope) for scope in granted if scope in SCOPE_LEVELS), default=-1)
+        return all(
+            (SCOPE_LEVELS.index(scope) <= granted_level) if scope in SCOPE_LEVELS else scope in granted
+            for scope in self.scopes
+        )
+
+    def _cache_is_current(self, conn):
+        """Checks whether the cached mirror of the synced labels can be served without refetching.
+        
+        The cache is current if the last sync (or validation) is younger than the
+        cache TTL. Otherwise one getProfile call (1 quota unit) compares Gmail's
+        current historyId with the stored history cursor: if they are equal nothing
+        has changed since the last sync, and the validation time is recorded.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to read the sync state from.
+            
+        Returns:
+            bool: True if cached data can be served as current.
+        """
+        cursor_age = self.db.get_sync_state_age(conn, 'history_id')
+        if cursor_age is None:
+            return False # No completed sync yet
+        if cursor_age <= self.cache_ttl:
+            return True
+        if self.offline:
+            return False
+        
+        service = self.get_gmail_service()
+        if not service:
+            return False
+        profile = self.scheduler.execute(service.users().getProfile(userId='me'), 'getProfile')
+        history_id = self.db.get_sync_state(conn, 'history_id')
+        if str(profile.get('historyId')) != history_id:
+            return False
+        with self.db.write_transaction() as write_conn:
+            self.db.set_sync_state(write_conn, 'history_id', history_id)
+        return True
+
     def list_labels(self):
-        """Lists all Gmail labels for the user."""
+        """Lists all Gmail labels for the user.
+        
+        Labels are served from the cache when they were fetched within the cache
+        TTL (or always, offline); otherwise they are fetched and stored.
+        """
+        conn = self.db.get_read_connection()
+        try:
+            labels, age = self.db.get_label_definitions(conn)
+        finally:
+            self.db.close_connection(conn)
+        
+        if labels and (self.offline or age <= self.cache_ttl):
+            print(f"\nLabels from the local cache (fetched {age:.0f} s ago):")
+            self._print_labels(labels)
+            return
+        if self.offline:
+            print("No labels in the local cache yet. Run 'list-labels' once while online.")
+            return
+        
         try:
             service = self.get_gmail_service()
             if not service:
@@ -110,19 +240,53 @@ class MessageAccesor:
                 return
                 
             print("\nFetching Gmail labels...")
-            results = service.users().labels().list(userId='me').execute()
+            results = self.scheduler.execute(service.users().labels().list(userId='me'), 'labels.list')
             labels = results.get('labels', [])
-            if not labels:
-                print('No labels found.')
-            else:
-                print('Labels:')
-                for label in labels:
-                    print(f"- {label['name']} (ID: {label['id']})")
-        except HttpError as error:
+            with self.db.write_transaction() as write_conn:
+                self.db.replace_label_definitions(write_conn, labels)
+            print('Labels:')
+            self._print_labels(labels)
+        except gmail_service.HttpError as error:
             print(f'An API error occurred while listing labels: {error}')
 
+    def _print_labels(self, labels):
+        """Prints label names and IDs.
+        
+        Args:
+            labels (list): Label dictionaries with 'id' and 'name' keys.
+        """
+        if not labels:
+            print('No labels found.')
+        for label in labels:
+            print(f"- {label['name']} (ID: {label['id']})")
+
     def list_messages_cmd(self, label_ids, max_results, query):
-        """Lists messages based on provided criteria."""
+        """Lists messages based on provided criteria.
+        
+        Listings without a Gmail search query whose labels the cache mirrors (see
+        in_sync_scope; INBOX unless other labels were synced) are answered from the
+        cache when it is current (see _cache_is_current), or always, offline.
+        Other listings call the API; results in the synced labels are written
+        through as stubs, so the next sync fetches their rich metadata.
+        """
+        label_ids = label_ids or []
+        conn = self.db.get_read_connection()
+        try:
+            sync_labels = self.db.get_sync_labels(conn)
+            if not query and in_sync_scope(label_ids, sync_labels) and (self.offline or self._cache_is_current(conn)):
+                messages = self.db.list_cached_messages(conn, label_ids, max_results)
+                print(f"\nMessages from the local cache (max: {max_results}, labels: {label_ids}):")
+                self._print_message_stubs(messages)
+                return
+        except gmail_service.HttpError as error:
+            print(f'An API error occurred while validating the cache: {error}')
+        finally:
+            self.db.close_connection(conn)
+        if self.offline:
+            print(f"Offline, only listings of the synced labels ({', '.join(sync_labels)}) without a query can be "
+                  f"answered from the local cache. Use the 'search' command to search the cache.")
+            return
+        
         try:
             service = self.get_gmail_service()
             if not service:
@@ -130,26 +294,75 @@ class MessageAccesor:
                 return
                 
             print(f"\nFetching messages (max: {max_results}, labels: {label_ids}, query: '{query or 'N/A'}')...")
-            list_response = service.users().messages().list(
+            list_response = self.scheduler.execute(service.users().messages().list(
                 userId='me',
                 labelIds=label_ids,
                 maxResults=max_results,
                 q=query
-            ).execute()
+            ), 'messages.list')
             messages = list_response.get('messages', [])
-
-            if not messages:
-                print("No messages found matching your criteria.")
-            else:
-                print("Found Messages (ID and Thread ID):")
-                for message_stub in messages:
-                    print(f"  ID: {message_stub['id']}, Thread ID: {message_stub['threadId']}")
-                print("\nUse 'get-message <ID>' to fetch full details of a message.")
-        except HttpError as error:
+            if messages and in_sync_scope(label_ids, sync_labels):
+                with self.db.write_transaction() as write_conn:
+                    self.db.upsert_stubs(write_conn, messages)
+            self._print_message_stubs(messages)
+        except gmail_service.HttpError as error:
             print(f'An API error occurred while listing messages: {error}')
 
+    def _print_message_stubs(self, messages):
+        """Prints message and thread IDs.
+        
+        Args:
+            messages (list): Message stub dictionaries with 'id' and 'threadId' keys.
+        """
+        if not messages:
+            print("No messages found matching your criteria.")
+        else:
+            print("Found Messages (ID and Thread ID):")
+            for message_stub in messages:
+                print(f"  ID: {message_stub['id']}, Thread ID: {message_stub['threadId']}")
+            print("\nUse 'get-message <ID>' to fetch full details of a message.")
+
     def get_message_detail(self, message_id, msg_format):
-        """Gets and displays a specific message."""
+        """Gets and displays a specific message.
+        
+        The 'metadata' and 'minimal' formats are served from the cache when the
+        message was fetched within the cache TTL or the cache is current (see
+        _cache_is_current), or always, offline. Cached metadata holds the headers
+        of the projection profile it was synced with. Fetched messages are written
+        through to the cache. Raw messages never change, so 'raw' is served from the
+        body store whenever the message is in it, and stored there when fetched.
+        """
+        if msg_format == 'raw':
+            from src.body_store import BodyStore
+            body_store = BodyStore.for_cache(self.db)
+            if body_store.has(message_id):
+                print(f"\nMessage ID: {message_id} from the local body store...")
+                message = {'id': message_id, 'threadId': body_store.get_thread_id(message_id)}
+                self._print_message(message, msg_format, raw_email_data=body_store.get_raw(message_id))
+                return
+        cached = None
+        if msg_format in CACHED_MESSAGE_FORMATS:
+            conn = self.db.get_read_connection()
+            try:
+                cached = self.db.get_cached_message(conn, message_id)
+                if cached and (self.offline or cached[1] <= self.cache_ttl or self._cache_is_current(conn)):
+                    message, age = cached
+                    print(f"\nMessage ID: {message_id} from the local cache (fetched {age:.0f} s ago)...")
+                    self._print_message(message, msg_format)
+                    return
+            except gmail_service.HttpError as error:
+                print(f'An API error occurred while validating the cache: {error}')
+            finally:
+                self.db.close_connection(conn)
+        if self.offline:
+            if msg_format in CACHED_MESSAGE_FORMATS:
+                print(f"Message {message_id} is not in the local cache.")
+            elif msg_format == 'raw':
+                print(f"Message {message_id} is not in the local body store. Use 'fetch-bodies' to download bodies.")
+            else:
+                print(f"Offline, only the {' and '.join(CACHED_MESSAGE_FORMATS)} and raw formats can be answered locally.")
+            return
+        
         try:
             service = self.get_gmail_service()
             if not service:
@@ -157,254 +370,884 @@ class MessageAccesor:
                 return
                 
             print(f"\nFetching message ID: {message_id} with format: {msg_format}...")
-            message = service.users().messages().get(userId='me', id=message_id, format=msg_format).execute()
-
-            print(f"Message ID: {message.get('id')}")
-            print(f"Thread ID: {message.get('threadId')}")
-            print(f"Snippet: {message.get('snippet', 'N/A')}")
-
-            if 'labelIds' in message:
-                print(f"Labels: {', '.join(message['labelIds'])}")
-
-            if msg_format == 'raw':
-                if 'raw' in message:
-                    raw_email_data = base64.urlsafe_b64decode(message['raw'].encode('ASCII'))
-                    print("\n--- Raw Email Data (decoded) ---")
-                    email_message = email.message_from_bytes(raw_email_data)
-                    print(f"Subject (from raw): {email_message['subject']}")
-                    print(f"From (from raw): {email_message['from']}")
-                    print(f"To (from raw): {email_message['to']}")
-
-                    if email_message.is_multipart():
-                        for part in email_message.walk():
-                            ctype = part.get_content_type()
-                            cdispo = str(part.get('Content-Disposition'))
-                            if ctype == 'text/plain' and 'attachment' not in cdispo:
-                                body = part.get_payload(decode=True)
-                                print("\n--- Plain Text Body (from raw) ---")
-                                print(body.decode('utf-8', errors='replace'))
-                                break
-                    else:
-                        body = email_message.get_payload(decode=True)
-                        print("\n--- Body (from raw) ---")
-                        print(body.decode('utf-8', errors='replace'))
-                else:
-                    print("Raw data not found in response.")
-            elif msg_format == 'full' or msg_format == 'metadata': # 'metadata' also includes payload headers
-                payload = message.get('payload')
-                if payload:
-                    headers = payload.get('headers', [])
-                    print("\n--- Headers ---")
-                    for header in headers:
-                        print(f"{header['name']}: {header['value']}")
-
-                    if msg_format == 'full': # Only parse body if 'full' format requested
-                        print("\n--- Message Body (from 'full' format) ---")
-                        parts = payload.get('parts')
-                        if parts: # Multipart message
-                            for part in parts:
-                                if part.get('mimeType') == 'text/plain':
-                                    body_data = part.get('body', {}).get('data')
-                                    if body_data:
-                                        text = base64.urlsafe_b64decode(body_data).decode('utf-8', errors='replace')
-                                        print("Plain Text Part:\n", text)
-                                        break # Show first plain text part
-                                # Could add handling for text/html here too
-                        elif payload.get('body', {}).get('data'): # Non-multipart message
-                            body_data = payload.get('body', {}).get('data')
-                            if body_data:
-                                text = base64.urlsafe_b64decode(body_data).decode('utf-8', errors='replace')
-                                print("Body:\n", text)
-                        else:
-                            print("No decodable body found in 'full' format payload.")
-                else:
-                    print("Payload not found in response.")
+            message = self.scheduler.execute(
+                service.users().messages().get(userId='me', id=message_id, format=msg_format), 'messages.get'
+            )
+            self._write_through_message(message, msg_format)
+            if msg_format == 'raw' and 'raw' in message:
+                body_store.put_raw(message['id'], message['raw'], message.get('threadId'))
+            self._print_message(message, msg_format)
 
-        except HttpError as error:
+        except gmail_service.HttpError as error:
             print(f'An API error occurred while fetching message {message_id}: {error}')
+            if cached:
+                message, age = cached
+                print(f"Showing the cached copy instead (fetched {age:.0f} s ago):")
+                self._print_message(message, msg_format)
         except Exception as e:
             print(f"An unexpected error occurred while processing message {message_id}: {e}")    
+
+    def _write_through_message(self, message, msg_format):
+        """Stores a message fetched by get-message in the cache.
+        
+        The cache mirrors the synced labels, so a message that no longer has any of them is removed.
+        'metadata' and 'full' responses replace the cached row; 'minimal' and 'raw'
+        responses carry no headers and only update the cached labels.
+        
+        Args:
+            message (dict): The users.messages.get response.
+            msg_format (str): The format it was fetched with.
+        """
+        if 'labelIds' not in message:
+            return
+        with self.db.write_transaction() as conn:
+            if not in_sync_scope(message['labelIds'], self.db.get_sync_labels(conn)):
+                self.db.delete_messages(conn, [message['id']])
+            elif msg_format in ('metadata', 'full'):
+                self.db.upsert_stubs(conn, [message])
+                self.db.upsert_rich_metadata(conn, [self._extract_rich_metadata(message['id'], message)])
+            else:
+                self.db.update_message_labels(conn, message['id'], message['labelIds'])
+
+    def _print_message(self, message, msg_format, raw_email_data=None):
+        """Prints a message resource in the layout of the requested format.
+        
+        Args:
+            message (dict): A users.messages.get resource (fetched or from the cache).
+            msg_format (str): The format it was requested in.
+            raw_email_data (bytes, optional): The decoded RFC822 message, when it comes
+                                              from the body store instead of message['raw'].
+        """
+        print(f"Message ID: {message.get('id')}")
+        print(f"Thread ID: {message.get('threadId')}")
+        print(f"Snippet: {message.get('snippet', 'N/A')}")
+
+        if 'labelIds' in message:
+            print(f"Labels: {', '.join(message['labelIds'])}")
+
+        if msg_format == 'raw':
+            if raw_email_data is None and 'raw' in message:
+                raw_email_data = base64.urlsafe_b64decode(message['raw'].encode('ASCII'))
+            if raw_email_data is not None:
+                print("\n--- Raw Email Data (decoded) ---")
+                email_message = email.message_from_bytes(raw_email_data)
+                print(f"Subject (from raw): {email_message['subject']}")
+                print(f"From (from raw): {email_message['from']}")
+                print(f"To (from raw): {email_message['to']}")
+
+                if email_message.is_multipart():
+                    for part in email_message.walk():
+                        ctype = part.get_content_type()
+                        cdispo = str(part.get('Content-Disposition'))
+                        if ctype == 'text/plain' and 'attachment' not in cdispo:
+                            body = part.get_payload(decode=True)
+                            print("\n--- Plain Text Body (from raw) ---")
+                            print(body.decode('utf-8', errors='replace'))
+                            break
+                else:
+                    body = email_message.get_payload(decode=True)
+                    print("\n--- Body (from raw) ---")
+                    print(body.decode('utf-8', errors='replace'))
+            else:
+                print("Raw data not found in response.")
+        elif msg_format == 'full' or msg_format == 'metadata': # 'metadata' also includes payload headers
+            payload = message.get('payload')
+            if payload:
+                headers = payload.get('headers', [])
+                print("\n--- Headers ---")
+                for header in headers:
+                    print(f"{header['name']}: {header['value']}")
+
+                if msg_format == 'full': # Only parse body if 'full' format requested
+                    print("\n--- Message Body (from 'full' format) ---")
+                    parts = payload.get('parts')
+                    if parts: # Multipart message
+                        for part in parts:
+                            if part.get('mimeType') == 'text/plain':
+                                body_data = part.get('body', {}).get('data')
+                                if body_data:
+                                    text = base64.urlsafe_b64decode(body_data).decode('utf-8', errors='replace')
+                                    print("Plain Text Part:\n", text)
+                                    break # Show first plain text part
+                            # Could add handling for text/html here too
+                    elif payload.get('body', {}).get('data'): # Non-multipart message
+                        body_data = payload.get('body', {}).get('data')
+                        if body_data:
+                            text = base64.urlsafe_b64decode(body_data).decode('utf-8', errors='replace')
+                            print("Body:\n", text)
+                    else:
+                        print("No decodable body found in 'full' format payload.")
+            else:
+                print("Payload not found in response.")
     
-    def get_all_messages(self):
-        """Fetches metadata for all messages in the INBOX and stores them in the database."""
-        try:
-            service = self.get_gmail_service()
-            if not service:
-                print("Failed to get Gmail service.")
-                return
+    def _metadata_request(self, service, msg_id):
+        """Builds the users.messages.get request used to fetch rich metadata.
+        
+        The current projection profile decides which headers Gmail returns
+        (metadataHeaders) and which response fields it sends (partial response).
+        
+        Args:
+            service: The Gmail API service object to build the request on.
+            msg_id (str): The ID of the message to fetch.
+            
+        Returns:
+            googleapiclient.http.HttpRequest: The request, not yet executed.
+        """
+        kwargs = {}
+        if self.projection['headers']:
+            kwargs['metadataHeaders'] = self.projection['headers']
+        if self.projection['fields']:
+            kwargs['fields'] = self.projection['fields']
+        return service.users().messages().get(userId='me', id=msg_id, format='metadata', **kwargs)
 
-            print("\nFetching all message metadata from INBOX...")
-            self.all_messages_metadata = []
-            page_token = None
-            total_messages_fetched = 0
+    def _thread_request(self, service, thread_id):
+        """Builds the users.threads.get request used by thread-mode sync.
+        
+        The projection profile applies to every message of the thread, as it does
+        to single messages in _metadata_request.
+        
+        Args:
+            service: The Gmail API service object to build the request on.
+            thread_id (str): The ID of the thread to fetch.
             
-            # Get a database connection
-            conn = self.db.get_db_connection()
-            cursor = conn.cursor()
+        Returns:
+            googleapiclient.http.HttpRequest: The request, not yet executed.
+        """
+        kwargs = {}
+        if self.projection['headers']:
+            kwargs['metadataHeaders'] = self.projection['headers']
+        if self.projection['fields']:
+            kwargs['fields'] = f"id,historyId,messages({self.projection['fields']})"
+        return service.users().threads().get(userId='me', id=thread_id, format='metadata', **kwargs)
+
+    def _extract_rich_metadata(self, msg_id, response):
+        """Builds a message_rich_metadata row from a users.messages.get response.
+        
+        Args:
+            msg_id (str): The ID of the message the response belongs to.
+            response (dict): The message resource returned by the API (format='metadata').
             
+        Returns:
+            tuple: Row values in the column order expected by GmailCacheDB.upsert_rich_metadata.
+        """
+        # Time each step for the metrics: header scan, JSON encoding, attachment walk
+        start = time.perf_counter()
+        
+        # Extract metadata fields
+        snippet = response.get('snippet', '')
+        internal_date = response.get('internalDate')
+        size_estimate = response.get('sizeEstimate')
+        label_ids = json.dumps(response.get('labelIds', []))
+        history_id = response.get('historyId')
+        
+        payload = response.get('payload', {})
+        headers = payload.get('headers', [])
+        
+        # Extract From and Subject headers
+        from_address = self._get_header(headers, 'From')
+        subject = self._get_header(headers, 'Subject')
+        headers_done = time.perf_counter()
+        
+        # Store the headers kept by the projection profile as compact JSON
+        if self.projection['headers']:
+            wanted = {name.lower() for name in self.projection['headers']}
+            headers = [header for header in headers if header['name'].lower() in wanted]
+        payload_headers_json = json.dumps(headers, separators=(',', ':'))
+        json_done = time.perf_counter()
+        
+        # Check for attachments
+        has_attachments = 0
+        attachment_filenames = []
+        
+        # Helper function to check for attachments recursively
+        def check_for_attachments(part):
+            if 'filename' in part and part['filename']:
+                return True, part['filename']
+            
+            if 'parts' in part:
+                for subpart in part['parts']:
+                    has_att, filename = check_for_attachments(subpart)
+                    if has_att:
+                        return True, filename
+                        
+            return False, None
+        
+        # Check payload for attachments
+        if 'parts' in payload:
+            for part in payload['parts']:
+                has_att, filename = check_for_attachments(part)
+                if has_att and filename:
+                    has_attachments = 1
+                    attachment_filenames.append(filename)
+        
+        end = time.perf_counter()
+        metrics.add_time('extract', end - start)
+        metrics.add_time('extract.headers', headers_done - start)
+        metrics.add_time('extract.json', json_done - headers_done)
+        metrics.add_time('extract.attachments', end - json_done)
+        return (
+            msg_id,
+            snippet,
+            internal_date,
+            size_estimate,
+            from_address,
+            subject,
+            label_ids,
+            has_attachments,
+            json.dumps(attachment_filenames) if attachment_filenames else None,
+            payload_headers_json,
+            int(history_id) if history_id else None
+        )
+
+    def _iter_stub_pages(self, service, label_id, page_token=None):
+        """Lists every message in a label, yielding one page of stubs at a time.
+        
+        Args:
+            service: The Gmail API service object.
+            label_id (str): The label to list, or ALL_MAIL for every message outside spam and trash.
+            page_token (str, optional): Page token to resume the listing from.
+            
+        Yields:
+            tuple: (stubs, next_page_token) where stubs is a list of message stub
+                   dictionaries ('id', 'threadId') and next_page_token is None on the last page.
+        """
+        total_messages_fetched = 0
+        
+        while True:
             try:
-                # Fetch message stubs and insert them into the database
-                while True:
-                    response = service.users().messages().list(
+                response = self.scheduler.execute(service.users().messages().list(
+                    userId='me',
+                    labelIds=None if label_id == ALL_MAIL else [label_id],
+                    pageToken=page_token
+                ), 'messages.list')
+            except gmail_service.HttpError as error:
+                # A saved page token can go stale; restart the listing from the first page
+                if page_token and total_messages_fetched == 0 and error.resp.status == 400:
+                    print("Saved page token is no longer valid, restarting the listing from the first page.")
+                    page_token = None
+                    continue
+                raise
+            
+            messages = response.get('messages', [])
+            page_token = response.get('nextPageToken')
+            if messages:
+                total_messages_fetched += len(messages)
+                print(f"Fetched {len(messages)} message stubs... (Total: {total_messages_fetched})")
+                yield messages, page_token
+
+            if not page_token:
+                break # No more pages
+
+    def _iter_thread_pages(self, service, label_id):
+        """Lists every thread with a message in a label, yielding one page at a time.
+        
+        Args:
+            service: The Gmail API service object.
+            label_id (str): The label to list threads of, or ALL_MAIL.
+            
+        Yields:
+            tuple: (threads, next_page_token) where threads is a list of thread
+                   dictionaries ('id', 'historyId', 'snippet').
+        """
+        page_token = None
+        total_threads_fetched = 0
+        
+        while True:
+            response = self.scheduler.execute(service.users().threads().list(
+                userId='me',
+                labelIds=None if label_id == ALL_MAIL else [label_id],
+                pageToken=page_token
+            ), 'threads.list')
+            
+            threads = response.get('threads', [])
+            page_token = response.get('nextPageToken')
+            total_threads_fetched += len(threads)
+            if threads:
+                print(f"Listed {len(threads)} threads from {label_id}... (Total: {total_threads_fetched})")
+            yield threads, page_token
+            
+            if not page_token:
+                break # No more pages
+
+    def _sync_threads(self, service, label_ids, sync_labels, workers, batch_size):
+        """Runs a full sync of some labels thread by thread, and reports the API calls saved.
+        
+        Threads are listed with threads.list and fetched with batch threads.get requests
+        (see ThreadPipeline), so a conversation costs one call however many messages it
+        has. Threads unchanged since the last thread-mode sync are skipped, which also
+        makes a re-run continue an interrupted sync.
+        
+        Args:
+            service: The Gmail API service object.
+            label_ids (list): The labels to list threads of.
+            sync_labels (list): All labels the cache mirrors; thread messages outside them are not stored.
+            workers (int): Number of concurrent batch-get workers.
+            batch_size (int): Number of threads per batch request.
+        """
+        # Read the historyId before listing, so that changes made while the
+        # listing is in progress are replayed by the next incremental sync
+        profile = self.scheduler.execute(service.users().getProfile(userId='me'), 'getProfile')
+        
+        print(f"\nFetching all threads from {', '.join(label_ids)} ({workers} workers, batch size {batch_size})...")
+        pipeline = ThreadPipeline(
+            self.db, self.build_worker_service, self._thread_request, self._extract_rich_metadata, self.scheduler,
+            sync_labels=sync_labels, workers=workers, batch_size=batch_size
+        )
+        # A thread listed under several labels is fetched once: afterwards its historyId is stored
+        pipeline.run((page for label_id in label_ids for page in self._iter_thread_pages(service, label_id)),
+                     store_stubs=False)
+        
+        with self.db.write_transaction() as write_conn:
+            self.db.set_sync_state(write_conn, 'history_id', profile.get('historyId'))
+            cached_messages = write_conn.execute("SELECT COUNT(*) FROM message_stubs").fetchone()[0]
+        
+        print(f"\nCompleted fetching rich metadata for {pipeline.rich_saved} messages in {pipeline.threads_fetched} threads "
+              f"({pipeline.messages_fetched - pipeline.rich_saved} thread messages outside the synced labels ignored, "
+              f"{pipeline.threads_skipped} unchanged threads skipped).")
+        
+        # What message mode would have spent: list every cached message, get each one stored
+        thread_calls = {'threads.list': pipeline.pages_listed, 'threads.get': pipeline.threads_fetched}
+        message_calls = {'messages.list': -(-cached_messages // LIST_PAGE_SIZE), 'messages.get': pipeline.rich_saved}
+        thread_units = sum(QUOTA_UNITS_PER_METHOD[method] * calls for method, calls in thread_calls.items())
+        message_units = sum(QUOTA_UNITS_PER_METHOD[method] * calls for method, calls in message_calls.items())
+        print(f"Thread mode used {sum(thread_calls.values())} API calls ({thread_units} quota units); "
+              f"fetching the same {pipeline.rich_saved} messages one by one would take "
+              f"{sum(message_calls.values())} calls ({message_units} quota units).")
+        if sum(message_calls.values()):
+            print(f"API calls saved: {1 - sum(thread_calls.values()) / sum(message_calls.values()):.0%}, "
+                  f"quota saved: {1 - thread_units / max(1, message_units):.0%}.")
+        if pipeline.failed_ids:
+            print(f"Could not fetch {len(pipeline.failed_ids)} threads after retrying; run the thread sync again to retry them.")
+        self.db.refresh_statistics()
+
+    def _sync_from_history(self, service, fallback="a full sync"):
+        """Replays Gmail history records since the last sync into the cache.
+        
+        Added messages are stored as stubs (their rich metadata is fetched afterwards
+        like any other missing message), deleted messages are removed, and label
+        changes update the cached label set. Messages that leave the synced labels
+        are removed from the cache, messages that enter them are added. All changes
+        are applied in one transaction together with the new history cursor.
+        
+        Args:
+            service: The Gmail API service object.
+            fallback (str): What the caller does when history cannot be replayed, named in the messages printed.
+            
+        Returns:
+            bool: True if the cache was brought up to date, False if a full sync is
+                  needed (no stored history cursor, or the cursor has expired).
+        """
+        with self.db.write_transaction() as conn:
+            start_history_id = self.db.get_sync_state(conn, 'history_id')
+            if not start_history_id:
+                print(f"\nNo history cursor stored yet, running {fallback}.")
+                return False
+            
+            sync_labels = self.db.get_sync_labels(conn)
+            print(f"\nFetching mailbox changes since history ID {start_history_id}...")
+            page_token = None
+            latest_history_id = start_history_id
+            records_applied = 0
+            
+            while True:
+                try:
+                    response = self.scheduler.execute(service.users().history().list(
                         userId='me',
-                        labelIds=['INBOX'],
+                        startHistoryId=start_history_id,
+                        historyTypes=['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved'],
                         pageToken=page_token
-                    ).execute()
-                    
-                    messages = response.get('messages', [])
-                    if messages:
-                        self.all_messages_metadata.extend(messages)
-                        total_messages_fetched += len(messages)
-                        print(f"Fetched {len(messages)} message stubs... (Total: {total_messages_fetched})")
-                        
-                        # Insert or update message stubs in the database
-                        stub_data = [(msg['id'], msg['threadId']) for msg in messages]
-                        cursor.executemany(
-                            "INSERT OR REPLACE INTO message_stubs (message_id, thread_id) VALUES (?, ?)",
-                            stub_data
-                        )
-                        conn.commit()
-
-                    page_token = response.get('nextPageToken')
-                    if not page_token:
-                        break # No more pages
+                    ), 'history.list')
+                except gmail_service.HttpError as error:
+                    # Gmail only keeps history for a limited time; an expired cursor returns 404
+                    if error.resp.status == 404:
+                        print(f"History cursor has expired, falling back to {fallback}.")
+                        conn.rollback()
+                        return False
+                    raise
                 
-                if not self.all_messages_metadata:
-                    print("No messages found in INBOX.")
-                    return
+                for record in response.get('history', []):
+                    self._apply_history_record(conn, record, sync_labels)
+                    records_applied += 1
                 
-                print(f"\nSuccessfully fetched metadata for {total_messages_fetched} message stubs from INBOX.")
+                latest_history_id = response.get('historyId', latest_history_id)
+                page_token = response.get('nextPageToken')
+                if not page_token:
+                    break # No more pages
+            
+            # Commit the replayed changes together with the new cursor
+            self.db.set_sync_state(conn, 'history_id', latest_history_id)
+        print(f"Applied {records_applied} history records (now at history ID {latest_history_id}).")
+        return True
+
+    def _apply_history_record(self, conn, record, sync_labels):
+        """Applies a single users.history record to the cache.
+        
+        Args:
+            conn (sqlite3.Connection): Connection used for writing the cache.
+            record (dict): A history record with any of the messagesAdded, messagesDeleted,
+                           labelsAdded and labelsRemoved lists.
+            sync_labels (list): The labels the cache mirrors.
+        """
+        history_id = int(record['id']) if record.get('id') else None
+        
+        for change in record.get('messagesAdded', []):
+            message = change['message']
+            if in_sync_scope(message.get('labelIds', []), sync_labels):
+                self.db.upsert_stubs(conn, [message])
+        
+        deleted_ids = [change['message']['id'] for change in record.get('messagesDeleted', [])]
+        if deleted_ids:
+            self.db.delete_messages(conn, deleted_ids)
+        
+        # labelIds on the message is the complete label set after the change
+        for change in record.get('labelsAdded', []) + record.get('labelsRemoved', []):
+            message = change['message']
+            label_ids = message.get('labelIds', [])
+            if in_sync_scope(label_ids, sync_labels):
+                self.db.upsert_stubs(conn, [message])
+                self.db.update_message_labels(conn, message['id'], label_ids, history_id)
+            else:
+                self.db.delete_messages(conn, [message['id']])
+
+    def _iter_missing_stub_pages(self, conn, page_size=500):
+        """Yields pages of cached stubs that do not have rich metadata yet.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+            page_size (int): Number of stubs per page.
+            
+        Yields:
+            tuple: (stubs, None), stubs being a list of message stub dictionaries ('id', 'threadId').
+        """
+        print(f"Need to fetch rich metadata for {self.db.count_missing_rich_metadata(conn)} messages.")
+        for rows in self.db.iter_missing_rich_metadata(conn, page_size):
+            yield [{'id': message_id, 'threadId': thread_id} for message_id, thread_id in rows], None
+
+    def build_worker_service(self):
+        """Builds an additional Gmail API service object for use on another thread.
+        
+        The HTTP client behind a service object is not thread-safe, so every
+        pipeline worker gets its own service built from the same credentials.
+        
+        Returns:
+            googleapiclient.discovery.Resource: A new Gmail API service object.
+        """
+        if self.service_factory:
+            return self.service_factory()
+        if not self.get_gmail_service():
+            raise RuntimeError("Failed to get Gmail service.")
+        return gmail_service.build_gmail_service(self.creds)
+
+    def get_all_messages(self, incremental=False, workers=4, batch_size=50, resume=False, projection=DEFAULT_PROJECTION,
+                         mode=DEFAULT_SYNC_MODE, label_ids=None):
+        """Fetches metadata for all messages in the synced labels and stores them in the database.
+        
+        Listing, batch fetching and database writes run as overlapping pipeline stages
+        (see MetadataPipeline), so rich metadata fetching starts with the first page.
+        A full sync is checkpointed in the sync_checkpoints table after every committed
+        page and batch, so an interrupted sync can be continued with resume=True.
+        In thread mode a full sync lists and fetches whole threads instead (see
+        _sync_threads); it skips unchanged threads, so it needs no checkpoint.
+        
+        Each label is listed separately and has its own checkpoint. Synced labels are
+        added to the labels the cache mirrors (GmailCacheDB.get_sync_labels), which
+        decide what incremental syncs and the read commands treat as cached.
+        
+        Args:
+            incremental (bool): Replay the changes recorded in Gmail history since the
+                                last sync instead of re-listing the synced labels. Falls back
+                                to a full sync if there is no usable history cursor or a
+                                label has not been synced before.
+            workers (int): Number of concurrent batch-get workers.
+            batch_size (int): Number of messages per batch request. Also the largest batch the
+                              scheduler grows to (see QuotaScheduler.set_batch_size).
+            resume (bool): Continue an interrupted full sync from its last checkpoint.
+            projection (str): Name of the projection profile in config.PROJECTION_PROFILES
+                              ('lean' or 'full') deciding which headers are fetched and stored.
+            mode (str): Full-sync strategy from config.SYNC_MODES: 'message' or 'thread'.
+            label_ids (list, optional): Labels to sync, or [ALL_MAIL] for every message outside
+                                        spam and trash. Defaults to the labels synced before
+                                        (DEFAULT_SYNC_LABELS for a new cache).
+                                        
+        Returns:
+            bool: True if the sync ran to completion (single messages may still have failed).
+        """
+        self.projection = PROJECTION_PROFILES[projection]
+        self.scheduler.set_batch_size(batch_size)
+        try:
+            service = self.get_gmail_service()
+            if not service:
+                print("Failed to get Gmail service.")
+                return False
+
+            # Reads use their own connection; writes go through the shared writer
+            conn = self.db.get_read_connection()
+            
+            try:
+                def new_pipeline():
+                    return MetadataPipeline(
+                        self.db, self.build_worker_service, self._metadata_request, self._extract_rich_metadata, self.scheduler,
+                        workers=workers, batch_size=batch_size
+                    )
                 
-                # Now fetch rich metadata for messages that don't have it yet
-                print("\nFetching rich metadata for messages...")
+                sync_labels = self.db.get_sync_labels(conn)
+                label_ids = list(label_ids or sync_labels)
+                checkpoints = {label_id: self.db.get_checkpoint(conn, label_id) for label_id in label_ids}
+                interrupted = [label_id for label_id, checkpoint in checkpoints.items()
+                               if checkpoint and checkpoint['phase'] != 'done']
+                if resume and not interrupted:
+                    print("\nNo interrupted sync to resume, running a full sync.")
+                    resume = False
                 
-                # Query to find message IDs without rich metadata
-                cursor.execute("""
-                    SELECT s.message_id 
-                    FROM message_stubs s 
-                    LEFT JOIN message_rich_metadata r ON s.message_id = r.message_id 
-                    WHERE r.message_id IS NULL
-                """)
+                # History only covers labels that were synced before
+                new_labels = [label_id for label_id in label_ids if not in_sync_scope([label_id], sync_labels)]
+                history_replayed = None # Not tried yet
+                if incremental and not resume and new_labels:
+                    print(f"\n{', '.join(new_labels)} not synced before, running a full sync.")
+                elif not resume and incremental:
+                    history_replayed = self._sync_from_history(service)
+                if history_replayed:
+                    # Only the messages added since the last sync need rich metadata
+                    print("\nFetching rich metadata for messages...")
+                    pipeline = new_pipeline()
+                    pipeline.run(self._iter_missing_stub_pages(conn), store_stubs=False)
+                    print(f"\nCompleted fetching rich metadata for {pipeline.rich_saved} messages.")
+                    self._report_failed_ids(pipeline)
+                    self.db.refresh_statistics()
+                    return True
                 
-                missing_ids = [row[0] for row in cursor.fetchall()]
+                with self.db.write_transaction() as write_conn:
+                    if self.db.add_sync_labels(write_conn, label_ids):
+                        # Threads fetched under the old scope left out their members in the new labels
+                        self.db.clear_thread_history_ids(write_conn)
+                    sync_labels = self.db.get_sync_labels(write_conn)
                 
-                if not missing_ids:
-                    print("No new messages to fetch rich metadata for.")
-                    return
+                # A listing only adds messages, and the history cursor moves to the start of this
+                # sync, so first replay the changes since the last sync: they remove the messages
+                # that left the synced labels and update the labels that are not listed again
+                if not resume and history_replayed is None and self.db.get_sync_state(conn, 'history_id'):
+                    history_replayed = self._sync_from_history(service)
+                unlisted = [label_id for label_id in sync_labels if label_id not in label_ids and ALL_MAIL not in label_ids]
+                if unlisted and not resume and not history_replayed:
+                    print(f"Also syncing {', '.join(unlisted)}, whose changes can no longer be replayed.")
+                    label_ids += unlisted
                 
-                print(f"Need to fetch rich metadata for {len(missing_ids)} messages.")
+                if mode == 'thread':
+                    self._sync_threads(service, label_ids, sync_labels, workers, batch_size)
+                    return True
                 
-                # Process in batches of 50
-                BATCH_SIZE = 50
-                total_processed = 0
+                if resume:
+                    label_ids = interrupted
+                    for label_id in label_ids:
+                        checkpoint = checkpoints[label_id]
+                        print(f"\nResuming interrupted sync of {label_id} (phase: {checkpoint['phase']}, "
+                              f"{checkpoint['messages_listed']} stubs and {checkpoint['batches_committed']} batches already stored)...")
+                else:
+                    # Read the historyId before listing, so that changes made while the
+                    # listing is in progress are replayed by the next incremental sync
+                    profile = self.scheduler.execute(service.users().getProfile(userId='me'), 'getProfile')
+                    # Every label gets its checkpoint now, so an interruption leaves all unfinished ones resumable
+                    with self.db.write_transaction() as write_conn:
+                        for label_id in label_ids:
+                            self.db.start_checkpoint(write_conn, label_id, profile.get('historyId'))
                 
-                for i in range(0, len(missing_ids), BATCH_SIZE):
-                    batch_ids = missing_ids[i:i + BATCH_SIZE]
-                    total_processed += len(batch_ids)
-                    print(f"Processing batch {i//BATCH_SIZE + 1} ({len(batch_ids)} messages, {total_processed}/{len(missing_ids)} total)")
-                    
-                    # Data to insert for this batch
-                    rich_metadata_to_insert = []
-                    
-                    # Create a batch request
-                    batch = service.new_batch_http_request()
-                    
-                    # Define a callback function for each request in the batch
-                    def callback_factory(msg_id):
-                        def callback(request_id, response, exception):
-                            if exception:
-                                print(f"Error fetching message {msg_id}: {exception}")
-                                return
-                                
-                            # Extract metadata fields
-                            snippet = response.get('snippet', '')
-                            internal_date = response.get('internalDate')
-                            size_estimate = response.get('sizeEstimate')
-                            label_ids = json.dumps(response.get('labelIds', []))
-                            
-                            payload = response.get('payload', {})
-                            headers = payload.get('headers', [])
-                            
-                            # Extract From and Subject headers
-                            from_address = self._get_header(headers, 'From')
-                            subject = self._get_header(headers, 'Subject')
-                            
-                            # Store all headers as JSON
-                            payload_headers_json = json.dumps(headers)
-                            
-                            # Check for attachments
-                            has_attachments = 0
-                            attachment_filenames = []
-                            
-                            # Helper function to check for attachments recursively
-                            def check_for_attachments(part):
-                                if 'filename' in part and part['filename']:
-                                    return True, part['filename']
-                                
-                                if 'parts' in part:
-                                    for subpart in part['parts']:
-                                        has_att, filename = check_for_attachments(subpart)
-                                        if has_att:
-                                            return True, filename
-                                            
-                                return False, None
-                            
-                            # Check payload for attachments
-                            if 'parts' in payload:
-                                for part in payload['parts']:
-                                    has_att, filename = check_for_attachments(part)
-                                    if has_att and filename:
-                                        has_attachments = 1
-                                        attachment_filenames.append(filename)
-                            
-                            # Add this message's data to our list for batch insertion
-                            rich_metadata_to_insert.append((
-                                msg_id,
-                                snippet,
-                                internal_date,
-                                size_estimate,
-                                from_address,
-                                subject,
-                                label_ids,
-                                has_attachments,
-                                json.dumps(attachment_filenames) if attachment_filenames else None,
-                                payload_headers_json
-                            ))
-                            
-                        return callback
+                rich_saved = 0
+                for label_id in label_ids:
+                    checkpoint = self.db.get_checkpoint(conn, label_id)
+                    if checkpoint['phase'] != 'listing':
+                        continue
+                    print(f"\nFetching all message metadata from {label_id} ({workers} workers, batch size {batch_size})...")
+                    pipeline = new_pipeline()
+                    pipeline.run(
+                        self._iter_stub_pages(service, label_id, page_token=checkpoint['page_token']),
+                        checkpoint_label=label_id
+                    )
+                    rich_saved += pipeline.rich_saved
                     
-                    # Add each message to the batch request
-                    for msg_id in batch_ids:
-                        batch.add(
-                            service.users().messages().get(userId='me', id=msg_id, format='metadata'),
-                            callback=callback_factory(msg_id)
-                        )
-                    
-                    # Execute the batch request
-                    batch.execute()
-                    
-                    # Insert all the rich metadata we collected
-                    if rich_metadata_to_insert:
-                        cursor.executemany("""
-                            INSERT OR REPLACE INTO message_rich_metadata (
-                                message_id, snippet, internal_date, size_estimate, 
-                                from_address, subject, label_ids_json, 
-                                has_attachments, attachment_filenames_json, payload_headers_json
-                            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                        """, rich_metadata_to_insert)
-                        conn.commit()
-                        print(f"Saved rich metadata for {len(rich_metadata_to_insert)} messages.")
-                    
-                print(f"\nCompleted fetching rich metadata for {total_processed} messages.")
+                    with self.db.write_transaction() as write_conn:
+                        self.db.set_checkpoint_phase(write_conn, label_id, 'fetching')
+                    checkpoint = self.db.get_checkpoint(conn, label_id)
+                    if not checkpoint['messages_listed']:
+                        print(f"No messages found in {label_id}.")
+                    else:
+                        print(f"\nSuccessfully fetched metadata for {checkpoint['messages_listed']} message stubs from {label_id}.")
+                
+                # Sweep up stubs whose rich metadata is still missing: batches that were in
+                # flight when a previous run stopped, or that failed after all retries
+                pipeline = new_pipeline()
+                pipeline.run(self._iter_missing_stub_pages(conn), store_stubs=False,
+                             checkpoint_label=label_ids[0] if len(label_ids) == 1 else None)
+                rich_saved += pipeline.rich_saved
+                
+                # The earliest start covers the changes made while any of the labels was listed
+                history_id = min((self.db.get_checkpoint(conn, label_id)['history_id'] for label_id in label_ids), key=int)
+                with self.db.write_transaction() as write_conn:
+                    self.db.set_sync_state(write_conn, 'history_id', history_id)
+                    for label_id in label_ids:
+                        self.db.set_checkpoint_phase(write_conn, label_id, 'done')
+                
+                print(f"\nCompleted fetching rich metadata for {rich_saved} messages.")
+                self._report_failed_ids(pipeline)
+                # Keep the planner statistics in step with the cache size, for rules and reports
+                self.db.refresh_statistics()
+                return True
                 
             finally:
                 # Always close the connection
                 self.db.close_connection(conn)
             
-        except HttpError as error:
+        except gmail_service.HttpError as error:
             print(f'An API error occurred while fetching all messages: {error}')
         except Exception as e:
             print(f"An unexpected error occurred while fetching all messages: {e}")
+        return False
+
+    def refresh_labels(self, max_age=LABEL_CHECK_MAX_AGE_SECONDS, newer_than_days=None, limit=None, workers=4,
+                       batch_size=50, use_history=True):
+        """Brings the cached label sets (read/unread, archive, categories) up to date.
+        
+        A sync only fetches messages without rich metadata, so label changes made in
+        Gmail reach the cache through history replay or through this refresh. When a
+        history cursor is stored, the label events since the last sync are replayed
+        (2 quota units per page of changes). Otherwise, or with use_history=False,
+        the messages whose labels were not verified within max_age are re-checked
+        newest first with format='minimal' batch gets. These return only the labels
+        and historyId, and only the labels that changed and labels_checked_at are written.
+        
+        Args:
+            max_age (float): Skip messages verified or fetched less than this many seconds ago.
+            newer_than_days (float, optional): Only check messages newer than this many days.
+            limit (int, optional): Check at most this many messages, newest first.
+            workers (int): Number of concurrent batch-get workers.
+            batch_size (int): Number of messages per batch request.
+            use_history (bool): Replay Gmail history when a usable cursor is stored.
+            
+        Returns:
+            bool: True if the refresh ran to completion (single messages may still have failed).
+        """
+        self.scheduler.set_batch_size(batch_size)
+        try:
+            service = self.get_gmail_service()
+            if not service:
+                print("Failed to get Gmail service.")
+                return False
+            units_before = self.scheduler.units_spent
+            if use_history and self._sync_from_history(service, fallback="label checks"):
+                conn = self.db.get_read_connection()
+                try:
+                    missing = self.db.count_missing_rich_metadata(conn)
+                finally:
+                    self.db.close_connection(conn)
+                print(f"Cached labels are current ({self.scheduler.units_spent - units_before} quota units).")
+                if missing:
+                    print(f"{missing} new messages will be fetched by the next sync.")
+                return True
+            
+            conn = self.db.get_read_connection()
+            try:
+                sync_labels = self.db.get_sync_labels(conn)
+                newer_than_ms = int((time.time() - newer_than_days * 86400) * 1000) if newer_than_days is not None else None
+                message_ids = self.db.list_label_check_candidates(conn, max_age, newer_than_ms, limit)
+            finally:
+                self.db.close_connection(conn)
+            if not message_ids:
+                print(f"All cached labels were verified within the last {max_age:.0f} seconds.")
+                return True
+            
+            print(f"\nChecking the labels of {len(message_ids)} messages, newest first ({workers} workers, batch size {batch_size})...")
+            pipeline = LabelRefreshPipeline(
+                self.db, self.build_worker_service,
+                lambda service, msg_id: service.users().messages().get(userId='me', id=msg_id, format='minimal',
+                                                                         fields=LABEL_CHECK_FIELDS),
+                self.scheduler, sync_labels=sync_labels, workers=workers, batch_size=batch_size
+            )
+            page_size = 500
+            pages = (([{'id': message_id} for message_id in message_ids[i:i + page_size]], None)
+                     for i in range(0, len(message_ids), page_size))
+            pipeline.run(pages, store_stubs=False)
+            print(f"Checked {pipeline.messages_checked} messages: {pipeline.labels_changed} with changed labels, "
+                  f"{pipeline.messages_removed} removed (deleted or no longer in the synced labels); "
+                  f"{self.scheduler.units_spent - units_before} quota units.")
+            if pipeline.failed_ids:
+                print(f"Could not check {len(pipeline.failed_ids)} messages after retrying; run refresh-labels again to retry them.")
+            return True
+        except gmail_service.HttpError as error:
+            print(f'An API error occurred while refreshing labels: {error}')
+        except Exception as e:
+            print(f"An unexpected error occurred while refreshing labels: {e}")
+        return False
+
+    def apply_action(self, action, where, params, label_id=None, limit=None, workers=4, assume_yes=False):
+        """Applies a Phase Two action to the cached messages matching a selection.
+        
+        Matching messages are selected from the cache, the user is asked to confirm,
+        and the action is sent in batchModify/batchDelete chunks of up to 1000 IDs.
+        The cache is updated as each chunk succeeds.
+        
+        Args:
+            action (str): One of actions.ACTIONS.
+            where (str): WHERE clause over message_rich_metadata r (see actions.build_selection).
+            params (list): Parameters of the WHERE clause.
+            label_id (str, optional): The label for the 'label' and 'unlabel' actions.
+            limit (int, optional): Act on at most this many messages, oldest first.
+            workers (int): Number of chunks sent concurrently.
+            assume_yes (bool): Skip the confirmation prompt.
+        """
+        engine = ActionEngine(self.db, self.build_worker_service, self.scheduler, workers=workers)
+        conn = self.db.get_read_connection()
+        try:
+            message_count, total_bytes = engine.preview(conn, where, params, limit)
+            message_ids = engine.select_ids(conn, where, params, limit)
+        finally:
+            self.db.close_connection(conn)
+        
+        if not message_ids:
+            print("No cached messages match the selection.")
+            return
+        print(f"\n'{action}' will affect {message_count} messages ({format_size(total_bytes)}).")
+        if action == 'delete':
+            print("Deleted messages are removed permanently and cannot be recovered.")
+        if not assume_yes and input("Continue? [y/N] ").strip().lower() not in ('y', 'yes'):
+            print("Cancelled.")
+            return
+        
+        try:
+            if not self.get_gmail_service():
+                print("Failed to get Gmail service.")
+                return
+            result = engine.apply(action, message_ids, label_id)
+        except gmail_service.HttpError as error:
+            print(f'An API error occurred while applying {action}: {error}')
+            return
+        
+        print(f"\nApplied '{action}' to {result['applied']} messages with {result['api_calls']} API calls.")
+        if result['failed']:
+            print(f"Could not apply '{action}' to {len(result['failed'])} messages; they are unchanged in the cache.")
+
+    def apply_rules(self, engine, workers=4, assume_yes=False):
+        """Applies the actions of a rule file to the cached messages each rule matches.
+        
+        Every message is acted on by the first rule that matches it. Each rule's
+        messages are sent as bulk actions (see apply_action), and the cache is
+        updated as each chunk succeeds.
+        
+        Args:
+            engine (RuleEngine): The compiled rules.
+            workers (int): Number of chunks sent concurrently.
+            assume_yes (bool): Skip the confirmation prompt.
+        """
+        conn = self.db.get_read_connection()
+        try:
+            matches = [(rule, message_ids) for rule, message_ids in engine.matches(conn) if message_ids]
+        finally:
+            self.db.close_connection(conn)
+        
+        if not matches:
+            print("No cached messages match any rule.")
+            return
+        print("\nThe rules will apply these actions:")
+        for rule, message_ids in matches:
+            target = f" {rule.label_id}" if rule.label_id else ""
+            print(f"{len(message_ids):>8}  {rule.name} -> {rule.action}{target}")
+        if any(rule.action == 'delete' for rule, _ in matches):
+            print("Deleted messages are removed permanently and cannot be recovered.")
+        if not assume_yes and input("Continue? [y/N] ").strip().lower() not in ('y', 'yes'):
+            print("Cancelled.")
+            return
+        
+        action_engine = ActionEngine(self.db, self.build_worker_service, self.scheduler, workers=workers)
+        try:
+            if not self.get_gmail_service():
+                print("Failed to get Gmail service.")
+                return
+            for rule, message_ids in matches:
+                print(f"\nApplying rule '{rule.name}' ({rule.action}, {len(message_ids)} messages)...")
+                result = action_engine.apply(rule.action, message_ids, rule.label_id)
+                if result['failed']:
+                    print(f"Could not apply '{rule.action}' to {len(result['failed'])} messages; they are unchanged in the cache.")
+        except gmail_service.HttpError as error:
+            print(f'An API error occurred while applying rules: {error}')
+
+    def fetch_bodies(self, limit=None, budget_mb=BODY_STORE_BUDGET_MB):
+        """Downloads the raw bodies of cached messages into the body store.
+        
+        Messages are fetched newest first with format='raw' batch requests, skipping
+        those already stored. Fetching stops once the store starts evicting to stay
+        within its budget, since older bodies would only replace newer ones.
+        
+        Args:
+            limit (int, optional): Consider at most this many of the newest cached messages.
+            budget_mb (float): Size budget of the body store in MB.
+        """
+        from src.body_store import BodyStore
+        body_store = BodyStore.for_cache(self.db, budget_bytes=int(budget_mb * 1024 * 1024))
+        conn = self.db.get_read_connection()
+        try:
+            # LIMIT -1 lists every cached message
+            stubs = self.db.list_cached_messages(conn, [], limit if limit else -1)
+        finally:
+            self.db.close_connection(conn)
+        message_ids = body_store.missing([stub['id'] for stub in stubs])
+        if not message_ids:
+            print(f"All {len(stubs)} messages already have their bodies stored.")
+            return
+        
+        try:
+            service = self.get_gmail_service()
+            if not service:
+                print("Failed to get Gmail service.")
+                return
+            print(f"\nFetching {len(message_ids)} message bodies (budget {format_size(body_store.budget_bytes)})...")
+            totals = {'messages': 0, 'raw_bytes': 0, 'stored_bytes': 0, 'new_parts': 0, 'parts': 0, 'evicted': 0}
+            
+            def store_body(message_id, response):
+                result = body_store.put_raw(message_id, response['raw'], response.get('threadId'))
+                totals['messages'] += 1
+                for key in ('raw_bytes', 'stored_bytes', 'new_parts', 'parts', 'evicted'):
+                    totals[key] += result[key]
+            
+            failed = {}
+            chunk_size = self.scheduler.batch_size
+            for start in range(0, len(message_ids), chunk_size):
+                if totals['evicted']:
+                    print("The body store is full; older bodies are not fetched.")
+                    break
+                failed.update(self.scheduler.execute_batch(
+                    service,
+                    message_ids[start:start + chunk_size],
+                    lambda service, msg_id: service.users().messages().get(userId='me', id=msg_id, format='raw'),
+                    'messages.get',
+                    store_body
+                ))
+                print(f"Stored {totals['messages']} bodies ({format_size(totals['raw_bytes'])} downloaded)...")
+        except gmail_service.HttpError as error:
+            print(f'An API error occurred while fetching message bodies: {error}')
+            return
+        
+        print(f"\nStored {totals['messages']} bodies: {format_size(totals['raw_bytes'])} of messages took "
+              f"{format_size(totals['stored_bytes'])} ({totals['parts'] - totals['new_parts']} of {totals['parts']} "
+              f"MIME parts were already stored).")
+        # A 404 means the message was deleted in Gmail; the next incremental sync removes it from the cache
+        deleted = [msg_id for msg_id, error in failed.items()
+                   if isinstance(error, gmail_service.HttpError) and error.resp.status == 404]
+        if deleted:
+            print(f"Skipped {len(deleted)} messages deleted in Gmail since the last sync; "
+                  f"run get-all-inbox-metadata --incremental to remove them from the cache.")
+        retryable = [msg_id for msg_id, error in failed.items() if is_retryable_error(error)]
+        if retryable:
+            print(f"Could not fetch {len(retryable)} bodies after retrying; run fetch-bodies again to retry them.")
+        other = len(failed) - len(deleted) - len(retryable)
+        if other:
+            print(f"Could not fetch {other} bodies because Gmail rejected the request; retrying will not help.")
+        stats = body_store.stats()
+        print(f"Body store: {stats['messages']} messages, {format_size(stats['raw_bytes'])} as sent, "
+              f"{format_size(stats['stored_bytes'])} stored in {stats['blobs']} unique parts.")
+
+    def _report_failed_ids(self, pipeline):
+        """Prints a summary of the messages a pipeline could not fetch."""
+        if pipeline.failed_ids:
+            print(f"Could not fetch rich metadata for {len(pipeline.failed_ids)} messages after retrying; "
+                  f"they will be picked up by the next sync.")
 
 
 def main():
@@ -412,30 +1255,280 @@ def main():
     Main function to parse command-line arguments and interact with the Gmail API.
     """
     parser = argparse.ArgumentParser(description="A command-line tool to interact with your Gmail account.")
+    parser.add_argument("--account", help="Use this account's token and cache from the accounts file instead of the default ones.")
+    parser.add_argument("--metrics-json", metavar="PATH", help="Write the command's metrics (stage timers, API calls, quota units, retries, bytes received, DB rows/sec, queue depths) to a JSON file and print a summary.")
+    parser.add_argument("--profile", metavar="PATH", help="Profile the command: cProfile statistics to PATH and sampled stacks of all threads to PATH.folded (flame graph input).")
+    parser.add_argument("--accounts-file", default=ACCOUNTS_FILENAME, help=f"The accounts file used by --account and sync-accounts. Default: {ACCOUNTS_FILENAME}")
     subparsers = parser.add_subparsers(dest="command", help="Available commands", required=True)
 
+    # Options shared by the read commands, which answer from the local cache when it is fresh
+    cache_options = argparse.ArgumentParser(add_help=False)
+    cache_options.add_argument("--max-age", type=float, default=CACHE_TTL_SECONDS, help=f"Serve cached data up to this many seconds old without contacting Gmail (0 always validates or refetches). Default: {CACHE_TTL_SECONDS}")
+    cache_options.add_argument("--offline", action="store_true", help="Only answer from the local cache; no credentials or network needed.")
+
     # Subparser for listing labels
-    parser_list_labels = subparsers.add_parser("list-labels", help="List all Gmail labels.")
+    parser_list_labels = subparsers.add_parser("list-labels", parents=[cache_options], help="List all Gmail labels.")
 
     # Subparser for listing messages
-    parser_list_messages = subparsers.add_parser("list-messages", help="List messages.")
+    parser_list_messages = subparsers.add_parser("list-messages", parents=[cache_options], help="List messages.")
     parser_list_messages.add_argument("--label-ids", nargs='*', default=['INBOX'], help="Space-separated list of label IDs to filter by (e.g., INBOX, SENT, SPAM). Default: INBOX")
     parser_list_messages.add_argument("--max-results", type=int, default=10, help="Maximum number of messages to return. Default: 10")
     parser_list_messages.add_argument("--query", "-q", type=str, help="Gmail search query (e.g., 'from:user@example.com is:unread').")
 
     # Subparser for getting a specific message
-    parser_get_message = subparsers.add_parser("get-message", help="Get a specific message by ID.")
+    parser_get_message = subparsers.add_parser("get-message", parents=[cache_options], help="Get a specific message by ID.")
     parser_get_message.add_argument("message_id", help="The ID of the message to retrieve.")
     parser_get_message.add_argument("--format", choices=['full', 'metadata', 'raw', 'minimal'], default='metadata', help="Format of the message to retrieve. Default: metadata")
 
-    # Subparser for getting all messages metadata from INBOX
-    parser_get_all_messages = subparsers.add_parser("get-all-inbox-metadata", help="Fetch metadata for all messages in the INBOX.")
-    # No specific arguments for this command yet, but can be added (e.g., batch_size)
+    # Subparser for downloading raw message bodies into the local body store
+    parser_fetch_bodies = subparsers.add_parser("fetch-bodies", help="Download the raw bodies of cached messages into the deduplicating body store, newest first.")
+    parser_fetch_bodies.add_argument("--limit", type=int, help="Only consider this many of the newest cached messages.")
+    parser_fetch_bodies.add_argument("--budget-mb", type=float, default=BODY_STORE_BUDGET_MB, help=f"Size budget of the body store in MB; least recently used bodies are evicted beyond it. Default: {BODY_STORE_BUDGET_MB}")
+
+    # Options shared by the sync commands
+    sync_options = argparse.ArgumentParser(add_help=False)
+    sync_options.add_argument("--incremental", action="store_true", help="Only apply changes since the last sync using Gmail history. Falls back to a full sync when the history cursor has expired or a label was not synced before.")
+    sync_options.add_argument("--resume", action="store_true", help="Continue an interrupted full sync from its last checkpoint instead of starting over (message mode).")
+    sync_options.add_argument("--mode", choices=SYNC_MODES, default=DEFAULT_SYNC_MODE, help=f"Full-sync strategy: 'message' fetches messages one by one, 'thread' fetches whole conversations in one call each and skips unchanged ones (fewer calls on heavily threaded mailboxes). Default: {DEFAULT_SYNC_MODE}")
+    sync_options.add_argument("--projection", choices=sorted(PROJECTION_PROFILES), default=DEFAULT_PROJECTION, help=f"Which headers to fetch and store: 'lean' keeps a few useful headers, 'full' keeps every header. Default: {DEFAULT_PROJECTION}")
+    sync_options.add_argument("--workers", type=int, default=4, help="Number of concurrent batch-get workers. Default: 4")
+    sync_options.add_argument("--batch-size", type=int, default=50, help="Number of messages (threads in thread mode) per batch request (1-100). Default: 50")
+    sync_scope = sync_options.add_mutually_exclusive_group()
+    sync_scope.add_argument("--labels", nargs='+', help=f"Label IDs to sync (e.g. INBOX SENT). Default: the labels synced before, {' '.join(DEFAULT_SYNC_LABELS)} for a new cache")
+    sync_scope.add_argument("--all-mail", action="store_true", help="Sync every message outside spam and trash.")
+
+    # Subparser for getting all messages metadata from the synced labels (INBOX by default)
+    subparsers.add_parser("get-all-inbox-metadata", parents=[sync_options], help="Fetch metadata for all messages in the synced labels (INBOX by default) or all mail.")
+
+    # Subparser for re-validating the labels of cached messages
+    parser_refresh_labels = subparsers.add_parser("refresh-labels", help="Bring cached labels (read/unread, archive, categories) up to date from history or with cheap format=minimal gets.")
+    parser_refresh_labels.add_argument("--max-age", type=float, default=LABEL_CHECK_MAX_AGE_SECONDS, help=f"Skip messages whose labels were verified less than this many seconds ago. Default: {LABEL_CHECK_MAX_AGE_SECONDS}")
+    parser_refresh_labels.add_argument("--newer-than-days", type=float, help="Only check messages newer than this many days.")
+    parser_refresh_labels.add_argument("--limit", type=int, help="Check at most this many messages, newest first.")
+    parser_refresh_labels.add_argument("--no-history", action="store_true", help="Check every message with format=minimal gets even when history could be replayed.")
+    parser_refresh_labels.add_argument("--workers", type=int, default=4, help="Number of concurrent batch-get workers. Default: 4")
+    parser_refresh_labels.add_argument("--batch-size", type=int, default=50, help="Number of messages per batch request (1-100). Default: 50")
+
+    # Subparser for syncing every account of the accounts file in parallel processes
+    parser_sync_accounts = subparsers.add_parser("sync-accounts", parents=[sync_options], help="Fetch metadata for several accounts from the accounts file in parallel processes.")
+    parser_sync_accounts.add_argument("--only", nargs='+', help="Only sync these accounts. Default: every account in the file")
+    parser_sync_accounts.add_argument("--processes", type=int, help="Number of worker processes. Default: one per CPU core")
+
+    # Subparser for the Phase One insights report (reads the local cache only)
+    parser_report = subparsers.add_parser("report", help="Show insights (top senders, largest emails, age distribution, unread count) from the local cache.")
+    parser_report.add_argument("--top", type=int, default=10, help="Number of rows in the top-N sections. Default: 10")
+    parser_report.add_argument("--large-mb", type=float, default=DEFAULT_LARGE_EMAIL_MB, help=f"Size in MB from which an email counts as large. Default: {DEFAULT_LARGE_EMAIL_MB}")
+
+    # Subparser for exporting a columnar analytics snapshot (reads the local cache only)
+    parser_export_snapshot = subparsers.add_parser("export-snapshot", help="Export the cached metadata as memory-mapped NumPy arrays for fast analytics.")
+    parser_export_snapshot.add_argument("--output", help="Directory to write the snapshot to. Default: 'snapshot' next to the cache database")
+
+    # Subparser for Phase Two actions on messages selected from the local cache
+    parser_action = subparsers.add_parser("action", help="Trash, delete, archive, label or mark messages selected from the local cache, using bulk API calls.")
+    parser_action.add_argument("action", choices=list(ACTIONS), help="The action to apply. 'delete' is permanent and needs full mailbox access.")
+    parser_action.add_argument("--label-id", help="Label ID to add or remove (required for 'label' and 'unlabel').")
+    parser_action.add_argument("--sender", help="Only messages from this email address.")
+    parser_action.add_argument("--domain", help="Only messages from this sender domain.")
+    parser_action.add_argument("--subject-contains", help="Only messages whose subject contains this text.")
+    parser_action.add_argument("--has-label", help="Only messages with this label ID.")
+    parser_action.add_argument("--older-than-days", type=float, help="Only messages older than this many days.")
+    parser_action.add_argument("--larger-than-mb", type=float, help="Only messages at least this large, in MB.")
+    read_state = parser_action.add_mutually_exclusive_group()
+    read_state.add_argument("--unread", dest="unread", action="store_const", const=True, help="Only unread messages.")
+    read_state.add_argument("--read", dest="unread", action="store_const", const=False, help="Only read messages.")
+    parser_action.add_argument("--has-attachments", action="store_const", const=True, help="Only messages with attachments.")
+    parser_action.add_argument("--limit", type=int, help="Act on at most this many messages, oldest first.")
+    parser_action.add_argument("--workers", type=int, default=4, help="Number of concurrent API calls. Default: 4")
+    parser_action.add_argument("--dry-run", action="store_true", help="Only show how many messages and bytes the action would affect.")
+    parser_action.add_argument("--yes", "-y", action="store_true", help="Do not ask for confirmation.")
+
+    # Subparser for evaluating (and applying) a rule file against the local cache
+    parser_rules = subparsers.add_parser("rules", help="Evaluate a JSON rule file against the local cache and optionally apply its actions.")
+    parser_rules.add_argument("rules_file", help="Path to the JSON rule file.")
+    parser_rules.add_argument("--explain", action="store_true", help="Show each rule's SQL, parameters and query plan.")
+    parser_rules.add_argument("--apply", action="store_true", help="Apply the rules' actions in Gmail (otherwise only match counts are shown).")
+    parser_rules.add_argument("--workers", type=int, default=4, help="Number of concurrent API calls when applying. Default: 4")
+    parser_rules.add_argument("--yes", "-y", action="store_true", help="Do not ask for confirmation.")
+
+    # Subparser for full-text search of the local cache
+    parser_search = subparsers.add_parser("search", help="Search subjects, snippets and senders in the local cache (no API calls).")
+    parser_search.add_argument("query", nargs='+', help="Keywords, prefixes (invoice*), phrases (\"order shipped\") and from:/subject: filters.")
+    parser_search.add_argument("--sender", help="Only messages from this email address.")
+    parser_search.add_argument("--domain", help="Only messages from this sender domain.")
+    parser_search.add_argument("--has-label", help="Only messages with this label ID.")
+    parser_search.add_argument("--newer-than-days", type=float, help="Only messages newer than this many days.")
+    parser_search.add_argument("--older-than-days", type=float, help="Only messages older than this many days.")
+    parser_search.add_argument("--larger-than-mb", type=float, help="Only messages at least this large, in MB.")
+    parser_search.add_argument("--smaller-than-mb", type=float, help="Only messages smaller than this, in MB.")
+    search_read_state = parser_search.add_mutually_exclusive_group()
+    search_read_state.add_argument("--unread", dest="unread", action="store_const", const=True, help="Only unread messages.")
+    search_read_state.add_argument("--read", dest="unread", action="store_const", const=False, help="Only read messages.")
+    parser_search.add_argument("--has-attachments", action="store_const", const=True, help="Only messages with attachments.")
+    parser_search.add_argument("--order", choices=list(ORDERINGS), default='date', help="Newest first ('date') or best match first ('relevance'). Default: date")
+    parser_search.add_argument("--limit", type=int, default=20, help="Maximum number of results. Default: 20")
+
+    # Subparser for near-duplicate clustering of the cached messages (reads and writes the local cache only)
+    parser_cluster = subparsers.add_parser("cluster", help="Group cached messages into template and near-duplicate clusters (no API calls).")
+    parser_cluster.add_argument("--rebuild", action="store_true", help="Drop all clusters and their categories and cluster every message again.")
+    parser_cluster.add_argument("--top", type=int, default=10, help="Number of largest clusters to show. Default: 10")
+
+    # Subparser for classifying one representative message per cluster
+    parser_classify = subparsers.add_parser("classify", help="Cluster new messages, then classify one representative per cluster and apply its category to all members.")
+    parser_classify.add_argument("--classifier", default='keyword', help="Classifier to use: 'keyword' (local stand-in) or 'module:factory' for a plug-in. Default: keyword")
+    parser_classify.add_argument("--batch-size", type=int, default=CLASSIFY_BATCH_SIZE, help=f"Cluster representatives per classifier call. Default: {CLASSIFY_BATCH_SIZE}")
+    parser_classify.add_argument("--workers", type=int, default=CLASSIFY_WORKERS, help=f"Number of concurrent classifier calls. Default: {CLASSIFY_WORKERS}")
+    parser_classify.add_argument("--limit", type=int, help="Classify at most this many clusters, largest first.")
+    parser_classify.add_argument("--reclassify", action="store_true", help="Also classify clusters that already have a category.")
 
     args = parser.parse_args()
+    where, params, sync_kwargs = None, None, None
+    sync_commands = ("get-all-inbox-metadata", "sync-accounts")
+    if args.command in sync_commands + ("refresh-labels",) and not 1 <= args.batch_size <= 100:
+        parser.error("--batch-size must be between 1 and 100 (Gmail batch request limit).")
+    if args.command == "sync-accounts" and args.account:
+        parser.error("sync-accounts selects its accounts with --only; --account applies to single-account commands.")
+    if args.command in sync_commands and args.resume and args.mode == 'thread':
+        parser.error("--resume only applies to message mode; re-running a thread-mode sync skips the threads it already fetched.")
+    if args.command in sync_commands:
+        sync_kwargs = dict(
+            incremental=args.incremental, workers=args.workers, batch_size=args.batch_size, resume=args.resume,
+            projection=args.projection, mode=args.mode, label_ids=[ALL_MAIL] if args.all_mail else args.labels
+        )
+    if args.command == "action":
+        if args.action in ('label', 'unlabel') and not args.label_id:
+            parser.error(f"--label-id is required for the '{args.action}' action.")
+        where, params = build_selection(
+            sender=args.sender, domain=args.domain, subject_contains=args.subject_contains, label=args.has_label,
+            older_than_days=args.older_than_days, larger_than_mb=args.larger_than_mb, unread=args.unread,
+            has_attachments=args.has_attachments
+        )
+        if not params and args.unread is None:
+            parser.error("Select messages with at least one filter (e.g. --domain or --older-than-days).")
+
+    # Record only the command's own work, not the imports before it
+    metrics.reset()
+    with metrics.profile_to(args.profile) if args.profile else contextlib.nullcontext():
+        run_command(parser, args, where, params, sync_kwargs)
+    if args.metrics_json:
+        metrics.print_summary()
+        metrics.write_json(args.metrics_json)
+        print(f"Metrics written to {args.metrics_json}")
+
 
-    print("Attempting to connect to Gmail API...")
-    msg_accessor = MessageAccesor()
+def run_command(parser, args, where=None, params=None, sync_kwargs=None):
+    """
+    Runs a parsed and validated command.
+    
+    Args:
+        parser (argparse.ArgumentParser): The command-line parser, for printing help.
+        args (argparse.Namespace): The parsed arguments.
+        where (str, optional): WHERE clause of the 'action' command's selection.
+        params (list, optional): Parameters of the WHERE clause.
+        sync_kwargs (dict, optional): get_all_messages arguments of the sync commands.
+    """
+    if args.command == "sync-accounts":
+        try:
+            profiles = select_accounts(load_accounts(args.accounts_file), args.only)
+        except (OSError, ValueError) as e:
+            print(f"Could not load accounts: {e}")
+            return
+        profiles = authorize_accounts(profiles)
+        if profiles:
+            sync_accounts(profiles, sync_kwargs, processes=args.processes)
+        return
+
+    # The default token and cache, or those of the account picked with --account
+    db_path, token_path, profile = None, None, None
+    if args.account:
+        try:
+            profile = select_accounts(load_accounts(args.accounts_file), [args.account])[0]
+        except (OSError, ValueError) as e:
+            print(f"Could not load accounts: {e}")
+            return
+        db_path, token_path = profile.db_path, profile.token_path
+
+    # Commands that only read the local cache don't need Gmail credentials
+    if args.command == "report":
+        InsightsReport(GmailCacheDB(db_path)).print_report(top_n=args.top, large_mb=args.large_mb)
+        return
+    if args.command == "search":
+        where, params = build_selection(
+            sender=args.sender, domain=args.domain, label=args.has_label, older_than_days=args.older_than_days,
+            newer_than_days=args.newer_than_days, larger_than_mb=args.larger_than_mb,
+            smaller_than_mb=args.smaller_than_mb, unread=args.unread, has_attachments=args.has_attachments
+        )
+        CacheSearch(GmailCacheDB(db_path)).print_results(' '.join(args.query), where, params, order=args.order, limit=args.limit)
+        return
+    if args.command in ("cluster", "classify"):
+        # Imported here to keep hashlib, html and the thread pool out of the startup of every other command
+        from src.clustering import Clusterer
+        from src.classification import ClassificationPipeline, load_classifier
+    if args.command == "cluster":
+        clusterer = Clusterer(GmailCacheDB(db_path))
+        if args.rebuild:
+            clusterer.rebuild()
+        clusterer.print_summary(clusterer.run(), top=args.top)
+        return
+    if args.command == "classify":
+        try:
+            classifier = load_classifier(args.classifier)
+        except ValueError as e:
+            print(f"Could not load classifier: {e}")
+            return
+        db = GmailCacheDB(db_path)
+        # New messages join their clusters first, so they get a category too
+        clusterer = Clusterer(db)
+        clusterer.print_summary(clusterer.run(), top=0)
+        pipeline = ClassificationPipeline(db, classifier, batch_size=args.batch_size, workers=args.workers)
+        pipeline.print_summary(pipeline.run(limit=args.limit, reclassify=args.reclassify))
+        return
+    if args.command == "export-snapshot":
+        # Imported here because numpy is an optional dependency
+        from src.snapshot import export_snapshot, DEFAULT_SNAPSHOT_DIR
+        output_dir = args.output or (os.path.join(os.path.dirname(db_path), 'snapshot') if db_path else DEFAULT_SNAPSHOT_DIR)
+        exported = export_snapshot(GmailCacheDB(db_path), output_dir)
+        print(f"Exported {exported} messages to {output_dir}")
+        return
+
+    if args.command == "action" and args.dry_run:
+        db = GmailCacheDB(db_path)
+        conn = db.get_read_connection()
+        try:
+            message_count, total_bytes = ActionEngine(db, None, None).preview(conn, where, params, args.limit)
+        finally:
+            db.close_connection(conn)
+        print(f"Dry run: '{args.action}' would affect {message_count} messages ({format_size(total_bytes)}), "
+              f"using {-(-message_count // BATCH_ACTION_CHUNK_SIZE)} API calls.")
+        return
+
+    if args.command == "rules":
+        try:
+            rule_engine = RuleEngine(load_rules(args.rules_file))
+        except (OSError, ValueError) as e:
+            print(f"Could not load rules: {e}")
+            return
+        rule_engine.print_evaluation(GmailCacheDB(db_path), explain=args.explain)
+        if not args.apply:
+            return
+
+    # The read commands answer from the cache when they can and connect only when needed
+    read_commands = ("list-labels", "list-messages", "get-message")
+    if args.command not in read_commands:
+        print("Attempting to connect to Gmail API...")
+    account = dict(db=GmailCacheDB(db_path), token_path=token_path)
+    if args.command in read_commands:
+        msg_accessor = MessageAccesor(offline=args.offline, **account)
+        msg_accessor.cache_ttl = args.max_age
+    elif args.command == "rules":
+        needs_full_access = any(rule.action in FULL_ACCESS_ACTIONS for rule in rule_engine.rules)
+        msg_accessor = MessageAccesor(scopes=FULL_ACCESS_SCOPES if needs_full_access else MODIFY_SCOPES, **account)
+    elif args.command == "action":
+        msg_accessor = MessageAccesor(scopes=FULL_ACCESS_SCOPES if args.action in FULL_ACCESS_ACTIONS else MODIFY_SCOPES, **account)
+    else:
+        msg_accessor = MessageAccesor(**account)
+    if profile:
+        # Stay within the account's own quota budget, as sync-accounts does
+        msg_accessor.scheduler = QuotaScheduler(units_per_second=profile.quota_units_per_second)
 
     if args.command == "list-labels":
         msg_accessor.list_labels()
@@ -443,8 +1536,17 @@ def main():
         msg_accessor.list_messages_cmd(args.label_ids, args.max_results, args.query)
     elif args.command == "get-message":
         msg_accessor.get_message_detail(args.message_id, args.format)
+    elif args.command == "fetch-bodies":
+        msg_accessor.fetch_bodies(limit=args.limit, budget_mb=args.budget_mb)
     elif args.command == "get-all-inbox-metadata":
-        msg_accessor.get_all_messages()
+        msg_accessor.get_all_messages(**sync_kwargs)
+    elif args.command == "refresh-labels":
+        msg_accessor.refresh_labels(max_age=args.max_age, newer_than_days=args.newer_than_days, limit=args.limit,
+                                    workers=args.workers, batch_size=args.batch_size, use_history=not args.no_history)
+    elif args.command == "rules":
+        msg_accessor.apply_rules(rule_engine, workers=args.workers, assume_yes=args.yes)
+    elif args.command == "action":
+        msg_accessor.apply_action(args.action, where, params, label_id=args.label_id, limit=args.limit, workers=args.workers, assume_yes=args.yes)
     else:
         parser.print_help()
 
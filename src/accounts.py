@@ -0,0 +1,306 @@
+"""
+Account profiles and parallel sync of several Gmail accounts.
+
+An accounts file lists the mailboxes to manage, each with its own OAuth token and
+cache database:
+
+    {"accounts": [
+        {"name": "alice"},
+        {"name": "shared", "token_path": "~/gmail/shared.pickle", "db_path": "~/gmail/shared.db",
+         "quota_units_per_second": 100}
+    ]}
+
+sync_accounts() syncs the accounts in worker processes, one account per process at
+a time, so the SQLite writes, JSON parsing and header extraction of different
+accounts run on different cores. Gmail's quota is per user, so every account gets
+its own QuotaScheduler with the profile's budget; lower the budgets when the sum
+would exceed the project-wide quota of the OAuth client. Each process forwards
+its output to the parent, which prints it prefixed with the account name and
+ends with a combined report.
+"""
+import contextlib
+import io
+import json
+import os
+import threading
+import time
+from concurrent.futures import as_completed
+
+from src import metrics
+from src.config import PROFILES_DIR, QUOTA_UNITS_PER_SECOND
+from src.gmail_db import GmailCacheDB
+from src.insights import InsightsReport, format_size
+from src.quota_scheduler import QuotaScheduler
+
+# Keys an entry of the accounts file may have
+PROFILE_KEYS = {'name', 'token_path', 'db_path', 'quota_units_per_second'}
+
+
+class AccountProfile:
+    """A Gmail account: its name, where its token and cache live, and its quota budget."""
+
+    def __init__(self, name, token_path=None, db_path=None, quota_units_per_second=QUOTA_UNITS_PER_SECOND):
+        """
+        Initialize the profile.
+
+        Args:
+            name (str): Unique account name, used in progress output and with --account.
+            token_path (str, optional): The account's OAuth token. Default: PROFILES_DIR/<name>/token.pickle
+            db_path (str, optional): The account's cache database. Default: PROFILES_DIR/<name>/gmail_cache.db
+            quota_units_per_second (float): Quota budget of the account's syncs.
+        """
+        self.name = name
+        self.token_path = os.path.expanduser(token_path or os.path.join(PROFILES_DIR, name, 'token.pickle'))
+        self.db_path = os.path.expanduser(db_path or os.path.join(PROFILES_DIR, name, 'gmail_cache.db'))
+        self.quota_units_per_second = quota_units_per_second
+
+
+def load_accounts(path):
+    """
+    Load the account profiles of an accounts file.
+
+    Args:
+        path (str): Path to the accounts file (see the module docstring for the format).
+
+    Returns:
+        list: AccountProfile objects, in file order.
+
+    Raises:
+        ValueError: If the file or one of its entries is invalid.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        try:
+            document = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"{path} is not valid JSON: {e}") from None
+    entries = document.get('accounts') if isinstance(document, dict) else None
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"{path} needs a non-empty 'accounts' list")
+
+    profiles, names = [], set()
+    for position, entry in enumerate(entries, start=1):
+        if not isinstance(entry, dict) or not entry.get('name'):
+            raise ValueError(f"Account #{position} must be an object with a 'name'")
+        name = entry['name']
+        if name in names:
+            raise ValueError(f"Duplicate account name '{name}'")
+        names.add(name)
+        unknown = set(entry) - PROFILE_KEYS
+        if unknown:
+            raise ValueError(f"Account '{name}': unknown keys {', '.join(sorted(unknown))}")
+        quota = entry.get('quota_units_per_second', QUOTA_UNITS_PER_SECOND)
+        if not isinstance(quota, (int, float)) or quota <= 0:
+            raise ValueError(f"Account '{name}': quota_units_per_second must be a positive number")
+        profiles.append(AccountProfile(name, entry.get('token_path'), entry.get('db_path'), quota))
+    return profiles
+
+
+def select_accounts(profiles, names):
+    """
+    Pick profiles by name.
+
+    Args:
+        profiles (list): AccountProfile objects.
+        names (list): Account names to pick, or None/empty for all of them.
+
+    Returns:
+        list: The named profiles, in the order of `names`.
+
+    Raises:
+        ValueError: If a name is not in `profiles`.
+    """
+    if not names:
+        return list(profiles)
+    by_name = {profile.name: profile for profile in profiles}
+    unknown = [name for name in names if name not in by_name]
+    if unknown:
+        raise ValueError(f"Unknown account {', '.join(unknown)}. Known accounts: {', '.join(by_name)}")
+    return [by_name[name] for name in names]
+
+
+def build_accessor(profile):
+    """Return a MessageAccesor for the account (the default accessor_factory of sync_accounts)."""
+    from src.MessageAccesor import MessageAccesor
+    return MessageAccesor(db=GmailCacheDB(profile.db_path), token_path=profile.token_path)
+
+
+class _ProgressWriter(io.TextIOBase):
+    """A thread-safe stdout replacement that sends each complete line to a queue as (name, line)."""
+
+    def __init__(self, name, events):
+        self.name = name
+        self.events = events
+        self._buffer = ''
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        with self._lock:
+            *lines, self._buffer = (self._buffer + text).split('\n')
+            for line in lines:
+                if line.strip():
+                    self.events.put((self.name, line))
+        return len(text)
+
+    def flush(self):
+        with self._lock:
+            if self._buffer.strip():
+                self.events.put((self.name, self._buffer))
+            self._buffer = ''
+
+
+def _sync_account(profile, options, accessor_factory, events):
+    """
+    Sync one account in a worker process.
+
+    Args:
+        profile (AccountProfile): The account to sync.
+        options (dict): Keyword arguments for MessageAccesor.get_all_messages.
+        accessor_factory (callable): Called as accessor_factory(profile); returns a MessageAccesor.
+        events: Queue receiving the account's output lines as (name, line).
+
+    Returns:
+        dict: The account's result: name, status, seconds, messages, bytes, unread, quota units
+              and the metrics recorded by the sync (see src/metrics.py).
+    """
+    # A pool process syncs several accounts one after the other
+    metrics.reset()
+    writer = _ProgressWriter(profile.name, events)
+    result = {'name': profile.name, 'status': 'failed', 'messages': 0, 'bytes': 0, 'unread': 0, 'units': 0}
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(writer):
+        accessor = None
+        try:
+            accessor = accessor_factory(profile)
+            accessor.scheduler = QuotaScheduler(units_per_second=profile.quota_units_per_second)
+            if accessor.get_all_messages(**options):
+                result['status'] = 'ok'
+            result['units'] = accessor.scheduler.units_spent
+            conn = accessor.db.get_read_connection()
+            try:
+                result.update(InsightsReport(accessor.db).totals(conn))
+            finally:
+                accessor.db.close_connection(conn)
+        except Exception as e:
+            print(f"Sync failed: {e}")
+        finally:
+            if accessor is not None:
+                accessor.db.close()
+    writer.flush()
+    result['seconds'] = time.perf_counter() - start
+    result['metrics'] = metrics.snapshot()
+    return result
+
+
+def _print_events(events):
+    """Print the (name, line) events of the worker processes until a None arrives."""
+    while True:
+        event = events.get()
+        if event is None:
+            return
+        name, line = event
+        print(f"[{name}] {line}", flush=True)
+
+
+def authorize_accounts(profiles, accessor_factory=build_accessor):
+    """
+    Run the OAuth flow, one account at a time, for every account without a saved token.
+
+    The flow opens a browser and waits for the user, so it cannot run in the
+    worker processes. Accounts whose authorization fails are left out.
+
+    Args:
+        profiles (list): AccountProfile objects.
+        accessor_factory (callable): Called as accessor_factory(profile); returns a MessageAccesor.
+
+    Returns:
+        list: The profiles that can be synced.
+    """
+    ready = []
+    for profile in profiles:
+        if os.path.exists(profile.token_path):
+            ready.append(profile)
+            continue
+        print(f"Authorizing account '{profile.name}'...")
+        accessor = accessor_factory(profile)
+        try:
+            if accessor.get_gmail_service():
+                ready.append(profile)
+            else:
+                print(f"Skipping '{profile.name}': authorization failed.")
+        finally:
+            accessor.db.close()
+    return ready
+
+
+def sync_accounts(profiles, options, processes=None, accessor_factory=build_accessor):
+    """
+    Sync several accounts in parallel worker processes and print a combined report.
+
+    Args:
+        profiles (list): AccountProfile objects to sync.
+        options (dict): Keyword arguments for MessageAccesor.get_all_messages.
+        processes (int, optional): Number of worker processes. Default: one per CPU, at most one per account.
+        accessor_factory (callable): Called as accessor_factory(profile) in the worker process;
+                                     returns a MessageAccesor. Must be picklable.
+
+    Returns:
+        list: Per-account result dictionaries (see _sync_account), in the order of `profiles`.
+    """
+    # Imported here to keep them out of the startup of every other command
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    processes = max(1, min(processes or os.cpu_count() or 1, len(profiles)))
+    print(f"Syncing {len(profiles)} accounts in {processes} processes...")
+    start = time.perf_counter()
+    # Spawned workers start clean instead of inheriting the parent's threads and connections
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    with context.Manager() as manager:
+        events = manager.Queue()
+        printer = threading.Thread(target=_print_events, args=(events,), name="account-progress", daemon=True)
+        printer.start()
+        try:
+            with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+                futures = {executor.submit(_sync_account, profile, options, accessor_factory, events): profile
+                           for profile in profiles}
+                for future in as_completed(futures):
+                    profile = futures[future]
+                    try:
+                        results[profile.name] = future.result()
+                        # Combine the accounts' metrics for --metrics-json
+                        metrics.merge(results[profile.name].pop('metrics'))
+                    except Exception as e:
+                        # The worker process itself failed (e.g. it was killed)
+                        events.put((profile.name, f"Worker process failed: {e}"))
+                        results[profile.name] = {'name': profile.name, 'status': 'failed', 'seconds': 0,
+                                                 'messages': 0, 'bytes': 0, 'unread': 0, 'units': 0}
+                    events.put((profile.name, f"Finished ({results[profile.name]['status']}); "
+                                              f"{len(results)}/{len(profiles)} accounts done."))
+        finally:
+            events.put(None)
+            printer.join()
+
+    ordered = [results[profile.name] for profile in profiles]
+    print_accounts_report(ordered, time.perf_counter() - start)
+    return ordered
+
+
+def print_accounts_report(results, wall_seconds):
+    """
+    Print one row per synced account and the totals.
+
+    Args:
+        results (list): Per-account result dictionaries (see _sync_account).
+        wall_seconds (float): Wall time of the whole run.
+    """
+    print(f"\n{'Account':<20} {'Status':<7} {'Time':>8} {'Messages':>10} {'Size':>10} {'Unread':>8} {'Quota units':>12}")
+    for result in results:
+        print(f"{result['name']:<20} {result['status']:<7} {result['seconds']:>7.1f}s {result['messages']:>10} "
+              f"{format_size(result['bytes']):>10} {result['unread']:>8} {result['units']:>12}")
+    totals = {key: sum(result[key] for result in results) for key in ('seconds', 'messages', 'bytes', 'unread', 'units')}
+    succeeded = sum(result['status'] == 'ok' for result in results)
+    print(f"{'Total':<20} {f'{succeeded}/{len(results)} ok':<7} {wall_seconds:>7.1f}s {totals['messages']:>10} "
+          f"{format_size(totals['bytes']):>10} {totals['unread']:>8} {totals['units']:>12}")
+    if wall_seconds > 0:
+        print(f"Account sync time {totals['seconds']:.1f}s in {wall_seconds:.1f}s wall time "
+              f"({totals['seconds'] / wall_seconds:.1f}x parallelism).")
@@ -0,0 +1,250 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src import gmail_service
+from src.config import BATCH_ACTION_CHUNK_SIZE
+from src.gmail_db import in_sync_scope
+
+# Phase Two actions: the API method each one uses and the label changes it makes.
+# 'label' and 'unlabel' apply the label given with the action.
+ACTIONS = {
+    'trash': {'method': 'messages.batchModify', 'add': ['TRASH'], 'remove': ['INBOX']},
+    'delete': {'method': 'messages.batchDelete', 'add': [], 'remove': []},
+    'archive': {'method': 'messages.batchModify', 'add': [], 'remove': ['INBOX']},
+    'mark-read': {'method': 'messages.batchModify', 'add': [], 'remove': ['UNREAD']},
+    'mark-unread': {'method': 'messages.batchModify', 'add': ['UNREAD'], 'remove': []},
+    'label': {'method': 'messages.batchModify', 'add': [], 'remove': []},
+    'unlabel': {'method': 'messages.batchModify', 'add': [], 'remove': []},
+}
+
+# Actions that need the full mailbox scope instead of gmail.modify
+FULL_ACCESS_ACTIONS = {'delete'}
+
+
+def build_selection(sender=None, domain=None, subject_contains=None, label=None, older_than_days=None,
+                    newer_than_days=None, larger_than_mb=None, smaller_than_mb=None, unread=None,
+                    has_attachments=None, now=None):
+    """
+    Build a parameterised WHERE clause over message_rich_metadata (aliased r).
+
+    Every condition uses an index: senders by address/domain, message_labels by
+    label, and the internal_date and size_estimate indexes.
+
+    Args:
+        sender (str, optional): Sender email address.
+        domain (str, optional): Sender domain.
+        subject_contains (str, optional): Text the subject must contain (case-insensitive).
+        label (str, optional): Label ID the message must have.
+        older_than_days (float, optional): Only messages received more than this many days ago.
+        newer_than_days (float, optional): Only messages received less than this many days ago.
+        larger_than_mb (float, optional): Only messages at least this large.
+        smaller_than_mb (float, optional): Only messages smaller than this.
+        unread (bool, optional): True for unread messages only, False for read messages only.
+        has_attachments (bool, optional): Only messages with (True) or without (False) attachments.
+        now (float, optional): Reference time in seconds since the epoch. Defaults to now.
+
+    Returns:
+        tuple: (where_sql, params). where_sql is '1' when no condition is given.
+    """
+    conditions, params = [], []
+    if sender:
+        conditions.append("r.sender_id IN (SELECT sender_id FROM senders WHERE address = ?)")
+        params.append(sender.strip().lower())
+    if domain:
+        conditions.append("r.sender_id IN (SELECT sender_id FROM senders WHERE domain = ?)")
+        params.append(domain.strip().lower())
+    if subject_contains:
+        escaped = subject_contains.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        conditions.append("r.subject LIKE ? ESCAPE '\\'")
+        params.append(f'%{escaped}%')
+    if label:
+        conditions.append("r.message_id IN (SELECT message_id FROM message_labels WHERE label_id = ?)")
+        params.append(label)
+    if older_than_days is not None:
+        conditions.append("r.internal_date < ?")
+        params.append(int(((now or time.time()) - older_than_days * 86400) * 1000))
+    if newer_than_days is not None:
+        conditions.append("r.internal_date >= ?")
+        params.append(int(((now or time.time()) - newer_than_days * 86400) * 1000))
+    if larger_than_mb is not None:
+        conditions.append("r.size_estimate >= ?")
+        params.append(int(larger_than_mb * 1024 * 1024))
+    if smaller_than_mb is not None:
+        conditions.append("r.size_estimate < ?")
+        params.append(int(smaller_than_mb * 1024 * 1024))
+    if unread is not None:
+        membership = "IN" if unread else "NOT IN"
+        conditions.append(f"r.message_id {membership} (SELECT message_id FROM message_labels WHERE label_id = 'UNREAD')")
+    if has_attachments is not None:
+        conditions.append("r.has_attachments = ?")
+        params.append(1 if has_attachments else 0)
+    return (' AND '.join(conditions) or '1'), params
+
+
+class ActionEngine:
+    """
+    Applies Phase Two actions to messages selected from the local cache.
+
+    Target IDs are selected with SQL against GmailCacheDB and sent to Gmail with
+    users.messages.batchModify / batchDelete in chunks of up to 1000 IDs, so a
+    cleanup of 50,000 messages costs about 50 API calls. Chunks run concurrently
+    through the shared QuotaScheduler. Each successful chunk is written through to
+    the cache in the same step, so no re-sync is needed afterwards.
+    """
+
+    def __init__(self, db, service_factory, scheduler, workers=4, chunk_size=BATCH_ACTION_CHUNK_SIZE):
+        """
+        Initialize the engine.
+
+        Args:
+            db (GmailCacheDB): The cache database to select from and update.
+            service_factory (callable): Returns a Gmail service object; called once per worker thread.
+            scheduler (QuotaScheduler): Shared scheduler that rate-limits and retries the calls.
+            workers (int): Number of chunks sent concurrently.
+            chunk_size (int): Message IDs per API call (at most 1000).
+        """
+        self.db = db
+        self.service_factory = service_factory
+        self.scheduler = scheduler
+        self.workers = max(1, workers)
+        self.chunk_size = max(1, min(chunk_size, BATCH_ACTION_CHUNK_SIZE))
+        self._local = threading.local()
+
+    def preview(self, conn, where, params, limit=None):
+        """
+        Count the messages a selection matches and their total size (the dry run).
+
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+            where (str): WHERE clause over message_rich_metadata r (see build_selection).
+            params (list): Parameters of the WHERE clause.
+            limit (int, optional): Only count the first `limit` matches (oldest first).
+
+        Returns:
+            tuple: (message_count, total_bytes).
+        """
+        if limit is None:
+            return conn.execute(f"""
+                SELECT COUNT(*), COALESCE(SUM(r.size_estimate), 0) FROM message_rich_metadata r
+                WHERE {where}
+            """, params).fetchone()
+        return conn.execute(f"""
+            SELECT COUNT(*), COALESCE(SUM(size_estimate), 0) FROM (
+                SELECT r.size_estimate FROM message_rich_metadata r
+                WHERE {where}
+                ORDER BY r.internal_date
+                LIMIT ?
+            )
+        """, [*params, limit]).fetchone()
+
+    def select_ids(self, conn, where, params, limit=None):
+        """
+        Return the IDs of the messages a selection matches, oldest first.
+
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+            where (str): WHERE clause over message_rich_metadata r (see build_selection).
+            params (list): Parameters of the WHERE clause.
+            limit (int, optional): Maximum number of IDs.
+
+        Returns:
+            list: Message IDs.
+        """
+        return [row[0] for row in conn.execute(f"""
+            SELECT r.message_id FROM message_rich_metadata r
+            WHERE {where}
+            ORDER BY r.internal_date
+            LIMIT ?
+        """, [*params, -1 if limit is None else limit])]
+
+    def apply(self, action, message_ids, label_id=None):
+        """
+        Apply an action to messages in Gmail and write the change through to the cache.
+
+        Args:
+            action (str): One of ACTIONS.
+            message_ids (list): IDs of the messages to act on.
+            label_id (str, optional): The label for the 'label' and 'unlabel' actions.
+
+        Returns:
+            dict: 'applied' (number of messages changed), 'failed' (IDs whose chunk failed)
+                  and 'api_calls' (number of chunks sent).
+
+        Raises:
+            ValueError: For an unknown action or a missing label_id.
+        """
+        if action not in ACTIONS:
+            raise ValueError(f"Unknown action '{action}'. Choose from: {', '.join(ACTIONS)}")
+        add, remove = list(ACTIONS[action]['add']), list(ACTIONS[action]['remove'])
+        if action in ('label', 'unlabel'):
+            if not label_id:
+                raise ValueError(f"The '{action}' action needs a label ID")
+            (add if action == 'label' else remove).append(label_id)
+
+        chunks = [message_ids[i:i + self.chunk_size] for i in range(0, len(message_ids), self.chunk_size)]
+        result = {'applied': 0, 'failed': [], 'api_calls': len(chunks)}
+        lock = threading.Lock()
+
+        def run_chunk(chunk):
+            try:
+                self._apply_chunk(action, chunk, add, remove)
+            except gmail_service.HttpError as error:
+                print(f"Error applying '{action}' to {len(chunk)} messages: {error}")
+                with lock:
+                    result['failed'].extend(chunk)
+                return
+            with lock:
+                result['applied'] += len(chunk)
+                print(f"Applied '{action}' to {len(chunk)} messages. (Total: {result['applied']})")
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="action") as executor:
+            # list() re-raises unexpected errors from the workers
+            list(executor.map(run_chunk, chunks))
+        return result
+
+    def _service(self):
+        """Return this thread's Gmail service object (the HTTP client is not thread-safe)."""
+        if getattr(self._local, 'service', None) is None:
+            self._local.service = self.service_factory()
+        return self._local.service
+
+    def _apply_chunk(self, action, chunk, add, remove):
+        """Send one batchModify/batchDelete call and update the cache for its messages."""
+        messages = self._service().users().messages()
+        method = ACTIONS[action]['method']
+        if method == 'messages.batchDelete':
+            request = messages.batchDelete(userId='me', body={'ids': chunk})
+        else:
+            request = messages.batchModify(userId='me', body={'ids': chunk, 'addLabelIds': add, 'removeLabelIds': remove})
+        self.scheduler.execute(request, method)
+
+        with self.db.write_transaction() as conn:
+            if method == 'messages.batchDelete':
+                self.db.delete_messages(conn, chunk)
+                return
+            self._write_through_labels(conn, chunk, add, remove)
+
+    def _write_through_labels(self, conn, chunk, add, remove):
+        """
+        Apply a label change to the cached messages of a chunk.
+
+        Messages that leave the synced labels (e.g. archived from an INBOX cache,
+        or trashed) are removed from the cache, like an incremental sync would do.
+        """
+        sync_labels = self.db.get_sync_labels(conn)
+        rows = conn.execute(
+            "SELECT message_id, label_ids_json FROM message_rich_metadata WHERE message_id IN (SELECT value FROM json_each(?))",
+            (json.dumps(chunk),)
+        ).fetchall()
+        leaving = []
+        for message_id, label_ids_json in rows:
+            labels = [label for label in json.loads(label_ids_json or '[]') if label not in remove]
+            labels += [label for label in add if label not in labels]
+            if in_sync_scope(labels, sync_labels):
+                self.db.update_message_labels(conn, message_id, labels)
+            else:
+                leaving.append(message_id)
+        if leaving:
+            self.db.delete_messages(conn, leaving)
@@ -0,0 +1,704 @@
+"""
+A content-addressed store for raw message bodies (RFC822), next to the metadata cache.
+
+Every message is split along its MIME structure. Each leaf part's body is stored
+once as a blob keyed by the SHA-256 of its content, so a newsletter template or an
+attachment that arrives in many messages takes the space of one. What remains of
+the message (headers, boundaries, anything between parts) is kept per message as
+a small compressed skeleton that references the parts. Base64 parts are stored
+decoded when re-encoding them reproduces the original bytes exactly, so every
+message can be rebuilt byte for byte.
+
+Blobs live in their own SQLite file (gmail_bodies.db) so the metadata cache stays
+small. The store has a size budget; when it is exceeded the least recently used
+messages are evicted together with the blobs no other message references.
+
+    store = BodyStore.for_cache(db)
+    store.put_raw(message_id, response['raw'])    # base64url 'raw' from messages.get
+    text = store.get_text(message_id)             # only this part is decompressed
+"""
+import base64
+import binascii
+import hashlib
+import json
+import mmap
+import os
+import quopri
+import re
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from email.parser import BytesHeaderParser
+from email.policy import compat32
+
+from src.config import BODY_STORE_BUDGET_MB
+from src.gmail_db import CONNECTION_PRAGMAS
+
+BODY_STORE_FILENAME = 'gmail_bodies.db'
+
+# Base64 characters decoded per step when streaming a 'raw' payload (a multiple of 4)
+DECODE_CHUNK_CHARS = 1 << 20
+# Decoded messages larger than this are spooled to a temporary file instead of memory
+SPOOL_MAX_BYTES = 8 * 1024 * 1024
+# Blobs that do not compress below this share of their size are stored as they are
+MIN_COMPRESSION_RATIO = 0.95
+# Maximum number of messages evicted per step
+EVICTION_BATCH_SIZE = 100
+
+# Skeleton record tags: literal bytes, or a reference to a part by index
+_LITERAL, _PART = b'L', b'P'
+_RECORD_HEADER = struct.Struct('>cI')
+_BLANK_LINE = re.compile(rb'\r?\n\r?\n')
+
+
+class BodyStore:
+    """
+    Stores raw messages as deduplicated, compressed MIME parts with LRU eviction.
+    """
+
+    def __init__(self, path, budget_bytes=BODY_STORE_BUDGET_MB * 1024 * 1024):
+        """
+        Open (or create) a body store.
+
+        Args:
+            path (str): Path to the store's SQLite file.
+            budget_bytes (int): Maximum stored size; least recently used messages are
+                                evicted beyond it. None disables eviction.
+        """
+        self.path = path
+        self.budget_bytes = budget_bytes
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.RLock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        for pragma, value in CONNECTION_PRAGMAS.items():
+            self._conn.execute(f"PRAGMA {pragma} = {value}")
+        self._initialize()
+
+    @classmethod
+    def for_cache(cls, db, **kwargs):
+        """
+        Open the body store that sits next to a metadata cache.
+
+        Args:
+            db (GmailCacheDB): The metadata cache.
+            **kwargs: Passed on to BodyStore.
+
+        Returns:
+            BodyStore: The store in the cache database's directory.
+        """
+        return cls(os.path.join(os.path.dirname(os.path.abspath(db.db_path)), BODY_STORE_FILENAME), **kwargs)
+
+    def _initialize(self):
+        """Create the tables and the triggers that keep the size totals current."""
+        with self._transaction() as conn:
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS blobs (
+                hash TEXT PRIMARY KEY,
+                data BLOB NOT NULL,
+                compressed INTEGER NOT NULL,
+                raw_size INTEGER NOT NULL,
+                stored_size INTEGER NOT NULL
+            )
+            ''')
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS bodies (
+                message_id TEXT PRIMARY KEY,
+                thread_id TEXT,
+                skeleton BLOB NOT NULL,
+                raw_size INTEGER NOT NULL,
+                stored_size INTEGER NOT NULL,
+                stored_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_used REAL NOT NULL
+            )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_bodies_last_used ON bodies(last_used)")
+            # stored_encoded: the blob holds the part as transferred (e.g. quoted-printable);
+            # otherwise it holds the decoded content and line_length/crlf re-create base64
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS body_parts (
+                message_id TEXT NOT NULL,
+                part_index INTEGER NOT NULL,
+                content_type TEXT,
+                filename TEXT,
+                charset TEXT,
+                transfer_encoding TEXT,
+                size INTEGER,
+                blob_hash TEXT NOT NULL,
+                stored_encoded INTEGER NOT NULL,
+                line_length INTEGER,
+                crlf INTEGER,
+                PRIMARY KEY (message_id, part_index)
+            ) WITHOUT ROWID
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_body_parts_blob ON body_parts(blob_hash)")
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS store_totals (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            )
+            ''')
+            conn.execute("""
+                INSERT OR IGNORE INTO store_totals (name, value)
+                VALUES ('messages', 0), ('raw_bytes', 0), ('stored_bytes', 0)
+            """)
+            conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_blobs_insert AFTER INSERT ON blobs BEGIN
+                UPDATE store_totals SET value = value + NEW.stored_size WHERE name = 'stored_bytes';
+            END
+            ''')
+            conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_blobs_delete AFTER DELETE ON blobs BEGIN
+                UPDATE store_totals SET value = value - OLD.stored_size WHERE name = 'stored_bytes';
+            END
+            ''')
+            conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_bodies_insert AFTER INSERT ON bodies BEGIN
+                UPDATE store_totals SET value = value + 1 WHERE name = 'messages';
+                UPDATE store_totals SET value = value + NEW.raw_size WHERE name = 'raw_bytes';
+                UPDATE store_totals SET value = value + NEW.stored_size WHERE name = 'stored_bytes';
+            END
+            ''')
+            conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_bodies_delete AFTER DELETE ON bodies BEGIN
+                UPDATE store_totals SET value = value - 1 WHERE name = 'messages';
+                UPDATE store_totals SET value = value - OLD.raw_size WHERE name = 'raw_bytes';
+                UPDATE store_totals SET value = value - OLD.stored_size WHERE name = 'stored_bytes';
+            END
+            ''')
+
+    @contextmanager
+    def _transaction(self):
+        """Run a block in one write transaction on the store's connection."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def close(self):
+        """Close the store's connection."""
+        with self._lock:
+            self._conn.close()
+
+    # -- Writing -------------------------------------------------------------
+
+    def put_raw(self, message_id, raw, thread_id=None):
+        """
+        Store a raw message from the base64url 'raw' field of a messages.get response.
+
+        The payload is decoded in chunks into a spooled buffer (a file for large
+        messages), split into MIME parts, and only parts whose content is not
+        stored yet are compressed and written. Storing a message that is already
+        in the store only marks it as used.
+
+        Args:
+            message_id (str): The Gmail message ID.
+            raw (str): The base64url-encoded RFC822 message.
+            thread_id (str, optional): The Gmail thread ID.
+
+        Returns:
+            dict: 'raw_bytes' (message size), 'parts', 'new_parts' (parts not stored
+                  before), 'stored_bytes' (bytes added to the store) and 'evicted'
+                  (messages evicted to stay within the budget).
+        """
+        if self.has(message_id):
+            self._touch([message_id])
+            return {'raw_bytes': 0, 'parts': 0, 'new_parts': 0, 'stored_bytes': 0, 'evicted': 0}
+
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES) as spool:
+            for start in range(0, len(raw), DECODE_CHUNK_CHARS):
+                chunk = raw[start:start + DECODE_CHUNK_CHARS]
+                if start + DECODE_CHUNK_CHARS >= len(raw):
+                    chunk += '=' * (-len(chunk) % 4) # Gmail may leave out the padding
+                spool.write(base64.urlsafe_b64decode(chunk))
+            return self.put_bytes(message_id, spool, thread_id)
+
+    def put_bytes(self, message_id, source, thread_id=None):
+        """
+        Store a raw RFC822 message given as bytes or as a readable binary file.
+
+        Args:
+            message_id (str): The Gmail message ID.
+            source (bytes or file): The message, or a file positioned anywhere.
+            thread_id (str, optional): The Gmail thread ID.
+
+        Returns:
+            dict: As for put_raw.
+        """
+        with _buffer(source) as buf:
+            segments = []
+            self._split(buf, 0, len(buf), segments)
+            result = {'raw_bytes': len(buf), 'parts': 0, 'new_parts': 0, 'stored_bytes': 0, 'evicted': 0}
+            with self._transaction() as conn:
+                # Replacing a message: delete first so the totals triggers see it go
+                conn.execute("DELETE FROM body_parts WHERE message_id = ?", (message_id,))
+                conn.execute("DELETE FROM bodies WHERE message_id = ?", (message_id,))
+                skeleton = bytearray()
+                for segment in segments:
+                    if segment[0] == 'literal':
+                        data = buf[segment[1]:segment[2]]
+                        skeleton += _RECORD_HEADER.pack(_LITERAL, len(data)) + data
+                    else:
+                        stored = self._put_part(conn, message_id, result['parts'], buf, *segment[1:])
+                        skeleton += _RECORD_HEADER.pack(_PART, result['parts'])
+                        result['parts'] += 1
+                        result['new_parts'] += stored > 0
+                        result['stored_bytes'] += stored
+                skeleton = zlib.compress(bytes(skeleton))
+                conn.execute("""
+                    INSERT INTO bodies (message_id, thread_id, skeleton, raw_size, stored_size, last_used)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (message_id, thread_id, skeleton, len(buf), len(skeleton), time.time()))
+                result['stored_bytes'] += len(skeleton)
+        if self.budget_bytes is not None:
+            result['evicted'] = self.evict(self.budget_bytes, keep=message_id)
+        return result
+
+    def _split(self, buf, start, end, segments):
+        """
+        Cut buf[start:end] (one MIME entity) into literal ranges and leaf parts.
+
+        Multipart entities are split at their boundary lines and their parts split
+        recursively; message/rfc822 parts are split like a message. Anything not
+        recognised stays literal, so the segments always cover the input exactly.
+        """
+        if buf[start:start + 2] == b'\r\n' or buf[start:start + 1] == b'\n':
+            body_start = start + (2 if buf[start:start + 1] == b'\r' else 1) # An entity without headers
+        else:
+            blank_line = _BLANK_LINE.search(buf, start, end)
+            if not blank_line:
+                _add_literal(segments, start, end)
+                return
+            body_start = blank_line.end()
+        headers = BytesHeaderParser(policy=compat32).parsebytes(bytes(buf[start:body_start]))
+        _add_literal(segments, start, body_start)
+
+        transfer_encoding = (headers.get('Content-Transfer-Encoding') or '7bit').strip().lower()
+        boundary = headers.get_boundary()
+        if headers.get_content_maintype() == 'multipart' and boundary:
+            self._split_multipart(buf, body_start, end, boundary.encode('ascii', 'surrogateescape'), segments)
+        elif headers.get_content_type() == 'message/rfc822' and transfer_encoding in ('7bit', '8bit', 'binary'):
+            self._split(buf, body_start, end, segments)
+        else:
+            # Trailing line breaks stay in the skeleton; the part is the content itself
+            content_end = end
+            while content_end > body_start and buf[content_end - 1:content_end] in (b'\n', b'\r'):
+                content_end -= 1
+            if content_end > body_start:
+                segments.append(('part', headers, transfer_encoding, body_start, content_end))
+            _add_literal(segments, content_end, end)
+
+    def _split_multipart(self, buf, start, end, boundary, segments):
+        """Split a multipart body at its delimiter lines (see _split)."""
+        delimiter = b'--' + boundary
+        delimiters = [] # (line start, line end, is the closing delimiter)
+        position = start
+        while True:
+            found = buf.find(delimiter, position, end)
+            if found < 0:
+                break
+            position = found + len(delimiter)
+            if found != start and buf[found - 1:found] != b'\n':
+                continue
+            closing = buf[position:position + 2] == b'--'
+            line_end = buf.find(b'\n', position, end)
+            line_end = end if line_end < 0 else line_end + 1
+            delimiters.append((found, line_end, closing))
+            position = line_end
+            if closing:
+                break
+        if not delimiters:
+            # No usable boundary: keep the body as one opaque part
+            if end > start:
+                segments.append(('part', None, '7bit', start, end))
+            return
+
+        _add_literal(segments, start, delimiters[0][1]) # Preamble and first delimiter
+        for (_, part_start, closing), (next_start, next_end, _) in zip(delimiters, delimiters[1:]):
+            if closing:
+                break
+            # The line break before a delimiter belongs to the delimiter
+            part_end = next_start
+            if buf[part_end - 1:part_end] == b'\n':
+                part_end -= 1
+                if buf[part_end - 1:part_end] == b'\r':
+                    part_end -= 1
+            part_end = max(part_start, part_end)
+            if part_end > part_start:
+                self._split(buf, part_start, part_end, segments)
+            _add_literal(segments, part_end, next_end)
+        _add_literal(segments, delimiters[-1][1], end) # Epilogue
+
+    def _put_part(self, conn, message_id, part_index, buf, headers, transfer_encoding, start, end):
+        """
+        Record one leaf part of a message and store its content if it is new.
+
+        Returns:
+            int: Bytes added to the store (0 when the content was already stored).
+        """
+        encoded = bytes(buf[start:end])
+        line_length = crlf = None
+        if transfer_encoding == 'base64':
+            content, line_length, crlf = _decode_base64_exactly(encoded)
+            stored_encoded = content is None
+            size = _decoded_size(encoded) if stored_encoded else len(content)
+        elif transfer_encoding == 'quoted-printable':
+            # Re-encoding quoted-printable does not reliably give the same bytes back
+            content, stored_encoded, size = None, True, len(quopri.decodestring(encoded))
+        else:
+            content, stored_encoded, size = encoded, False, len(encoded)
+        if stored_encoded:
+            content = encoded
+
+        blob_hash = hashlib.sha256(content).hexdigest()
+        stored = 0
+        if conn.execute("SELECT 1 FROM blobs WHERE hash = ?", (blob_hash,)).fetchone() is None:
+            data = zlib.compress(content)
+            compressed = len(data) < len(content) * MIN_COMPRESSION_RATIO
+            if not compressed:
+                data = content
+            conn.execute(
+                "INSERT INTO blobs (hash, data, compressed, raw_size, stored_size) VALUES (?, ?, ?, ?, ?)",
+                (blob_hash, data, int(compressed), len(content), len(data))
+            )
+            stored = len(data)
+
+        headers = headers if headers is not None else BytesHeaderParser(policy=compat32).parsebytes(b'')
+        conn.execute("""
+            INSERT INTO body_parts (message_id, part_index, content_type, filename, charset, transfer_encoding,
+                                    size, blob_hash, stored_encoded, line_length, crlf)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (message_id, part_index, headers.get_content_type(), headers.get_filename(),
+              headers.get_content_charset(), transfer_encoding, size, blob_hash, int(stored_encoded),
+              line_length, None if crlf is None else int(crlf)))
+        return stored
+
+    # -- Reading -------------------------------------------------------------
+
+    def has(self, message_id):
+        """
+        Check whether a message is in the store.
+
+        Args:
+            message_id (str): The Gmail message ID.
+
+        Returns:
+            bool: True if its body is stored.
+        """
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM bodies WHERE message_id = ?", (message_id,)).fetchone() is not None
+
+    def missing(self, message_ids):
+        """
+        Return the IDs whose bodies are not stored, keeping their order.
+
+        Args:
+            message_ids (list): Gmail message IDs.
+
+        Returns:
+            list: The IDs not in the store.
+        """
+        with self._lock:
+            stored = {row[0] for row in self._conn.execute(
+                "SELECT message_id FROM bodies WHERE message_id IN (SELECT value FROM json_each(?))",
+                (_json_list(message_ids),)
+            )}
+        return [message_id for message_id in message_ids if message_id not in stored]
+
+    def get_thread_id(self, message_id):
+        """
+        Return the thread ID stored with a message body, or None.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT thread_id FROM bodies WHERE message_id = ?", (message_id,)).fetchone()
+        return row[0] if row else None
+
+    def iter_raw(self, message_id):
+        """
+        Rebuild a stored message, yielding its RFC822 bytes piece by piece.
+
+        Args:
+            message_id (str): The Gmail message ID.
+
+        Yields:
+            bytes: Consecutive pieces of the original message.
+
+        Raises:
+            KeyError: If the message is not in the store.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT skeleton FROM bodies WHERE message_id = ?", (message_id,)).fetchone()
+            if row is None:
+                raise KeyError(message_id)
+            parts = {part['index']: part for part in self._parts(message_id)}
+        self._touch([message_id])
+        skeleton = zlib.decompress(row[0])
+        position = 0
+        while position < len(skeleton):
+            tag, value = _RECORD_HEADER.unpack_from(skeleton, position)
+            position += _RECORD_HEADER.size
+            if tag == _LITERAL:
+                yield skeleton[position:position + value]
+                position += value
+            else:
+                yield self._encoded_part(parts[value])
+
+    def get_raw(self, message_id):
+        """
+        Return a stored message as RFC822 bytes, exactly as Gmail sent it.
+
+        Args:
+            message_id (str): The Gmail message ID.
+
+        Returns:
+            bytes: The message.
+
+        Raises:
+            KeyError: If the message is not in the store.
+        """
+        return b''.join(self.iter_raw(message_id))
+
+    def parts(self, message_id):
+        """
+        List the leaf MIME parts of a stored message without reading their content.
+
+        Args:
+            message_id (str): The Gmail message ID.
+
+        Returns:
+            list: Dictionaries with 'index', 'content_type', 'filename', 'charset',
+                  'transfer_encoding' and 'size' (decoded size, if known) keys.
+        """
+        with self._lock:
+            return [{key: part[key] for key in ('index', 'content_type', 'filename', 'charset', 'transfer_encoding', 'size')}
+                    for part in self._parts(message_id)]
+
+    def get_part(self, message_id, part_index):
+        """
+        Return the decoded content of one part. Only that part's blob is read.
+
+        Args:
+            message_id (str): The Gmail message ID.
+            part_index (int): Index of the part, as listed by parts().
+
+        Returns:
+            bytes: The decoded content.
+
+        Raises:
+            KeyError: If the message or part is not in the store.
+        """
+        with self._lock:
+            part = next((part for part in self._parts(message_id) if part['index'] == part_index), None)
+        if part is None:
+            raise KeyError((message_id, part_index))
+        self._touch([message_id])
+        content = self._blob(part['blob_hash'])
+        if not part['stored_encoded']:
+            return content
+        if part['transfer_encoding'] == 'quoted-printable':
+            return quopri.decodestring(content)
+        if part['transfer_encoding'] == 'base64':
+            return binascii.a2b_base64(content)
+        return content
+
+    def get_text(self, message_id, subtype='plain'):
+        """
+        Return the first text body of a stored message (not an attached text file).
+
+        Args:
+            message_id (str): The Gmail message ID.
+            subtype (str): 'plain' or 'html'.
+
+        Returns:
+            str: The text, or None if the message has no such part.
+        """
+        for part in self.parts(message_id):
+            if part['content_type'] == f'text/{subtype}' and not part['filename']:
+                content = self.get_part(message_id, part['index'])
+                try:
+                    return content.decode(part['charset'] or 'utf-8', errors='replace')
+                except LookupError: # Unknown charset
+                    return content.decode('utf-8', errors='replace')
+        return None
+
+    def stats(self):
+        """
+        Return the store's totals.
+
+        Returns:
+            dict: 'messages', 'raw_bytes' (size of the stored messages as sent),
+                  'stored_bytes' (size on disk before SQLite overhead) and 'blobs'.
+        """
+        with self._lock:
+            totals = dict(self._conn.execute("SELECT name, value FROM store_totals").fetchall())
+            totals['blobs'] = self._conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+        return totals
+
+    def _parts(self, message_id):
+        """Read the body_parts rows of a message as dictionaries, in part order."""
+        columns = ('index', 'content_type', 'filename', 'charset', 'transfer_encoding', 'size',
+                   'blob_hash', 'stored_encoded', 'line_length', 'crlf')
+        return [dict(zip(columns, row)) for row in self._conn.execute("""
+            SELECT part_index, content_type, filename, charset, transfer_encoding, size,
+                   blob_hash, stored_encoded, line_length, crlf
+            FROM body_parts WHERE message_id = ? ORDER BY part_index
+        """, (message_id,))]
+
+    def _blob(self, blob_hash):
+        """Read and decompress one blob."""
+        with self._lock:
+            data, compressed = self._conn.execute(
+                "SELECT data, compressed FROM blobs WHERE hash = ?", (blob_hash,)
+            ).fetchone()
+        return zlib.decompress(data) if compressed else bytes(data)
+
+    def _encoded_part(self, part):
+        """Return a part's bytes as they appear in the message."""
+        content = self._blob(part['blob_hash'])
+        if part['stored_encoded'] or part['transfer_encoding'] != 'base64':
+            return content
+        return _encode_base64(content, part['line_length'], part['crlf'])
+
+    def _touch(self, message_ids):
+        """Mark messages as just used, for LRU eviction."""
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE bodies SET last_used = ? WHERE message_id IN (SELECT value FROM json_each(?))",
+                (time.time(), _json_list(message_ids))
+            )
+
+    # -- Eviction ------------------------------------------------------------
+
+    def evict(self, budget_bytes, keep=None):
+        """
+        Evict least recently used messages until the store fits in a budget.
+
+        Blobs are removed once no remaining message references them.
+
+        Args:
+            budget_bytes (int): Target maximum for the stored size.
+            keep (str, optional): A message ID that must not be evicted.
+
+        Returns:
+            int: Number of messages evicted.
+        """
+        evicted = 0
+        with self._transaction() as conn:
+            while True:
+                totals = dict(conn.execute("SELECT name, value FROM store_totals").fetchall())
+                excess = totals['stored_bytes'] - budget_bytes
+                if excess <= 0 or not totals['messages']:
+                    break
+                # Evict about as many messages as the excess amounts to, so the store
+                # is not emptied far below its budget
+                average_size = totals['stored_bytes'] / totals['messages']
+                batch_size = min(EVICTION_BATCH_SIZE, max(1, int(excess / average_size)))
+                victims = [row[0] for row in conn.execute(
+                    "SELECT message_id FROM bodies WHERE message_id IS NOT ? ORDER BY last_used LIMIT ?", (keep, batch_size)
+                )]
+                if not victims:
+                    break
+                victims_json = _json_list(victims)
+                hashes = _json_list([row[0] for row in conn.execute(
+                    "SELECT DISTINCT blob_hash FROM body_parts WHERE message_id IN (SELECT value FROM json_each(?))",
+                    (victims_json,)
+                )])
+                conn.execute("DELETE FROM body_parts WHERE message_id IN (SELECT value FROM json_each(?))", (victims_json,))
+                conn.execute("DELETE FROM bodies WHERE message_id IN (SELECT value FROM json_each(?))", (victims_json,))
+                conn.execute("""
+                    DELETE FROM blobs WHERE hash IN (SELECT value FROM json_each(?))
+                    AND NOT EXISTS (SELECT 1 FROM body_parts WHERE blob_hash = blobs.hash)
+                """, (hashes,))
+                evicted += len(victims)
+        return evicted
+
+
+@contextmanager
+def _buffer(source):
+    """
+    Give random access to a message held in bytes or in a (spooled) file.
+
+    Small spooled files are read into memory; files on disk are memory-mapped,
+    so a large message is never copied into memory as a whole.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        yield bytes(source)
+        return
+    source.flush()
+    size = source.seek(0, os.SEEK_END)
+    source.seek(0)
+    if size == 0 or not _has_fileno(source):
+        yield source.read()
+        return
+    with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        yield mapped
+
+
+def _has_fileno(source):
+    """Return True if a file object is backed by a real file descriptor."""
+    if getattr(source, '_rolled', True) is False: # SpooledTemporaryFile still in memory
+        return False
+    try:
+        source.fileno()
+    except (OSError, AttributeError, ValueError):
+        return False
+    return True
+
+
+def _add_literal(segments, start, end):
+    """Append a literal byte range, merging it with a directly preceding one."""
+    if end <= start:
+        return
+    if segments and segments[-1][0] == 'literal' and segments[-1][2] == start:
+        segments[-1] = ('literal', segments[-1][1], end)
+    else:
+        segments.append(('literal', start, end))
+
+
+def _decode_base64_exactly(encoded):
+    """
+    Decode a base64 part if encoding the result again gives exactly the same bytes.
+
+    Returns:
+        tuple: (content, line_length, crlf), or (None, None, None) if the original
+               layout cannot be reproduced (irregular lines, stray characters).
+    """
+    first_break = encoded.find(b'\n')
+    crlf = first_break > 0 and encoded[first_break - 1:first_break] == b'\r'
+    line_length = len(encoded) if first_break < 0 else first_break - crlf
+    if line_length <= 0 or line_length % 4:
+        return None, None, None
+    try:
+        content = binascii.a2b_base64(encoded)
+    except binascii.Error:
+        return None, None, None
+    if _encode_base64(content, line_length, crlf) != encoded:
+        return None, None, None
+    return content, line_length, crlf
+
+
+def _decoded_size(encoded):
+    """Decoded size of a base64 part stored as transferred, or None if it is malformed."""
+    try:
+        return len(binascii.a2b_base64(encoded))
+    except binascii.Error:
+        return None
+
+
+def _encode_base64(content, line_length, crlf):
+    """Encode content as base64 lines of a given length, without a final line break."""
+    encoded = base64.b64encode(content)
+    line_break = b'\r\n' if crlf else b'\n'
+    return line_break.join(encoded[i:i + line_length] for i in range(0, len(encoded), line_length))
+
+
+def _json_list(values):
+    """Encode a list of IDs for json_each()."""
+    return json.dumps(list(values))
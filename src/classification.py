@@ -0,0 +1,247 @@
+"""
+Classification of message clusters (see clustering.py), one representative per cluster.
+
+A classifier is any object with a `name` and a `classify(items)` method. `items` is a
+list of dicts, one per cluster, describing its most recent message ('sender',
+'domain', 'subject', 'snippet') and the cluster ('template', 'member_count'); the
+method returns one (category, confidence) pair per item, in the same order.
+
+ClassificationPipeline sends the representatives of unclassified clusters to the
+classifier in batches, largest clusters first and several batches at a time, and
+stores each result on its cluster. The message_categories view gives every member
+the category of its cluster, including messages that join the cluster later, so
+the number of classifier calls grows with the number of distinct templates rather
+than with the number of messages.
+
+KeywordClassifier is a local stand-in that needs no model or network. Another
+classifier, such as one that prompts an LLM, is plugged in by its factory:
+
+    classifier = load_classifier('my_package.llm:make_classifier')
+    ClassificationPipeline(db, classifier).run()
+"""
+import importlib
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from src import metrics
+from src.config import CLASSIFY_BATCH_SIZE, CLASSIFY_WORKERS
+
+# Categories of the keyword classifier and the words that indicate them, in order of precedence
+CATEGORY_KEYWORDS = {
+    'security': {'security', 'password', 'verify', 'verification', 'login', 'sign', 'suspicious', 'alert', 'authentication'},
+    'receipt': {'receipt', 'invoice', 'order', 'payment', 'paid', 'purchase', 'statement', 'billing', 'subscription'},
+    'shipping': {'shipped', 'shipping', 'delivery', 'delivered', 'tracking', 'package', 'dispatched', 'parcel'},
+    'calendar': {'meeting', 'invitation', 'invite', 'calendar', 'event', 'rsvp', 'reminder', 'appointment'},
+    'social': {'commented', 'mentioned', 'followed', 'follower', 'friend', 'liked', 'tagged', 'connection'},
+    'promotion': {'sale', 'off', 'discount', 'deal', 'deals', 'offer', 'coupon', 'save', 'free', 'limited', 'shop'},
+    'newsletter': {'newsletter', 'digest', 'weekly', 'edition', 'issue', 'news', 'updates', 'roundup', 'list'},
+}
+# Category of messages that match no keyword, by whether the sender writes one-off mail
+PERSONAL_CATEGORY = 'personal'
+OTHER_CATEGORY = 'other'
+
+_WORD = re.compile(r'[a-z]+')
+
+
+class KeywordClassifier:
+    """
+    A local stand-in classifier: the category whose keywords appear most often.
+
+    Subject words count twice as much as snippet words. Clusters without any
+    keyword are 'personal' when they hold a single message and 'other' otherwise.
+    """
+
+    name = 'keyword'
+
+    def classify(self, items):
+        """
+        Classify cluster representatives.
+
+        Args:
+            items (list): One dict per cluster (see the module docstring).
+
+        Returns:
+            list: (category, confidence) per item, confidence between 0 and 1.
+        """
+        results = []
+        for item in items:
+            subject_words = _WORD.findall((item.get('subject') or '').lower())
+            snippet_words = _WORD.findall((item.get('snippet') or '').lower())
+            scores = {}
+            for category, keywords in CATEGORY_KEYWORDS.items():
+                score = 2 * sum(word in keywords for word in subject_words) + sum(word in keywords for word in snippet_words)
+                if score:
+                    scores[category] = score
+            if not scores:
+                category = PERSONAL_CATEGORY if item.get('member_count', 1) <= 1 else OTHER_CATEGORY
+                results.append((category, 0.3))
+                continue
+            # Ties go to the category listed first in CATEGORY_KEYWORDS
+            category = max(scores, key=scores.get)
+            results.append((category, round(scores[category] / (sum(scores.values()) + 1), 2)))
+        return results
+
+
+# Classifiers that load_classifier knows by name
+CLASSIFIERS = {'keyword': KeywordClassifier}
+
+
+def load_classifier(spec):
+    """
+    Create a classifier from a name in CLASSIFIERS or a 'module:factory' path.
+
+    Args:
+        spec (str): 'keyword', or e.g. 'my_package.llm:make_classifier', where the
+                    factory is called without arguments and returns the classifier.
+
+    Returns:
+        object: The classifier.
+
+    Raises:
+        ValueError: If the spec names no known classifier or importable factory.
+    """
+    if spec in CLASSIFIERS:
+        return CLASSIFIERS[spec]()
+    module_name, _, factory_name = spec.partition(':')
+    if not module_name or not factory_name:
+        raise ValueError(f"Unknown classifier '{spec}'. Use one of {', '.join(CLASSIFIERS)} or 'module:factory'")
+    try:
+        factory = getattr(importlib.import_module(module_name), factory_name)
+    except (ImportError, AttributeError) as e:
+        raise ValueError(f"Cannot load classifier '{spec}': {e}") from None
+    try:
+        classifier = factory()
+    except TypeError as e:
+        raise ValueError(f"Cannot create classifier '{spec}': {e}") from None
+    if not callable(getattr(classifier, 'classify', None)):
+        raise ValueError(f"'{spec}' did not return an object with a classify(items) method")
+    return classifier
+
+
+class ClassificationPipeline:
+    """Classifies one representative per cluster, in concurrent batches, and stores the categories."""
+
+    def __init__(self, db, classifier, batch_size=CLASSIFY_BATCH_SIZE, workers=CLASSIFY_WORKERS):
+        """
+        Initialize the pipeline.
+
+        Args:
+            db (GmailCacheDB): The cache database.
+            classifier: The classifier (see the module docstring).
+            batch_size (int): Representatives per classify() call.
+            workers (int): Number of concurrent classify() calls.
+        """
+        self.db = db
+        self.classifier = classifier
+        self.batch_size = max(1, batch_size)
+        self.workers = max(1, workers)
+
+    def pending(self, conn, limit=None, reclassify=False):
+        """
+        Return the representatives of the clusters to classify, largest clusters first.
+
+        The representative is the most recent message of the cluster.
+
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+            limit (int, optional): At most this many clusters.
+            reclassify (bool): Include clusters that already have a category.
+
+        Returns:
+            list: One item dict per cluster, with its 'cluster_id' (see the module docstring).
+        """
+        rows = conn.execute(f"""
+            SELECT c.cluster_id, c.sender_domain, c.template, c.member_count, r.from_address, r.subject, r.snippet
+            FROM clusters c
+            JOIN message_rich_metadata r ON r.message_id = (
+                SELECT m.message_id FROM message_clusters m
+                JOIN message_rich_metadata latest ON latest.message_id = m.message_id
+                WHERE m.cluster_id = c.cluster_id
+                ORDER BY latest.internal_date DESC LIMIT 1
+            )
+            WHERE c.member_count > 0 {'' if reclassify else 'AND c.category IS NULL'}
+            ORDER BY c.member_count DESC
+            LIMIT ?
+        """, (-1 if limit is None else limit,)).fetchall()
+        return [{'cluster_id': cluster_id, 'domain': domain, 'template': template, 'member_count': member_count,
+                 'sender': sender, 'subject': subject, 'snippet': snippet}
+                for cluster_id, domain, template, member_count, sender, subject, snippet in rows]
+
+    def _classify_batch(self, batch):
+        """Run the classifier on one batch and check that it returned one result per item."""
+        start = time.perf_counter()
+        results = list(self.classifier.classify(batch))
+        metrics.add_time('classify.batch', time.perf_counter() - start)
+        if len(results) != len(batch):
+            raise ValueError(f"the classifier returned {len(results)} results for {len(batch)} clusters")
+        return results
+
+    def run(self, limit=None, reclassify=False):
+        """
+        Classify the pending clusters and store their categories.
+
+        A failed batch is reported and left unclassified, so the next run retries it.
+
+        Args:
+            limit (int, optional): Classify at most this many clusters.
+            reclassify (bool): Classify again clusters that already have a category.
+
+        Returns:
+            dict: 'clusters' classified, 'messages' they hold, classifier 'calls',
+                  'failed' batches and 'seconds' taken.
+        """
+        start = time.perf_counter()
+        conn = self.db.get_read_connection()
+        try:
+            items = self.pending(conn, limit, reclassify)
+        finally:
+            self.db.close_connection(conn)
+
+        name = getattr(self.classifier, 'name', type(self.classifier).__name__)
+        stats = {'clusters': 0, 'messages': 0, 'calls': 0, 'failed': 0}
+        batches = [items[i:i + self.batch_size] for i in range(0, len(items), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="classify") as executor:
+            futures = {executor.submit(self._classify_batch, batch): batch for batch in batches}
+            for future in as_completed(futures):
+                batch = futures[future]
+                stats['calls'] += 1
+                try:
+                    results = future.result()
+                except Exception as e:
+                    print(f"Classifier batch of {len(batch)} clusters failed: {e}")
+                    stats['failed'] += 1
+                    continue
+                with self.db.write_transaction() as write_conn:
+                    write_conn.executemany("""
+                        UPDATE clusters SET category = ?, confidence = ?, classifier = ?, classified_at = CURRENT_TIMESTAMP
+                        WHERE cluster_id = ?
+                    """, [(category, confidence, name, item['cluster_id'])
+                          for item, (category, confidence) in zip(batch, results)])
+                stats['clusters'] += len(batch)
+                stats['messages'] += sum(item['member_count'] for item in batch)
+                metrics.count('classify.clusters', len(batch))
+        stats['seconds'] = time.perf_counter() - start
+        return stats
+
+    def print_summary(self, stats):
+        """
+        Print the outcome of a run and the number of clusters and messages per category.
+
+        Args:
+            stats (dict): The result of run().
+        """
+        print(f"Classified {stats['clusters']} clusters covering {stats['messages']} messages "
+              f"with {stats['calls']} classifier calls in {stats['seconds']:.1f}s"
+              + (f" ({stats['failed']} calls failed)." if stats['failed'] else "."))
+        conn = self.db.get_read_connection()
+        try:
+            rows = conn.execute("""
+                SELECT category, COUNT(*), SUM(member_count) FROM clusters
+                WHERE member_count > 0 GROUP BY category ORDER BY SUM(member_count) DESC
+            """).fetchall()
+        finally:
+            self.db.close_connection(conn)
+        print(f"\n{'Category':<16} {'Clusters':>9} {'Messages':>10}")
+        for category, cluster_count, message_count in rows:
+            print(f"{category or '(unclassified)':<16} {cluster_count:>9} {message_count:>10}")
@@ -0,0 +1,317 @@
+"""
+Near-duplicate clustering of cached messages, so that classification runs once per template.
+
+Most of a large mailbox is template mail: receipts, shipping notices, newsletters and
+alerts whose subjects and snippets differ only in names, amounts, dates and links.
+Messages are grouped in two steps, using only the cached from_address, subject and
+snippet:
+
+1. Template: the subject is normalised (reply prefixes removed; numbers, URLs and
+   email addresses replaced by placeholders). Messages from the same sender with the
+   same normalised subject share a cluster, found with one primary key lookup.
+2. Near duplicate: any other message gets a MinHash signature of the word shingles of
+   its normalised subject and snippet (one-permutation MinHash: one hash per shingle
+   instead of one per shingle and permutation). The LSH bands of the signature, scoped to the
+   sender domain, find candidate clusters. The message joins the candidate whose
+   estimated Jaccard similarity is highest, if it reaches CLUSTER_SIMILARITY_THRESHOLD,
+   and otherwise starts a new cluster.
+
+Clusters, template keys, LSH buckets and assignments are stored in the cache (see
+GmailCacheDB._migrate_to_v7), so every run only clusters the messages cached since
+the previous one.
+
+    clusterer = Clusterer(db)
+    stats = clusterer.run()
+"""
+import hashlib
+import html
+import re
+import time
+import zlib
+from array import array
+
+from src import metrics
+from src.config import CLUSTER_SIGNATURE_SIZE, CLUSTER_LSH_BANDS, CLUSTER_SIMILARITY_THRESHOLD
+from src.gmail_db import parse_sender
+
+# Key of the shingle hash. Stored signatures depend on it (and on CLUSTER_SIGNATURE_SIZE
+# and CLUSTER_LSH_BANDS); change them only together with `cluster --rebuild`.
+MINHASH_SEED = 1
+# Bits of a signature slot that hold the shingle hash; the bits above count how far an
+# empty slot is from the slot it borrowed its value from (see MinHasher.signature)
+_VALUE_BITS = 58
+_EMPTY = 1 << 64
+# Messages clustered per write transaction
+CHUNK_SIZE = 5000
+
+_REPLY_PREFIX = re.compile(r'^\s*((re|fwd?|aw|wg|tr)\s*(\[\d+\])?\s*:\s*)+', re.IGNORECASE)
+_URL = re.compile(r'(https?://|www\.)\S+')
+_EMAIL = re.compile(r'[\w.+-]+@[\w-]+(\.[\w-]+)+')
+# Any token with a digit: amounts, dates, times, order, tracking and account numbers
+_NUMBER = re.compile(r'\S*\d\S*')
+_TOKEN = re.compile(r'<\w+>|[^\W\d_]+')
+
+
+def normalize_text(text):
+    """
+    Reduce a subject or snippet to the words it shares with other mail of the same template.
+
+    Args:
+        text (str): The text, possibly with HTML entities (as in Gmail snippets).
+
+    Returns:
+        str: Lowercased words separated by single spaces, with URLs, email addresses and
+             tokens containing digits replaced by <url>, <email> and <n>.
+    """
+    text = html.unescape(text or '').lower()
+    text = _URL.sub(' <url> ', text)
+    text = _EMAIL.sub(' <email> ', text)
+    text = _NUMBER.sub(' <n> ', text)
+    return ' '.join(_TOKEN.findall(text))
+
+
+def normalize_subject(subject):
+    """Return the template of a subject: normalize_text without Re:/Fwd: prefixes."""
+    return normalize_text(_REPLY_PREFIX.sub('', subject or ''))
+
+
+def template_key(address, template):
+    """Return the cluster_templates key of a sender address and a normalised subject."""
+    return f"{address or ''}\n{template}"
+
+
+def shingles(*texts):
+    """
+    Return the word bigrams of normalised texts (the single word of a one-word text).
+
+    Returns:
+        set: The shingles, as strings.
+    """
+    result = set()
+    for text in texts:
+        words = text.split()
+        result.update(words if len(words) < 2 else [f"{first} {second}" for first, second in zip(words, words[1:])])
+    return result
+
+
+class MinHasher:
+    """
+    One-permutation MinHash signatures and their LSH band buckets.
+
+    Classic MinHash applies every one of its hash functions to every shingle, which
+    costs about half a millisecond per message in Python. Here each shingle is hashed
+    once: the hash picks one of the signature's slots and each slot keeps the smallest
+    hash it receives. Slots that receive nothing take the value of the next filled
+    slot, marked with their distance to it, so that short texts still compare well
+    (densification by rotation, Shrivastava and Li, 2014).
+    """
+
+    def __init__(self, signature_size=CLUSTER_SIGNATURE_SIZE, bands=CLUSTER_LSH_BANDS, seed=MINHASH_SEED):
+        """
+        Initialize the hasher.
+
+        Args:
+            signature_size (int): Number of slots of a signature (at most 64).
+            bands (int): Number of LSH bands; must divide signature_size.
+            seed (int): Key of the shingle hash.
+
+        Raises:
+            ValueError: If the sizes do not fit.
+        """
+        if not 0 < signature_size <= 64 or bands <= 0 or signature_size % bands:
+            raise ValueError(f"The number of bands ({bands}) must divide the signature size ({signature_size}, at most 64)")
+        self.size = signature_size
+        self.bands = bands
+        self.rows = signature_size // bands
+        self.key = seed.to_bytes(8, 'little')
+
+    def signature(self, shingles):
+        """Return the signature (a list of ints below 2**64) of a non-empty set of shingles."""
+        size, key = self.size, self.key
+        signature = [_EMPTY] * size
+        for shingle in shingles:
+            value = int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8, key=key).digest(), 'little')
+            slot, value = value % size, (value // size) & ((1 << _VALUE_BITS) - 1)
+            if value < signature[slot]:
+                signature[slot] = value
+        # Empty slots take the value of the next filled slot (wrapping around), tagged with their distance to it
+        next_filled = min(slot for slot in range(size) if signature[slot] != _EMPTY) + size
+        for slot in range(size - 1, -1, -1):
+            if signature[slot] == _EMPTY:
+                signature[slot] = ((next_filled - slot) << _VALUE_BITS) | signature[next_filled % size]
+            else:
+                next_filled = slot
+        return signature
+
+    def buckets(self, domain, signature):
+        """
+        Return the LSH bucket of every band of a signature.
+
+        Buckets are scoped to the sender domain, so only mail of the same domain
+        becomes a candidate. Two signatures share a bucket when one of their bands
+        is identical, which is likely when they are similar.
+
+        Args:
+            domain (str): The sender domain, or None.
+            signature (list): A signature from signature().
+
+        Returns:
+            list: One 32-bit bucket per band.
+        """
+        domain_hash = zlib.crc32((domain or '').encode())
+        return [zlib.crc32(band.to_bytes(2, 'little') + array('Q', signature[band * self.rows:(band + 1) * self.rows]).tobytes(),
+                           domain_hash)
+                for band in range(self.bands)]
+
+
+def similarity(signature, other):
+    """Estimate the Jaccard similarity of two sets from their signatures."""
+    return sum(a == b for a, b in zip(signature, other)) / len(signature)
+
+
+class Clusterer:
+    """
+    Incremental near-duplicate clustering of the cached messages.
+
+    The lookups run on the writer connection inside the chunk's transaction, so
+    each message sees the clusters created by the messages before it, and memory
+    use does not grow with the number of clusters.
+    """
+
+    def __init__(self, db, threshold=CLUSTER_SIMILARITY_THRESHOLD, minhasher=None):
+        """
+        Initialize the clusterer.
+
+        Args:
+            db (GmailCacheDB): The cache database.
+            threshold (float): Estimated Jaccard similarity from which a message joins a cluster.
+            minhasher (MinHasher, optional): Default: MinHasher() with the settings of src/config.py.
+        """
+        self.db = db
+        self.threshold = threshold
+        self.minhasher = minhasher or MinHasher()
+
+    def run(self, chunk_size=CHUNK_SIZE):
+        """
+        Cluster every cached message that is not in a cluster yet.
+
+        Args:
+            chunk_size (int): Messages per write transaction.
+
+        Returns:
+            dict: 'messages' clustered, how many joined a cluster 'by_template' or
+                  'by_similarity', 'new_clusters' created and 'seconds' taken.
+        """
+        stats = {'messages': 0, 'by_template': 0, 'by_similarity': 0, 'new_clusters': 0}
+        start = time.perf_counter()
+        conn = self.db.get_read_connection()
+        try:
+            cursor = conn.execute("""
+                SELECT r.message_id, r.from_address, r.subject, r.snippet, s.address, s.domain
+                FROM message_rich_metadata r
+                LEFT JOIN senders s ON s.sender_id = r.sender_id
+                WHERE NOT EXISTS (SELECT 1 FROM message_clusters c WHERE c.message_id = r.message_id)
+            """)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                with self.db.write_transaction() as write_conn:
+                    for row in rows:
+                        stats[self._assign(write_conn, *row)] += 1
+                stats['messages'] += len(rows)
+                metrics.count('cluster.messages', len(rows))
+        finally:
+            self.db.close_connection(conn)
+        stats['seconds'] = time.perf_counter() - start
+        return stats
+
+    def _assign(self, conn, message_id, from_address, subject, snippet, address, domain):
+        """
+        Put one message into a cluster, creating the cluster if needed.
+
+        Returns:
+            str: How the cluster was found: 'by_template', 'by_similarity' or 'new_clusters'.
+        """
+        if address is None and from_address:
+            address, _, domain = parse_sender(from_address)
+        template = normalize_subject(subject)
+        key = template_key(address, template)
+        row = conn.execute("SELECT cluster_id FROM cluster_templates WHERE template_key = ?", (key,)).fetchone()
+        if row:
+            outcome, cluster_id = 'by_template', row[0]
+        else:
+            outcome, cluster_id, signature, buckets = 'new_clusters', None, None, []
+            message_shingles = shingles(template, normalize_text(snippet))
+            if message_shingles:
+                minhash_start = time.perf_counter()
+                signature = self.minhasher.signature(message_shingles)
+                buckets = self.minhasher.buckets(domain, signature)
+                metrics.add_time('cluster.minhash', time.perf_counter() - minhash_start)
+                cluster_id = self._most_similar(conn, domain, signature, buckets)
+                if cluster_id is not None:
+                    outcome = 'by_similarity'
+            if cluster_id is None:
+                cluster_id = conn.execute(
+                    "INSERT INTO clusters (sender_domain, template, signature) VALUES (?, ?, ?)",
+                    (domain, template, array('Q', signature).tobytes() if signature else None)
+                ).lastrowid
+                conn.executemany("INSERT OR IGNORE INTO cluster_buckets (bucket, cluster_id) VALUES (?, ?)",
+                                 [(bucket, cluster_id) for bucket in buckets])
+            conn.execute("INSERT OR IGNORE INTO cluster_templates (template_key, cluster_id) VALUES (?, ?)", (key, cluster_id))
+        conn.execute("INSERT INTO message_clusters (message_id, cluster_id) VALUES (?, ?)", (message_id, cluster_id))
+        return outcome
+
+    def _most_similar(self, conn, domain, signature, buckets):
+        """Return the most similar cluster of the domain sharing a bucket, if it reaches the threshold."""
+        placeholders = ','.join('?' * len(buckets))
+        candidates = conn.execute(f"""
+            SELECT c.cluster_id, c.signature FROM clusters c
+            WHERE c.cluster_id IN (SELECT cluster_id FROM cluster_buckets WHERE bucket IN ({placeholders}))
+            AND c.sender_domain IS ?
+        """, [*buckets, domain]).fetchall()
+        best_id, best_similarity = None, self.threshold
+        for cluster_id, blob in candidates:
+            score = similarity(signature, array('Q', blob))
+            if score >= best_similarity:
+                best_id, best_similarity = cluster_id, score
+        return best_id
+
+    def rebuild(self):
+        """
+        Drop every cluster, with its category, so the next run() clusters all messages again.
+
+        Needed after changing the MinHash settings, which makes stored signatures incomparable.
+        """
+        with self.db.write_transaction() as conn:
+            for table in ('message_clusters', 'cluster_buckets', 'cluster_templates', 'clusters'):
+                conn.execute(f"DELETE FROM {table}")
+
+    def print_summary(self, stats, top=10):
+        """
+        Print the outcome of a run and the largest clusters.
+
+        Args:
+            stats (dict): The result of run().
+            top (int): Number of clusters to list.
+        """
+        print(f"Clustered {stats['messages']} new messages in {stats['seconds']:.1f}s: {stats['by_template']} by template, "
+              f"{stats['by_similarity']} by similarity, {stats['new_clusters']} new clusters.")
+        conn = self.db.get_read_connection()
+        try:
+            cluster_count, message_count = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(member_count), 0) FROM clusters WHERE member_count > 0"
+            ).fetchone()
+            rows = conn.execute("""
+                SELECT member_count, sender_domain, template, category FROM clusters
+                WHERE member_count > 0 ORDER BY member_count DESC LIMIT ?
+            """, (max(top, 0),)).fetchall()
+        finally:
+            self.db.close_connection(conn)
+        if cluster_count:
+            print(f"{message_count} cached messages in {cluster_count} clusters "
+                  f"({message_count / cluster_count:.1f} messages per cluster).")
+        if rows:
+            print(f"\n{'Messages':>9}  {'Domain':<28} {'Category':<12} Template")
+        for member_count, domain, template, category in rows:
+            print(f"{member_count:>9}  {(domain or 'N/A')[:28]:<28} {category or '-':<12} {template or '(no subject)'}")
@@ -2,5 +2,94 @@ import os
 
 # Define paths
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
+# Scopes for Phase Two actions: label changes and trash need gmail.modify,
+# permanent deletion (batchDelete) needs full mailbox access
+MODIFY_SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
+FULL_ACCESS_SCOPES = ['https://mail.google.com/']
+# Gmail scopes from narrowest to broadest; a broader scope covers the narrower ones
+SCOPE_LEVELS = SCOPES + MODIFY_SCOPES + FULL_ACCESS_SCOPES
 CREDENTIALS_FILENAME = os.path.join(os.path.dirname(__file__), 'config', 'credentials.json')
-TOKEN_FILENAME = os.path.join(os.path.dirname(__file__), 'token.pickle')
\ No newline at end of file
+TOKEN_FILENAME = os.path.join(os.path.dirname(__file__), 'token.pickle')
+# Account profiles for multi-account use (see accounts.py); each profile's token and cache
+# default to PROFILES_DIR/<name>/token.pickle and PROFILES_DIR/<name>/gmail_cache.db
+ACCOUNTS_FILENAME = os.path.join(os.path.dirname(__file__), 'config', 'accounts.json')
+PROFILES_DIR = os.path.join(os.path.dirname(__file__), 'profiles')
+# Local copy of the Gmail API discovery document (see gmail_service.py), refreshed after DISCOVERY_CACHE_MAX_AGE_DAYS
+DISCOVERY_CACHE_FILENAME = os.path.join(os.path.dirname(__file__), 'gmail_discovery.json')
+DISCOVERY_CACHE_MAX_AGE_DAYS = 30
+
+# Gmail API quota (https://developers.google.com/gmail/api/reference/quota)
+# Per-user limit, in quota units per second
+QUOTA_UNITS_PER_SECOND = 250
+# Quota units charged for each API method
+QUOTA_UNITS_PER_METHOD = {
+    'getProfile': 1,
+    'labels.list': 1,
+    'history.list': 2,
+    'messages.list': 5,
+    'messages.get': 5,
+    'messages.modify': 5,
+    'messages.trash': 5,
+    'messages.batchModify': 50,
+    'messages.batchDelete': 50,
+    'threads.list': 10,
+    'threads.get': 10,
+}
+
+# Projection profiles for metadata fetches. 'headers' is sent as metadataHeaders and
+# limits the headers Gmail returns and we store (None means all headers); 'fields' is
+# a partial-response mask for the messages.get response (None means every field); thread-mode
+# sync applies it to each message of the threads.get response.
+PROJECTION_PROFILES = {
+    'lean': {
+        'headers': ['From', 'To', 'Subject', 'Date', 'List-Id', 'List-Unsubscribe'],
+        'fields': 'id,threadId,labelIds,snippet,historyId,internalDate,sizeEstimate,'
+                  'payload(mimeType,filename,headers,parts(mimeType,filename,parts))',
+    },
+    'full': {
+        'headers': None,
+        'fields': None,
+    },
+}
+DEFAULT_PROJECTION = 'lean'
+
+# Full-sync strategies: 'message' lists and fetches message by message (messages.list/get),
+# 'thread' lists and fetches whole conversations (threads.list/get), one call per thread
+SYNC_MODES = ['message', 'thread']
+DEFAULT_SYNC_MODE = 'message'
+# Page size of messages.list and threads.list calls that do not send maxResults
+LIST_PAGE_SIZE = 100
+# Labels a new cache mirrors. ALL_MAIL stands for every message outside spam and trash
+# (a listing without labelIds); it is not a real Gmail label ID.
+DEFAULT_SYNC_LABELS = ['INBOX']
+ALL_MAIL = 'ALL_MAIL'
+
+# refresh-labels skips messages whose labels were verified (or fetched) less than this
+# many seconds ago; the others are re-checked newest first with format='minimal' gets
+LABEL_CHECK_MAX_AGE_SECONDS = 3600
+# Response fields of a label check: no headers, snippet or payload
+LABEL_CHECK_FIELDS = 'id,labelIds,historyId'
+
+# Gmail accepts at most 1000 message IDs per batchModify/batchDelete call
+BATCH_ACTION_CHUNK_SIZE = 1000
+
+# Cache-first reads (get-message, list-messages, list-labels): cached data younger
+# than this many seconds is served without an API call. Older data is served only
+# if Gmail's historyId shows the mailbox has not changed since the last sync.
+CACHE_TTL_SECONDS = 300
+# get-message formats that can be answered from the cached metadata
+CACHED_MESSAGE_FORMATS = ['metadata', 'minimal']
+
+# Size budget of the raw message body store (gmail_bodies.db); least recently used
+# messages are evicted beyond it
+BODY_STORE_BUDGET_MB = 2048
+
+# Near-duplicate clustering of cached messages (see clustering.py): MinHash signature
+# size (at most 64), LSH bands (must divide the signature size), and the estimated
+# Jaccard similarity from which a message joins a cluster of the same sender domain
+CLUSTER_SIGNATURE_SIZE = 64
+CLUSTER_LSH_BANDS = 16
+CLUSTER_SIMILARITY_THRESHOLD = 0.6
+# Cluster representatives per classifier call, and concurrent calls (see classification.py)
+CLASSIFY_BATCH_SIZE = 20
+CLASSIFY_WORKERS = 4
@@ -0,0 +1,712 @@
+"""
+An offline stand-in for the Gmail API service object.
+
+FakeGmailService mimics the parts of the googleapiclient Gmail resource that this
+project uses (users.getProfile, users.labels.list, users.messages.list/get/
+batchModify/batchDelete, users.threads.list/get, users.history.list and batch
+requests) on top of a
+synthetic FakeMailbox, so sync and action code can be exercised and benchmarked
+without a Google account:
+
+    mailbox = FakeMailbox(message_count=100000)
+    service = FakeGmailService(mailbox, error_rate=0.01, latency=0.05)
+    accessor = MessageAccesor(service=service, service_factory=service.clone, db=GmailCacheDB(path))
+    accessor.get_all_messages()
+    print(service.stats.summary())
+
+Messages are generated deterministically from their index, so a mailbox of a
+million messages costs almost no memory until messages are changed.
+"""
+import base64
+import json
+import random
+import threading
+import time
+from collections import Counter
+from email.message import EmailMessage
+from email.policy import SMTP
+from functools import lru_cache
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from src import metrics
+from src.config import QUOTA_UNITS_PER_METHOD
+
+SYSTEM_LABELS = ['INBOX', 'SENT', 'DRAFT', 'SPAM', 'TRASH', 'UNREAD', 'STARRED', 'IMPORTANT',
+                 'CATEGORY_PERSONAL', 'CATEGORY_SOCIAL', 'CATEGORY_PROMOTIONS', 'CATEGORY_UPDATES',
+                 'CATEGORY_FORUMS']
+
+# Probability of each label on a generated message (INBOX covers the rest as archived)
+DEFAULT_LABEL_MIX = {
+    'INBOX': 0.8,
+    'UNREAD': 0.35,
+    'IMPORTANT': 0.1,
+    'STARRED': 0.02,
+    'CATEGORY_PROMOTIONS': 0.4,
+    'CATEGORY_UPDATES': 0.25,
+    'CATEGORY_SOCIAL': 0.1,
+}
+
+SUBJECT_TEMPLATES = [
+    'Your order #{n} has shipped',
+    'Weekly digest: {n} new updates',
+    '{name}, your invoice for {month} is ready',
+    'Re: Meeting notes {n}',
+    'Sale ends tonight - {n}% off everything',
+    'Security alert for your account',
+    '[list-{d}] Discussion thread {n}',
+    'Your receipt from {domain}',
+]
+
+# Base timestamp for generated messages (2023-11-14), in milliseconds
+BASE_TIME_MS = 1700000000000
+
+# History ID of a new mailbox, and of every message and thread that has not changed since
+INITIAL_HISTORY_ID = 1000
+
+# Raw messages (format='raw') attach one of this many distinct files, so the same
+# attachment recurs across messages like a sender's standard PDF
+ATTACHMENT_POOL_SIZE = 16
+
+
+def make_http_error(status, reason='rateLimitExceeded', message='Injected error'):
+    """
+    Build an HttpError like the ones googleapiclient raises.
+
+    Args:
+        status (int): HTTP status code.
+        reason (str): Gmail error reason.
+        message (str): Error message.
+
+    Returns:
+        HttpError: The error object.
+    """
+    content = json.dumps({'error': {'code': status, 'message': message,
+                                    'errors': [{'reason': reason, 'message': message}]}}).encode('utf-8')
+    return HttpError(httplib2.Response({'status': status}), content)
+
+
+class FakeStats:
+    """Thread-safe counters shared by a fake service and its clones."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = Counter()
+        self.quota_units = 0
+        self.bytes_sent = 0
+        self.batches = 0
+        self.batched_calls = 0
+        self.errors_injected = Counter()
+
+    def record(self, method, response=None, batched=False):
+        """Count one API call (or batch sub-request) and its response size."""
+        size = len(json.dumps(response, separators=(',', ':'))) if response is not None else 0
+        # Report to the metrics like the real HTTP client does (see gmail_service.build_gmail_service)
+        metrics.count('api.http_requests', not batched)
+        metrics.count('api.bytes_received', size)
+        with self._lock:
+            self.calls[method] += 1
+            self.batched_calls += batched
+            self.quota_units += QUOTA_UNITS_PER_METHOD.get(method, 5)
+            self.bytes_sent += size
+
+    def record_error(self, status):
+        with self._lock:
+            self.errors_injected[status] += 1
+
+    def record_batch(self):
+        metrics.count('api.http_requests')
+        with self._lock:
+            self.batches += 1
+
+    def summary(self):
+        """
+        Return the counters as a plain dictionary.
+
+        Returns:
+            dict: 'calls' per method, 'api_calls' total, 'http_requests' (batches count once),
+                  'quota_units', 'bytes' and 'errors_injected' per status.
+        """
+        with self._lock:
+            return {
+                'calls': dict(self.calls),
+                'api_calls': sum(self.calls.values()),
+                'http_requests': sum(self.calls.values()) - self.batched_calls + self.batches,
+                'quota_units': self.quota_units,
+                'bytes': self.bytes_sent,
+                'errors_injected': dict(self.errors_injected),
+            }
+
+
+class FakeMailbox:
+    """
+    A synthetic, deterministic mailbox with a change history.
+
+    Message i is generated on demand from (seed, i). Changes made through
+    add_messages, delete_messages and modify_labels are stored as overrides and
+    recorded as history records, like Gmail's users.history.
+    """
+
+    def __init__(self, message_count=1000, seed=0, label_mix=None, sender_count=2000, domain_count=200,
+                 extra_headers=20, header_size=200, attachment_rate=0.1, thread_size=3, years=8,
+                 history_retention=None):
+        """
+        Initialize the mailbox.
+
+        Args:
+            message_count (int): Number of messages initially in the mailbox.
+            seed (int): Seed for the generator; the same seed gives the same mailbox.
+            label_mix (dict, optional): Probability of each label; defaults to DEFAULT_LABEL_MIX.
+            sender_count (int): Number of distinct senders (picked with a long-tailed distribution).
+            domain_count (int): Number of distinct sender domains.
+            extra_headers (int): Received/DKIM/ARC style headers added to each message.
+            header_size (int): Size in bytes of each extra header value.
+            attachment_rate (float): Probability that a message has attachments.
+            thread_size (int): Number of consecutive messages per thread.
+            years (int): Messages are spread over this many years before BASE_TIME_MS.
+            history_retention (int, optional): Number of history records kept; older start
+                                               history IDs get a 404 like an expired cursor.
+        """
+        self.seed = seed
+        self.label_mix = label_mix or DEFAULT_LABEL_MIX
+        self.sender_count = sender_count
+        self.domain_count = domain_count
+        self.extra_headers = extra_headers
+        self.header_size = header_size
+        self.attachment_rate = attachment_rate
+        self.thread_size = max(1, thread_size)
+        self.span_ms = int(years * 365 * 86400 * 1000)
+        self.history_retention = history_retention
+
+        self._lock = threading.RLock()
+        self.message_count = message_count   # Indexes 0..message_count-1 have been created
+        self.deleted = set()
+        self.label_overrides = {}
+        self.history_id = INITIAL_HISTORY_ID
+        self.history = []                    # (history_id, record) pairs
+        self.changed_at = {}                 # Message index or thread ID -> history ID of its last change
+
+    # -- Message generation --------------------------------------------------
+
+    @staticmethod
+    def message_id(index):
+        return f'{index:016x}'
+
+    @staticmethod
+    def message_index(message_id):
+        return int(message_id, 16)
+
+    def _rng(self, index, stream=0):
+        # Separate streams keep a message's labels independent of its content
+        return random.Random((self.seed * 1000003 + index) * 2 + stream)
+
+    def _generated_labels(self, index):
+        rng = self._rng(index, stream=1)
+        return [label for label, probability in self.label_mix.items() if rng.random() < probability]
+
+    def labels_of(self, index):
+        """Current label IDs of a message."""
+        with self._lock:
+            labels = self.label_overrides.get(index)
+        return list(labels) if labels is not None else self._generated_labels(index)
+
+    def exists(self, index):
+        return 0 <= index < self.message_count and index not in self.deleted
+
+    def thread_id(self, index):
+        return f'{index // self.thread_size:016x}'
+
+    def thread_indexes(self, thread_id):
+        """Indexes of the existing messages in a thread, oldest first."""
+        first = int(thread_id, 16) * self.thread_size
+        return [index for index in range(first, first + self.thread_size) if self.exists(index)]
+
+    def thread_history_id(self, thread_id):
+        """History ID of the last change to any message of a thread, including deletions."""
+        with self._lock:
+            return self.changed_at.get(thread_id, INITIAL_HISTORY_ID)
+
+    def message(self, index):
+        """
+        Build the full message resource (format='metadata') for a message index.
+
+        Returns:
+            dict: The message resource, or None if the message does not exist.
+        """
+        if not self.exists(index):
+            return None
+        rng = self._rng(index)
+        sender_rank = min(int(rng.paretovariate(1.2)) - 1, self.sender_count - 1)
+        domain = f'example{sender_rank % self.domain_count}.com'
+        sender = f'Sender {sender_rank} <news{sender_rank}@{domain}>'
+        internal_date = BASE_TIME_MS - self.span_ms + int(self.span_ms * index / max(1, self.message_count))
+        subject = rng.choice(SUBJECT_TEMPLATES).format(
+            n=rng.randint(1, 99999), name='Alex', month='March', d=sender_rank % 7, domain=domain)
+
+        headers = [
+            {'name': 'From', 'value': sender},
+            {'name': 'To', 'value': 'me@example.org'},
+            {'name': 'Subject', 'value': subject},
+            {'name': 'Date', 'value': time.strftime('%a, %d %b %Y %H:%M:%S +0000', time.gmtime(internal_date / 1000))},
+            {'name': 'Message-ID', 'value': f'<{index}.{sender_rank}@{domain}>'},
+        ]
+        if sender_rank % 3 == 0:
+            headers.append({'name': 'List-Unsubscribe', 'value': f'<https://{domain}/unsubscribe>'})
+        for i in range(self.extra_headers):
+            headers.append({'name': ('Received', 'DKIM-Signature', 'ARC-Seal')[i % 3], 'value': 'x' * self.header_size})
+
+        parts = [{'partId': '0', 'mimeType': 'text/plain', 'filename': '', 'headers': [], 'body': {'size': 2000}}]
+        size = 4000 + self.extra_headers * self.header_size + rng.randint(0, 20000)
+        if rng.random() < self.attachment_rate:
+            attachment_size = rng.randint(10000, 8000000)
+            size += attachment_size
+            parts.append({'partId': '1', 'mimeType': 'multipart/mixed', 'filename': '', 'headers': [], 'parts': [
+                {'partId': '1.0', 'mimeType': 'application/pdf', 'filename': f'document-{index}.pdf',
+                 'headers': [], 'body': {'size': attachment_size}},
+            ]})
+
+        return {
+            'id': self.message_id(index),
+            'threadId': self.thread_id(index),
+            'labelIds': self.labels_of(index),
+            'snippet': f'{subject} - view this email in your browser ' + 'lorem ipsum ' * 8,
+            'historyId': str(self.changed_at.get(index, INITIAL_HISTORY_ID)),
+            'internalDate': str(internal_date),
+            'sizeEstimate': size,
+            'payload': {'partId': '', 'mimeType': 'multipart/mixed', 'filename': '', 'headers': headers,
+                        'body': {'size': 0}, 'parts': parts},
+        }
+
+    def raw_message(self, index):
+        """
+        Build the RFC822 message (format='raw') for a message index.
+
+        The HTML body is a per-sender template and attachments come from a small
+        pool, so raw messages repeat content the way real newsletters do.
+
+        Returns:
+            bytes: The message with CRLF line endings, or None if it does not exist.
+        """
+        message = self.message(index)
+        if message is None:
+            return None
+        headers = message['payload']['headers']
+        sender_rank = int(headers[4]['value'].split('.')[1].split('@')[0])
+        subject = headers[2]['value']
+
+        email = EmailMessage(policy=SMTP)
+        for header in headers:
+            email[header['name']] = header['value']
+        email.set_content(f'{subject}\n\nHello Alex,\n\n' + 'lorem ipsum dolor sit amet ' * 20 + f'\n\nMessage {index}\n')
+        email.add_alternative(_newsletter_html(sender_rank), subtype='html')
+        attachments = message['payload']['parts'][1:]
+        if attachments:
+            pool_index = sender_rank % ATTACHMENT_POOL_SIZE
+            email.add_attachment(_attachment(pool_index), maintype='application', subtype='pdf',
+                                 filename=f'document-{pool_index}.pdf')
+        # Fixed boundaries keep the message identical from one call to the next
+        for number, part in enumerate(part for part in email.walk() if part.is_multipart()):
+            part.set_boundary(f'=_part_{index}_{number}')
+        return email.as_bytes()
+
+    # -- Changes and history -------------------------------------------------
+
+    def _record(self, record):
+        self.history_id += 1
+        record['id'] = str(self.history_id)
+        self.history.append((self.history_id, record))
+        for stub in record['messages']:
+            self.changed_at[self.message_index(stub['id'])] = self.history_id
+            self.changed_at[stub['threadId']] = self.history_id
+        if self.history_retention and len(self.history) > self.history_retention:
+            del self.history[:len(self.history) - self.history_retention]
+
+    def _stub(self, index):
+        return {'id': self.message_id(index), 'threadId': self.thread_id(index), 'labelIds': self.labels_of(index)}
+
+    def add_messages(self, count, labels=('INBOX', 'UNREAD')):
+        """
+        Deliver new messages.
+
+        Returns:
+            list: IDs of the new messages.
+        """
+        with self._lock:
+            new_ids = []
+            for _ in range(count):
+                index = self.message_count
+                self.message_count += 1
+                self.label_overrides[index] = list(labels)
+                self._record({'messages': [self._stub(index)], 'messagesAdded': [{'message': self._stub(index)}]})
+                new_ids.append(self.message_id(index))
+            return new_ids
+
+    def delete_messages(self, message_ids):
+        """Permanently delete messages."""
+        with self._lock:
+            for message_id in message_ids:
+                index = self.message_index(message_id)
+                if self.exists(index):
+                    stub = self._stub(index)
+                    self.deleted.add(index)
+                    self._record({'messages': [stub], 'messagesDeleted': [{'message': stub}]})
+
+    def modify_labels(self, message_ids, add=(), remove=()):
+        """Add and remove labels on messages."""
+        with self._lock:
+            for message_id in message_ids:
+                index = self.message_index(message_id)
+                if not self.exists(index):
+                    continue
+                labels = self.labels_of(index)
+                added = [label for label in add if label not in labels]
+                removed = [label for label in remove if label in labels]
+                labels = [label for label in labels if label not in removed] + added
+                self.label_overrides[index] = labels
+                stub = self._stub(index)
+                if added:
+                    self._record({'messages': [stub], 'labelsAdded': [{'message': stub, 'labelIds': added}]})
+                if removed:
+                    self._record({'messages': [stub], 'labelsRemoved': [{'message': stub, 'labelIds': removed}]})
+
+    def history_since(self, start_history_id):
+        """
+        Return the history records after a history ID.
+
+        Raises:
+            HttpError: 404 if the start ID is older than the retained history.
+        """
+        with self._lock:
+            oldest = self.history[0][0] if self.history else self.history_id + 1
+            if self.history_retention and int(start_history_id) < oldest - 1:
+                raise make_http_error(404, 'notFound', 'Requested entity was not found.')
+            return [record for history_id, record in self.history if history_id > int(start_history_id)]
+
+
+class FakeRequest:
+    """A deferred API call, like googleapiclient.http.HttpRequest."""
+
+    def __init__(self, service, method, handler):
+        self.service = service
+        self.method = method
+        self.handler = handler
+
+    def execute(self):
+        self.service._sleep()
+        self.service._maybe_fail()
+        return self.service._respond(self.method, self.handler)
+
+
+class FakeBatch:
+    """A batch of requests, like googleapiclient.http.BatchHttpRequest."""
+
+    def __init__(self, service):
+        self.service = service
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        if len(self.requests) >= 100:
+            raise ValueError("Exceeded maximum calls (100) in a single batch")
+        self.requests.append((request, callback, request_id or str(len(self.requests) + 1)))
+
+    def execute(self):
+        self.service._sleep()
+        self.service.stats.record_batch()
+        for request, callback, request_id in self.requests:
+            try:
+                self.service._maybe_fail()
+                response = self.service._respond(request.method, request.handler, batched=True)
+                exception = None
+            except HttpError as error:
+                response, exception = None, error
+            if callback:
+                callback(request_id, response, exception)
+
+
+class _Resource:
+    """Routes attribute access like service.users().messages() to handler methods."""
+
+    def __init__(self, service, name):
+        self._service = service
+        self._name = name
+
+    def __getattr__(self, attribute):
+        handler = getattr(self._service, f'_{self._name}_{attribute}', None)
+        if handler is None:
+            raise AttributeError(f"Fake Gmail service has no {self._name}.{attribute}")
+        return handler
+
+
+class FakeGmailService:
+    """
+    A drop-in replacement for build('gmail', 'v1', ...) backed by a FakeMailbox.
+
+    Failures are injected per request (and per batch sub-request): error_rate is the
+    probability of a 429, server_error_rate the probability of a 500. latency is
+    slept once per HTTP request, so a batch costs one latency like the real API.
+    """
+
+    def __init__(self, mailbox, error_rate=0.0, server_error_rate=0.0, latency=0.0, page_size=100,
+                 stats=None, seed=None):
+        """
+        Initialize the service.
+
+        Args:
+            mailbox (FakeMailbox): The synthetic mailbox to serve.
+            error_rate (float): Probability of a 429 rateLimitExceeded per request.
+            server_error_rate (float): Probability of a 500 backendError per request.
+            latency (float): Seconds slept per HTTP request (batches count once).
+            page_size (int): Default page size of list calls (Gmail's default is 100).
+            stats (FakeStats, optional): Counters to share with other services.
+            seed (int, optional): Seed for error injection.
+        """
+        self.mailbox = mailbox
+        self.error_rate = error_rate
+        self.server_error_rate = server_error_rate
+        self.latency = latency
+        self.page_size = page_size
+        self.stats = stats or FakeStats()
+        self._random = random.Random(seed)
+
+    def clone(self):
+        """Return another service on the same mailbox and counters, like a per-thread client."""
+        return FakeGmailService(self.mailbox, self.error_rate, self.server_error_rate, self.latency,
+                                self.page_size, self.stats, self._random.random())
+
+    def users(self):
+        return _Resource(self, 'users')
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self)
+
+    # -- Request plumbing ----------------------------------------------------
+
+    def _sleep(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _maybe_fail(self):
+        roll = self._random.random()
+        if roll < self.error_rate:
+            self.stats.record_error(429)
+            raise make_http_error(429, 'rateLimitExceeded', 'Too many concurrent requests for user')
+        if roll < self.error_rate + self.server_error_rate:
+            self.stats.record_error(500)
+            raise make_http_error(500, 'backendError', 'Backend Error')
+
+    def _respond(self, method, handler, batched=False):
+        response = handler()
+        self.stats.record(method, response, batched)
+        return response
+
+    # -- users ---------------------------------------------------------------
+
+    def _users_getProfile(self, userId):
+        mailbox = self.mailbox
+        return FakeRequest(self, 'getProfile', lambda: {
+            'emailAddress': 'me@example.org',
+            'messagesTotal': mailbox.message_count - len(mailbox.deleted),
+            'historyId': str(mailbox.history_id),
+        })
+
+    def _users_labels(self):
+        return _Resource(self, 'labels')
+
+    def _users_messages(self):
+        return _Resource(self, 'messages')
+
+    def _users_threads(self):
+        return _Resource(self, 'threads')
+
+    def _users_history(self):
+        return _Resource(self, 'history')
+
+    # -- users.labels --------------------------------------------------------
+
+    def _labels_list(self, userId):
+        return FakeRequest(self, 'labels.list', lambda: {
+            'labels': [{'id': label, 'name': label, 'type': 'system'} for label in SYSTEM_LABELS]
+        })
+
+    # -- users.messages ------------------------------------------------------
+
+    def _listed(self, index, wanted, includeSpamTrash):
+        """Whether a message index matches a list call's labelIds."""
+        if not self.mailbox.exists(index):
+            return False
+        labels = self.mailbox.labels_of(index)
+        hidden = not includeSpamTrash and ('SPAM' in labels or 'TRASH' in labels)
+        return not hidden and wanted.issubset(labels)
+
+    def _format_message(self, index, format, metadataHeaders=None):
+        """Build the message resource for an index in a messages.get/threads.get format, or None."""
+        mailbox = self.mailbox
+        message = mailbox.message(index)
+        if message is None:
+            return None
+        if format == 'minimal':
+            message.pop('payload')
+        elif format == 'raw':
+            raw = mailbox.raw_message(index)
+            message.pop('payload')
+            message['sizeEstimate'] = len(raw)
+            message['raw'] = base64.urlsafe_b64encode(raw).decode('ascii')
+        elif metadataHeaders:
+            wanted = {name.lower() for name in metadataHeaders}
+            message['payload']['headers'] = [header for header in message['payload']['headers']
+                                              if header['name'].lower() in wanted]
+        return message
+
+    def _messages_list(self, userId, labelIds=None, maxResults=None, pageToken=None, q=None, includeSpamTrash=False):
+        mailbox = self.mailbox
+        page_size = min(maxResults or self.page_size, 500)
+        wanted = set(labelIds or [])
+
+        def handler():
+            # Gmail lists newest first; the page token is the next index to scan down from
+            index = int(pageToken) if pageToken else mailbox.message_count - 1
+            messages = []
+            while index >= 0 and len(messages) < page_size:
+                if self._listed(index, wanted, includeSpamTrash):
+                    messages.append({'id': mailbox.message_id(index), 'threadId': mailbox.thread_id(index)})
+                index -= 1
+            response = {'messages': messages, 'resultSizeEstimate': len(messages)}
+            if index >= 0 and messages:
+                response['nextPageToken'] = str(index)
+            if not messages:
+                del response['messages']
+            return response
+
+        return FakeRequest(self, 'messages.list', handler)
+
+    def _messages_get(self, userId, id, format='full', metadataHeaders=None, fields=None):
+        mailbox = self.mailbox
+
+        def handler():
+            message = self._format_message(mailbox.message_index(id), format, metadataHeaders)
+            if message is None:
+                raise make_http_error(404, 'notFound', 'Requested entity was not found.')
+            return _select_fields(message, fields)
+
+        return FakeRequest(self, 'messages.get', handler)
+
+    def _messages_batchModify(self, userId, body):
+        mailbox = self.mailbox
+
+        def handler():
+            _check_batch_ids(body)
+            mailbox.modify_labels(body['ids'], add=body.get('addLabelIds', []), remove=body.get('removeLabelIds', []))
+            return ''
+
+        return FakeRequest(self, 'messages.batchModify', handler)
+
+    def _messages_batchDelete(self, userId, body):
+        mailbox = self.mailbox
+
+        def handler():
+            _check_batch_ids(body)
+            mailbox.delete_messages(body['ids'])
+            return ''
+
+        return FakeRequest(self, 'messages.batchDelete', handler)
+
+    # -- users.threads -------------------------------------------------------
+
+    def _threads_list(self, userId, labelIds=None, maxResults=None, pageToken=None, q=None, includeSpamTrash=False):
+        mailbox = self.mailbox
+        page_size = min(maxResults or self.page_size, 500)
+        wanted = set(labelIds or [])
+
+        def handler():
+            # Threads are runs of consecutive indexes, listed newest first when any member
+            # matches; the page token is the next index to scan down from
+            index = int(pageToken) if pageToken else mailbox.message_count - 1
+            threads = []
+            while index >= 0 and len(threads) < page_size:
+                first = index - index % mailbox.thread_size
+                members = [i for i in range(first, index + 1) if self._listed(i, wanted, includeSpamTrash)]
+                if members:
+                    thread_id = mailbox.thread_id(index)
+                    threads.append({'id': thread_id, 'snippet': mailbox.message(members[-1])['snippet'],
+                                    'historyId': str(mailbox.thread_history_id(thread_id))})
+                index = first - 1
+            response = {'threads': threads, 'resultSizeEstimate': len(threads)}
+            if index >= 0 and threads:
+                response['nextPageToken'] = str(index)
+            if not threads:
+                del response['threads']
+            return response
+
+        return FakeRequest(self, 'threads.list', handler)
+
+    def _threads_get(self, userId, id, format='full', metadataHeaders=None, fields=None):
+        mailbox = self.mailbox
+
+        def handler():
+            messages = [self._format_message(index, format, metadataHeaders) for index in mailbox.thread_indexes(id)]
+            if not messages:
+                raise make_http_error(404, 'notFound', 'Requested entity was not found.')
+            thread = {'id': id, 'historyId': str(mailbox.thread_history_id(id)), 'messages': messages}
+            return _select_fields(thread, fields)
+
+        return FakeRequest(self, 'threads.get', handler)
+
+    # -- users.history -------------------------------------------------------
+
+    def _history_list(self, userId, startHistoryId, historyTypes=None, labelId=None, pageToken=None, maxResults=100):
+        mailbox = self.mailbox
+
+        def handler():
+            records = mailbox.history_since(startHistoryId)
+            start = int(pageToken) if pageToken else 0
+            page = records[start:start + maxResults]
+            response = {'history': page, 'historyId': str(mailbox.history_id)}
+            if start + maxResults < len(records):
+                response['nextPageToken'] = str(start + maxResults)
+            return response
+
+        return FakeRequest(self, 'history.list', handler)
+
+
+@lru_cache(maxsize=None)
+def _newsletter_html(sender_rank):
+    """The HTML body every message from one sender shares."""
+    rows = ''.join(f'<tr><td class="item">Offer {i} from sender {sender_rank}</td></tr>\n' for i in range(60))
+    return f'<html><body><h1>Sender {sender_rank} newsletter</h1><table>\n{rows}</table></body></html>\n'
+
+
+@lru_cache(maxsize=ATTACHMENT_POOL_SIZE)
+def _attachment(pool_index):
+    """Incompressible attachment content for one pool entry (20-200 KB)."""
+    rng = random.Random(pool_index)
+    return rng.randbytes(rng.randint(20000, 200000))
+
+
+def _check_batch_ids(body):
+    """Reject batchModify/batchDelete bodies that Gmail would reject."""
+    if not body.get('ids') or len(body['ids']) > 1000:
+        raise make_http_error(400, 'invalidArgument', 'ids must contain between 1 and 1000 message IDs')
+
+
+def _select_fields(resource, fields):
+    """Apply a partial-response field mask; only top-level field selection is emulated."""
+    if not fields:
+        return resource
+    top_level = {field.split('(')[0] for field in _split_fields(fields)}
+    return {key: value for key, value in resource.items() if key in top_level}
+
+
+def _split_fields(fields):
+    """Split a partial-response field mask on top-level commas."""
+    depth, current, result = 0, '', []
+    for char in fields:
+        if char == ',' and depth == 0:
+            result.append(current)
+            current = ''
+            continue
+        depth += (char == '(') - (char == ')')
+        current += char
+    if current:
+        result.append(current)
+    return result
@@ -1,11 +1,67 @@
 import sqlite3
 import os
-from src.config import TOKEN_FILENAME
+import json
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parseaddr
+from src import metrics
+from src.config import TOKEN_FILENAME, DEFAULT_SYNC_LABELS, ALL_MAIL
 
 # Define the default database filename
 DB_FILENAME = 'gmail_cache.db'
 DEFAULT_DB_PATH = os.path.join(os.path.dirname(TOKEN_FILENAME), DB_FILENAME)
 
+# Schema version stored in PRAGMA user_version. Version 0 is the original schema;
+# GmailCacheDB._migrate upgrades older cache files in place one version at a time.
+SCHEMA_VERSION = 8
+
+# Per-connection tuning applied to every connection. The cache can always be
+# rebuilt from Gmail, so synchronous=NORMAL (durable at checkpoint, not at every
+# commit in WAL mode) is a good trade for write throughput.
+CONNECTION_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,       # Negative means KiB, so ~64 MB of page cache
+    'mmap_size': 268435456,     # Memory-map up to 256 MB of the database file
+    'temp_store': 'MEMORY',
+    'busy_timeout': 30000,      # Wait up to 30 s for another writer instead of failing
+}
+
+def parse_sender(from_address):
+    """
+    Split a raw From header into its normalized parts.
+    
+    Args:
+        from_address (str): The raw From header value (e.g. 'Name <User@Example.com>').
+        
+    Returns:
+        tuple: (address, display_name, domain). The address and domain are lowercased;
+               if no email address can be parsed, the whole header is used as the address.
+    """
+    display_name, address = parseaddr(from_address)
+    address = (address or from_address).strip().lower()
+    domain = address.rsplit('@', 1)[1] if '@' in address else None
+    return address, display_name or None, domain
+
+def in_sync_scope(label_ids, sync_labels):
+    """
+    Whether messages with these labels belong in a cache that mirrors sync_labels.
+    
+    A listing filtered by label_ids (all of them must match, like messages.list)
+    is covered by the cache under the same test.
+    
+    Args:
+        label_ids (list): Label IDs of a message, or of a listing filter.
+        sync_labels (list): The labels the cache mirrors (see GmailCacheDB.get_sync_labels).
+        
+    Returns:
+        bool: True if the message is mirrored: it has one of sync_labels, or the cache
+              mirrors ALL_MAIL and the message is not in spam or trash.
+    """
+    if ALL_MAIL in sync_labels:
+        return 'SPAM' not in label_ids and 'TRASH' not in label_ids
+    return any(label_id in sync_labels for label_id in label_ids)
+
 class GmailCacheDB:
     # Rest of the class remains unchanged
     """
@@ -30,6 +86,14 @@ class GmailCacheDB:
         if db_dir and not os.path.exists(db_dir):
             os.makedirs(db_dir, exist_ok=True)
         
+        # Long-lived writer connection, created on first use and shared by all threads.
+        # The lock makes sure only one thread uses it (one transaction) at a time.
+        self._writer_conn = None
+        self._write_lock = threading.RLock()
+        
+        # Raw From header -> sender_id, so each sync resolves a sender only once
+        self._sender_ids = {}
+        
         # Initialize the database (create tables if they don't exist)
         self._initialize_database()
     
@@ -42,6 +106,10 @@ class GmailCacheDB:
         conn = self.get_db_connection()
         cursor = conn.cursor()
         
+        # WAL lets readers run concurrently with the writer and turns most commits
+        # into sequential appends. The journal mode is persistent in the file.
+        cursor.execute("PRAGMA journal_mode=WAL")
+        
         # Create message_stubs table for basic message metadata
         # This table stores the minimal info about each message
         cursor.execute('''
@@ -66,15 +134,490 @@ class GmailCacheDB:
             has_attachments INTEGER,
             attachment_filenames_json TEXT,
             payload_headers_json TEXT,
+            history_id INTEGER,
             rich_last_fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY(message_id) REFERENCES message_stubs(message_id)
         )
         ''')
         
-        # Commit changes and close the connection
+        # Cache files created before incremental sync existed lack the
+        # per-message history ID, so add it in place
+        self._ensure_column(cursor, 'message_rich_metadata', 'history_id', 'INTEGER')
+        
+        # Create sync_state table as a small key/value store for sync cursors
+        # (e.g. the mailbox historyId recorded at the end of the last sync)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sync_state (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        
+        # Create sync_checkpoints table so an interrupted full sync can be resumed
+        # Phases: 'listing' (paging through stubs), 'fetching' (rich metadata), 'done'
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sync_checkpoints (
+            label_id TEXT PRIMARY KEY,
+            phase TEXT NOT NULL,
+            page_token TEXT,
+            history_id TEXT,
+            messages_listed INTEGER DEFAULT 0,
+            batches_committed INTEGER DEFAULT 0,
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        
+        # Commit changes, bring the schema up to date and close the connection
         conn.commit()
+        self._migrate(conn)
         conn.close()
     
+    def _migrate(self, conn):
+        """
+        Upgrade the schema to SCHEMA_VERSION, one versioned migration at a time.
+        
+        Each migration runs in its own transaction together with the user_version
+        bump, so an interrupted upgrade never leaves a half-migrated file behind.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to the database being upgraded.
+        """
+        migrations = {
+            1: self._migrate_to_v1,
+            2: self._migrate_to_v2,
+            3: self._migrate_to_v3,
+            4: self._migrate_to_v4,
+            5: self._migrate_to_v5,
+            6: self._migrate_to_v6,
+            7: self._migrate_to_v7,
+            8: self._migrate_to_v8,
+        }
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for target_version in range(version + 1, SCHEMA_VERSION + 1):
+            conn.execute("BEGIN")
+            try:
+                migrations[target_version](conn)
+                conn.execute(f"PRAGMA user_version = {target_version}")
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                self._sender_ids.clear()
+                raise
+    
+    def _migrate_to_v1(self, conn):
+        """
+        Version 1: normalized labels and senders, plus indexes for common filters.
+        
+        Adds message_labels (one row per message and label), a deduplicated senders
+        table with the parsed address and domain, a sender_id column on
+        message_rich_metadata, and indexes on date, size, sender and label.
+        Existing rows are backfilled from label_ids_json and from_address.
+        """
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS senders (
+            sender_id INTEGER PRIMARY KEY,
+            address TEXT NOT NULL UNIQUE,
+            display_name TEXT,
+            domain TEXT
+        )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_senders_domain ON senders(domain)")
+        
+        # Keyed by label first, so "messages with label X" is a range scan
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS message_labels (
+            label_id TEXT NOT NULL,
+            message_id TEXT NOT NULL,
+            PRIMARY KEY (label_id, message_id)
+        ) WITHOUT ROWID
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_message_labels_message ON message_labels(message_id)")
+        
+        self._ensure_column(conn.cursor(), 'message_rich_metadata', 'sender_id', 'INTEGER REFERENCES senders(sender_id)')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_rich_internal_date ON message_rich_metadata(internal_date)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_rich_size_estimate ON message_rich_metadata(size_estimate)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_rich_sender_date ON message_rich_metadata(sender_id, internal_date)")
+        
+        # Backfill existing rows in chunks
+        last_id = ''
+        while True:
+            rows = conn.execute('''
+                SELECT message_id, from_address, label_ids_json FROM message_rich_metadata
+                WHERE message_id > ? ORDER BY message_id LIMIT 1000
+            ''', (last_id,)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            conn.executemany(
+                "UPDATE message_rich_metadata SET sender_id = ? WHERE message_id = ?",
+                [(self._get_sender_id(conn, from_address), message_id) for message_id, from_address, _ in rows]
+            )
+            self._replace_labels(conn, [(message_id, json.loads(label_ids_json or '[]')) for message_id, _, label_ids_json in rows])
+    
+    def _migrate_to_v2(self, conn):
+        """
+        Version 2: summary tables for the Phase One insights, kept current by triggers.
+        
+        sender_stats (per-sender count and bytes), month_stats (per-month histogram of
+        internal_date) and cache_counters ('messages', 'bytes', 'unread') are updated
+        by triggers on message_rich_metadata and message_labels, so they change in the
+        same transaction as the rows they summarize. Messages without a sender are
+        counted under sender_id 0, messages without a date under month 'unknown'.
+        """
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS sender_stats (
+            sender_id INTEGER PRIMARY KEY,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            total_bytes INTEGER NOT NULL DEFAULT 0
+        )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sender_stats_count ON sender_stats(message_count)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sender_stats_bytes ON sender_stats(total_bytes)")
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS month_stats (
+            month TEXT PRIMARY KEY,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            total_bytes INTEGER NOT NULL DEFAULT 0
+        )
+        ''')
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS cache_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+        ''')
+        
+        # SQL fragments for the trigger bodies; {row} is NEW or OLD
+        sender_key = "COALESCE({row}.sender_id, 0)"
+        month_key = "COALESCE(strftime('%Y-%m', {row}.internal_date / 1000, 'unixepoch'), 'unknown')"
+        size = "COALESCE({row}.size_estimate, 0)"
+        add_row = f'''
+            INSERT INTO sender_stats (sender_id, message_count, total_bytes) VALUES ({sender_key}, 1, {size})
+                ON CONFLICT(sender_id) DO UPDATE SET message_count = message_count + 1, total_bytes = total_bytes + excluded.total_bytes;
+            INSERT INTO month_stats (month, message_count, total_bytes) VALUES ({month_key}, 1, {size})
+                ON CONFLICT(month) DO UPDATE SET message_count = message_count + 1, total_bytes = total_bytes + excluded.total_bytes;
+            UPDATE cache_counters SET value = value + 1 WHERE name = 'messages';
+            UPDATE cache_counters SET value = value + {size} WHERE name = 'bytes';
+        '''
+        remove_row = f'''
+            UPDATE sender_stats SET message_count = message_count - 1, total_bytes = total_bytes - {size}
+                WHERE sender_id = {sender_key};
+            DELETE FROM sender_stats WHERE sender_id = {sender_key} AND message_count <= 0;
+            UPDATE month_stats SET message_count = message_count - 1, total_bytes = total_bytes - {size}
+                WHERE month = {month_key};
+            DELETE FROM month_stats WHERE month = {month_key} AND message_count <= 0;
+            UPDATE cache_counters SET value = value - 1 WHERE name = 'messages';
+            UPDATE cache_counters SET value = value - {size} WHERE name = 'bytes';
+        '''
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_rich_stats_insert AFTER INSERT ON message_rich_metadata BEGIN
+            {add_row.format(row='NEW')}
+        END
+        ''')
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_rich_stats_delete AFTER DELETE ON message_rich_metadata BEGIN
+            {remove_row.format(row='OLD')}
+        END
+        ''')
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_rich_stats_update
+        AFTER UPDATE OF sender_id, size_estimate, internal_date ON message_rich_metadata BEGIN
+            {remove_row.format(row='OLD')}
+            {add_row.format(row='NEW')}
+        END
+        ''')
+        conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_labels_unread_insert AFTER INSERT ON message_labels
+        WHEN NEW.label_id = 'UNREAD' BEGIN
+            UPDATE cache_counters SET value = value + 1 WHERE name = 'unread';
+        END
+        ''')
+        conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_labels_unread_delete AFTER DELETE ON message_labels
+        WHEN OLD.label_id = 'UNREAD' BEGIN
+            UPDATE cache_counters SET value = value - 1 WHERE name = 'unread';
+        END
+        ''')
+        
+        # Backfill the summaries from the rows already in the cache
+        conn.execute('''
+            INSERT OR REPLACE INTO sender_stats (sender_id, message_count, total_bytes)
+            SELECT COALESCE(sender_id, 0), COUNT(*), SUM(COALESCE(size_estimate, 0))
+            FROM message_rich_metadata GROUP BY COALESCE(sender_id, 0)
+        ''')
+        conn.execute(f'''
+            INSERT OR REPLACE INTO month_stats (month, message_count, total_bytes)
+            SELECT {month_key.format(row='message_rich_metadata')}, COUNT(*), SUM(COALESCE(size_estimate, 0))
+            FROM message_rich_metadata GROUP BY 1
+        ''')
+        conn.execute('''
+            INSERT OR REPLACE INTO cache_counters (name, value)
+            SELECT 'messages', COUNT(*) FROM message_rich_metadata
+            UNION ALL SELECT 'bytes', COALESCE(SUM(size_estimate), 0) FROM message_rich_metadata
+            UNION ALL SELECT 'unread', COUNT(*) FROM message_labels WHERE label_id = 'UNREAD'
+        ''')
+    
+    def _migrate_to_v3(self, conn):
+        """
+        Version 3: a narrow covering index for rule evaluation.
+        
+        Rows of message_rich_metadata carry the snippet and header JSON, so scanning
+        the table reads kilobytes per message. idx_rich_rule_columns holds only the
+        columns rule predicates test; conditions that cannot seek (subject keywords,
+        OR/NOT combinations) scan it instead of the table, and lookups by message_id
+        (from message_labels) are answered from it without touching the row.
+        idx_rich_size_estimate is replaced by idx_rich_size_date for the same reason.
+        """
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_rich_rule_columns
+            ON message_rich_metadata(message_id, sender_id, internal_date, size_estimate, has_attachments, subject)
+        ''')
+        # Size thresholds are usually combined with an age; carry the date so neither needs the row
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_rich_size_date ON message_rich_metadata(size_estimate, internal_date)")
+        conn.execute("DROP INDEX IF EXISTS idx_rich_size_estimate")
+        # Without statistics the planner prefers the unique message_id index, which is not covering
+        conn.execute("PRAGMA analysis_limit = 1000")
+        conn.execute("ANALYZE")
+    
+    def _migrate_to_v4(self, conn):
+        """
+        Version 4: a full-text index over subject, snippet and sender for local search.
+        
+        message_fts is an external-content FTS5 table: it stores only the inverted
+        index and reads the text back from message_rich_metadata by rowid. Triggers
+        keep it in step with every insert, delete and text update, whichever code
+        path writes the row, and existing rows are indexed with 'rebuild'.
+        message_rich_metadata has no INTEGER PRIMARY KEY, so a VACUUM can renumber
+        its rowids; rebuild_search_index() must be run after one.
+        """
+        conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(
+            subject, snippet, from_address,
+            content='message_rich_metadata', content_rowid='rowid',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        ''')
+        # The 'delete' command must be given the old values that were indexed.
+        # Re-fetching a message rewrites every column, so updates only reindex changed text.
+        insert_row = '''
+            INSERT INTO message_fts (rowid, subject, snippet, from_address)
+            VALUES (NEW.rowid, NEW.subject, NEW.snippet, NEW.from_address);
+        '''
+        delete_row = '''
+            INSERT INTO message_fts (message_fts, rowid, subject, snippet, from_address)
+            VALUES ('delete', OLD.rowid, OLD.subject, OLD.snippet, OLD.from_address);
+        '''
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_rich_fts_insert AFTER INSERT ON message_rich_metadata BEGIN
+            {insert_row}
+        END
+        ''')
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_rich_fts_delete AFTER DELETE ON message_rich_metadata BEGIN
+            {delete_row}
+        END
+        ''')
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_rich_fts_update
+        AFTER UPDATE OF subject, snippet, from_address ON message_rich_metadata
+        WHEN OLD.subject IS NOT NEW.subject OR OLD.snippet IS NOT NEW.snippet
+            OR OLD.from_address IS NOT NEW.from_address BEGIN
+            {delete_row}
+            {insert_row}
+        END
+        ''')
+        conn.execute("INSERT INTO message_fts (message_fts) VALUES ('rebuild')")
+    
+    def _migrate_to_v5(self, conn):
+        """
+        Version 5: the mailbox's label definitions, so list-labels can be served locally.
+        
+        The table holds the complete result of the last labels.list call; fetched_at
+        is compared against the cache TTL.
+        """
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS labels (
+            label_id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            type TEXT,
+            fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+    
+    def _migrate_to_v6(self, conn):
+        """
+        Version 6: per-thread summaries for thread-mode sync.
+        
+        threads holds each conversation's cached message count, total size and
+        first/last message date, kept current by triggers on message_rich_metadata
+        (the thread is looked up through message_stubs, which is written first).
+        history_id is the thread's historyId when thread-mode sync last fetched it,
+        so unchanged threads are skipped. message_stubs gets an index on thread_id
+        for the per-thread date lookups.
+        """
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_stubs_thread ON message_stubs(thread_id)")
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS threads (
+            thread_id TEXT PRIMARY KEY,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            total_bytes INTEGER NOT NULL DEFAULT 0,
+            first_date INTEGER,
+            last_date INTEGER,
+            history_id INTEGER
+        )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_threads_last_date ON threads(last_date)")
+        
+        # SQL fragments for the trigger bodies; {row} is NEW or OLD
+        thread_key = "(SELECT thread_id FROM message_stubs WHERE message_id = {row}.message_id)"
+        size = "COALESCE({row}.size_estimate, 0)"
+        # Removing a message can change either end of the date range, so recompute both
+        recompute_dates = '''
+            first_date = (SELECT MIN(r.internal_date) FROM message_stubs s
+                          JOIN message_rich_metadata r ON r.message_id = s.message_id
+                          WHERE s.thread_id = threads.thread_id),
+            last_date = (SELECT MAX(r.internal_date) FROM message_stubs s
+                         JOIN message_rich_metadata r ON r.message_id = s.message_id
+                         WHERE s.thread_id = threads.thread_id)
+        '''
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_rich_threads_insert AFTER INSERT ON message_rich_metadata BEGIN
+            INSERT INTO threads (thread_id, message_count, total_bytes, first_date, last_date)
+            SELECT thread_id, 1, {size.format(row='NEW')}, NEW.internal_date, NEW.internal_date
+            FROM message_stubs WHERE message_id = NEW.message_id
+                ON CONFLICT(thread_id) DO UPDATE SET
+                    message_count = message_count + 1,
+                    total_bytes = total_bytes + excluded.total_bytes,
+                    first_date = COALESCE(MIN(first_date, excluded.first_date), first_date, excluded.first_date),
+                    last_date = COALESCE(MAX(last_date, excluded.last_date), last_date, excluded.last_date);
+        END
+        ''')
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_rich_threads_delete AFTER DELETE ON message_rich_metadata BEGIN
+            UPDATE threads SET
+                message_count = message_count - 1,
+                total_bytes = total_bytes - {size.format(row='OLD')},
+                {recompute_dates}
+            WHERE thread_id = {thread_key.format(row='OLD')};
+            DELETE FROM threads WHERE thread_id = {thread_key.format(row='OLD')} AND message_count <= 0;
+        END
+        ''')
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_rich_threads_update
+        AFTER UPDATE OF size_estimate, internal_date ON message_rich_metadata
+        WHEN OLD.size_estimate IS NOT NEW.size_estimate OR OLD.internal_date IS NOT NEW.internal_date BEGIN
+            UPDATE threads SET
+                total_bytes = total_bytes - {size.format(row='OLD')} + {size.format(row='NEW')},
+                {recompute_dates}
+            WHERE thread_id = {thread_key.format(row='NEW')};
+        END
+        ''')
+        
+        # Backfill the summaries from the rows already in the cache
+        conn.execute('''
+            INSERT OR REPLACE INTO threads (thread_id, message_count, total_bytes, first_date, last_date)
+            SELECT s.thread_id, COUNT(*), SUM(COALESCE(r.size_estimate, 0)), MIN(r.internal_date), MAX(r.internal_date)
+            FROM message_stubs s JOIN message_rich_metadata r ON r.message_id = s.message_id
+            GROUP BY s.thread_id
+        ''')
+    
+    def _migrate_to_v7(self, conn):
+        """
+        Version 7: near-duplicate clusters of template mail, for classification.
+        
+        Messages are grouped by a normalised template (see src/clustering.py).
+        cluster_templates maps each template key to its cluster, cluster_buckets
+        holds the LSH buckets of the clusters' MinHash signatures, and
+        message_clusters assigns every clustered message to one cluster. A
+        cluster's category is set by classifying one representative and applies
+        to all its members (the message_categories view). member_count is kept
+        current by triggers; deleting a message removes its assignment, while
+        the cluster and its category stay for future mail of the same template.
+        """
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS clusters (
+            cluster_id INTEGER PRIMARY KEY,
+            sender_domain TEXT,
+            template TEXT,
+            signature BLOB,
+            member_count INTEGER NOT NULL DEFAULT 0,
+            category TEXT,
+            confidence REAL,
+            classifier TEXT,
+            classified_at TIMESTAMP
+        )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_clusters_category ON clusters(category)")
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS cluster_templates (
+            template_key TEXT PRIMARY KEY,
+            cluster_id INTEGER NOT NULL
+        ) WITHOUT ROWID
+        ''')
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS cluster_buckets (
+            bucket INTEGER NOT NULL,
+            cluster_id INTEGER NOT NULL,
+            PRIMARY KEY (bucket, cluster_id)
+        ) WITHOUT ROWID
+        ''')
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS message_clusters (
+            message_id TEXT PRIMARY KEY,
+            cluster_id INTEGER NOT NULL
+        ) WITHOUT ROWID
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_message_clusters_cluster ON message_clusters(cluster_id)")
+        
+        conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_message_clusters_insert AFTER INSERT ON message_clusters BEGIN
+            UPDATE clusters SET member_count = member_count + 1 WHERE cluster_id = NEW.cluster_id;
+        END
+        ''')
+        conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_message_clusters_delete AFTER DELETE ON message_clusters BEGIN
+            UPDATE clusters SET member_count = member_count - 1 WHERE cluster_id = OLD.cluster_id;
+        END
+        ''')
+        conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_rich_clusters_delete AFTER DELETE ON message_rich_metadata BEGIN
+            DELETE FROM message_clusters WHERE message_id = OLD.message_id;
+        END
+        ''')
+        conn.execute('''
+        CREATE VIEW IF NOT EXISTS message_categories AS
+            SELECT m.message_id, c.cluster_id, c.category, c.confidence
+            FROM message_clusters m JOIN clusters c ON c.cluster_id = m.cluster_id
+        ''')
+    
+    def _migrate_to_v8(self, conn):
+        """
+        Version 8: when each message's cached labels were last verified against Gmail.
+        
+        labels_checked_at is set by refresh-labels and whenever a label change is
+        applied from Gmail (history replay, get-message). Fetching the whole row
+        verifies the labels too, so the later of labels_checked_at and
+        rich_last_fetched_at is when the labels were last known to be current.
+        """
+        self._ensure_column(conn.cursor(), 'message_rich_metadata', 'labels_checked_at', 'TIMESTAMP')
+    
+    def _ensure_column(self, cursor, table, column, column_type):
+        """
+        Add a column to an existing table if it is not already present.
+        
+        Args:
+            cursor (sqlite3.Cursor): Cursor to run the statements on.
+            table (str): Name of the table to alter.
+            column (str): Name of the column that must exist.
+            column_type (str): SQL type used when the column has to be added.
+        """
+        cursor.execute(f"PRAGMA table_info({table})")
+        existing_columns = {row[1] for row in cursor.fetchall()}
+        if column not in existing_columns:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+    
     def get_db_connection(self):
         """
         Get a new SQLite connection to the database.
@@ -82,10 +625,116 @@ class GmailCacheDB:
         Returns:
             sqlite3.Connection: A new connection to the SQLite database.
         """
-        # Connect to the SQLite database file
-        # Setting isolation_level=None enables autocommit mode
-        # which is often useful for simpler transaction management
-        return sqlite3.connect(self.db_path)
+        # Connect to the SQLite database file and apply the tuning pragmas
+        conn = sqlite3.connect(self.db_path)
+        self._apply_pragmas(conn)
+        return conn
+    
+    def _apply_pragmas(self, conn):
+        """
+        Apply CONNECTION_PRAGMAS to a connection.
+        
+        Args:
+            conn (sqlite3.Connection): The connection to tune.
+        """
+        for name, value in CONNECTION_PRAGMAS.items():
+            conn.execute(f"PRAGMA {name}={value}")
+    
+    def get_read_connection(self):
+        """
+        Get a new read-only SQLite connection to the database.
+        
+        In WAL mode any number of readers can run while the writer connection
+        is committing, each seeing the last committed state.
+        
+        Returns:
+            sqlite3.Connection: A new read-only connection. It may be used from any
+                                thread, but not from several threads at once.
+        """
+        conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+        self._apply_pragmas(conn)
+        return conn
+    
+    def get_writer_connection(self):
+        """
+        Get the long-lived writer connection, creating it on first use.
+        
+        Use write_transaction() rather than this connection directly, so that
+        writes from different threads never interleave inside one transaction.
+        
+        Returns:
+            sqlite3.Connection: The shared writer connection.
+        """
+        with self._write_lock:
+            if self._writer_conn is None:
+                self._writer_conn = sqlite3.connect(self.db_path, check_same_thread=False)
+                self._apply_pragmas(self._writer_conn)
+            return self._writer_conn
+    
+    @contextmanager
+    def write_transaction(self):
+        """
+        Run a block of writes as one transaction on the shared writer connection.
+        
+        The transaction is committed when the block exits normally and rolled back
+        if it raises. Other threads that want to write wait until it is finished.
+        Group as many rows as practical into one transaction: every commit costs
+        a WAL sync, which dominates write time when done per page.
+        
+        Yields:
+            sqlite3.Connection: The writer connection.
+        """
+        wait_start = time.perf_counter()
+        with self._write_lock:
+            start = time.perf_counter()
+            metrics.add_time('db.write_lock_wait', start - wait_start)
+            conn = self.get_writer_connection()
+            try:
+                yield conn
+                commit_start = time.perf_counter()
+                conn.commit()
+                metrics.add_time('db.commit', time.perf_counter() - commit_start)
+                metrics.add_time('db.transaction', time.perf_counter() - start)
+            except BaseException:
+                conn.rollback()
+                # Sender IDs inserted by the rolled back transaction no longer exist
+                self._sender_ids.clear()
+                raise
+    
+    def refresh_statistics(self):
+        """
+        Refresh the query planner statistics (sqlite_stat1) after large changes.
+        
+        Without statistics SQLite cannot tell the narrow covering index from the
+        row-sized ones and may pick a plan that reads every row. analysis_limit
+        samples each index, so this takes milliseconds even on large caches.
+        """
+        with self.write_transaction() as conn:
+            conn.execute("PRAGMA analysis_limit = 1000")
+            conn.execute("ANALYZE")
+    
+    def rebuild_search_index(self):
+        """
+        Rebuild the message_fts full-text index from message_rich_metadata.
+        
+        The triggers keep the index current, so this is only needed after something
+        that renumbers rowids (VACUUM) or if the index is suspected to be out of step.
+        """
+        with self.write_transaction() as conn:
+            conn.execute("INSERT INTO message_fts (message_fts) VALUES ('rebuild')")
+    
+    def close(self):
+        """
+        Close the long-lived writer connection, if it was opened.
+        
+        Runs PRAGMA optimize first, which refreshes the planner statistics of
+        tables that changed a lot, so queries keep picking the right indexes.
+        """
+        with self._write_lock:
+            if self._writer_conn is not None:
+                self._writer_conn.execute("PRAGMA optimize")
+                self._writer_conn.close()
+                self._writer_conn = None
     
     def close_connection(self, conn):
         """
@@ -96,3 +745,543 @@ class GmailCacheDB:
         """
         if conn:
             conn.close()
+    
+    def get_sync_state(self, conn, key):
+        """
+        Read a value from the sync_state table.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+            key (str): The sync state key (e.g. 'history_id').
+            
+        Returns:
+            str: The stored value, or None if the key has never been set.
+        """
+        row = conn.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+    
+    def get_sync_state_age(self, conn, key):
+        """
+        Return how long ago a sync_state value was last written.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+            key (str): The sync state key (e.g. 'history_id').
+            
+        Returns:
+            float: Age in seconds, or None if the key has never been set.
+        """
+        row = conn.execute(
+            "SELECT (julianday('now') - julianday(updated_at)) * 86400 FROM sync_state WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+    
+    def set_sync_state(self, conn, key, value):
+        """
+        Store a value in the sync_state table. The caller is responsible for committing.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to write to.
+            key (str): The sync state key (e.g. 'history_id').
+            value: The value to store; it is saved as text.
+        """
+        conn.execute(
+            "INSERT OR REPLACE INTO sync_state (key, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)",
+            (key, str(value) if value is not None else None)
+        )
+    
+    def get_sync_labels(self, conn):
+        """
+        Read the labels whose messages the cache mirrors.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+            
+        Returns:
+            list: Label IDs, [ALL_MAIL] for all mail. DEFAULT_SYNC_LABELS if no sync has run.
+        """
+        value = self.get_sync_state(conn, 'sync_labels')
+        return json.loads(value) if value else list(DEFAULT_SYNC_LABELS)
+    
+    def add_sync_labels(self, conn, label_ids):
+        """
+        Add labels to the ones the cache mirrors. The caller is responsible for committing.
+        
+        ALL_MAIL covers every other label, so it replaces them. A cache synced before
+        the labels were recorded keeps mirroring DEFAULT_SYNC_LABELS.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to write to.
+            label_ids (list): Label IDs about to be synced.
+            
+        Returns:
+            bool: True if the labels widened the scope of the cache.
+        """
+        if self.get_sync_state(conn, 'sync_labels') or self.get_sync_state(conn, 'history_id'):
+            previous = self.get_sync_labels(conn)
+        else:
+            previous = [] # Nothing synced yet, so no default labels to keep
+        sync_labels = previous + [label_id for label_id in label_ids if not in_sync_scope([label_id], previous)]
+        if ALL_MAIL in sync_labels:
+            sync_labels = [ALL_MAIL]
+        self.set_sync_state(conn, 'sync_labels', json.dumps(sync_labels))
+        return sync_labels != previous
+    
+    def start_checkpoint(self, conn, label_id, history_id):
+        """
+        Start a new checkpoint for a full sync of a label, replacing any previous one.
+        The caller is responsible for committing.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to write to.
+            label_id (str): The label being synced (e.g. 'INBOX').
+            history_id (str): Mailbox historyId read before the listing started.
+        """
+        conn.execute("""
+            INSERT OR REPLACE INTO sync_checkpoints (label_id, phase, page_token, history_id)
+            VALUES (?, 'listing', NULL, ?)
+        """, (label_id, history_id))
+    
+    def get_checkpoint(self, conn, label_id):
+        """
+        Read the sync checkpoint of a label.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+            label_id (str): The label being synced (e.g. 'INBOX').
+            
+        Returns:
+            dict: The checkpoint columns by name, or None if no sync was ever started.
+        """
+        cursor = conn.execute("SELECT * FROM sync_checkpoints WHERE label_id = ?", (label_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        return {description[0]: value for description, value in zip(cursor.description, row)}
+    
+    def checkpoint_page(self, conn, label_id, next_page_token, stub_count):
+        """
+        Record that a page of stubs has been stored. Call this in the same transaction
+        as the stub insert, so the checkpoint never runs ahead of the data.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to write to.
+            label_id (str): The label being synced.
+            next_page_token (str): Token of the next page to list, None after the last page.
+            stub_count (int): Number of stubs stored from this page.
+        """
+        conn.execute("""
+            UPDATE sync_checkpoints
+            SET page_token = ?, messages_listed = messages_listed + ?, updated_at = CURRENT_TIMESTAMP
+            WHERE label_id = ?
+        """, (next_page_token, stub_count, label_id))
+    
+    def checkpoint_batch(self, conn, label_id):
+        """
+        Record that a batch of rich metadata has been stored, in the same transaction.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to write to.
+            label_id (str): The label being synced.
+        """
+        conn.execute("""
+            UPDATE sync_checkpoints
+            SET batches_committed = batches_committed + 1, updated_at = CURRENT_TIMESTAMP
+            WHERE label_id = ?
+        """, (label_id,))
+    
+    def set_checkpoint_phase(self, conn, label_id, phase):
+        """
+        Move a sync checkpoint to another phase. The caller is responsible for committing.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to write to.
+            label_id (str): The label being synced.
+            phase (str): One of 'listing', 'fetching' or 'done'.
+        """
+        conn.execute(
+            "UPDATE sync_checkpoints SET phase = ?, updated_at = CURRENT_TIMESTAMP WHERE label_id = ?",
+            (phase, label_id)
+        )
+    
+    def upsert_stubs(self, conn, stubs):
+        """
+        Insert or update message stubs. The caller is responsible for committing.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to write to.
+            stubs (list): Message stub dictionaries with 'id' and 'threadId' keys.
+        """
+        with metrics.timer('db.upsert_stubs'):
+            conn.executemany(
+                "INSERT OR REPLACE INTO message_stubs (message_id, thread_id) VALUES (?, ?)",
+                [(msg['id'], msg['threadId']) for msg in stubs]
+            )
+        metrics.count('db.rows.stubs', len(stubs))
+    
+    def upsert_rich_metadata(self, conn, rows):
+        """
+        Insert or update rich metadata rows. The caller is responsible for committing.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to write to.
+            rows (list): Tuples of (message_id, snippet, internal_date, size_estimate,
+                         from_address, subject, label_ids_json, has_attachments,
+                         attachment_filenames_json, payload_headers_json, history_id).
+        """
+        rows = list(rows)
+        start = time.perf_counter()
+        conn.executemany("""
+            INSERT INTO message_rich_metadata (
+                message_id, snippet, internal_date, size_estimate, 
+                from_address, subject, label_ids_json, 
+                has_attachments, attachment_filenames_json, payload_headers_json,
+                history_id, sender_id
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(message_id) DO UPDATE SET
+                snippet = excluded.snippet,
+                internal_date = excluded.internal_date,
+                size_estimate = excluded.size_estimate,
+                from_address = excluded.from_address,
+                subject = excluded.subject,
+                label_ids_json = excluded.label_ids_json,
+                has_attachments = excluded.has_attachments,
+                attachment_filenames_json = excluded.attachment_filenames_json,
+                payload_headers_json = excluded.payload_headers_json,
+                history_id = excluded.history_id,
+                sender_id = excluded.sender_id,
+                rich_last_fetched_at = CURRENT_TIMESTAMP
+        """, [tuple(row) + (self._get_sender_id(conn, row[4]),) for row in rows])
+        self._replace_labels(conn, [(row[0], json.loads(row[6] or '[]')) for row in rows])
+        metrics.add_time('db.upsert_rich', time.perf_counter() - start)
+        metrics.count('db.rows.rich', len(rows))
+    
+    def _get_sender_id(self, conn, from_address):
+        """
+        Resolve a raw From header to a senders row, inserting it if needed.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to write to.
+            from_address (str): The raw From header value (e.g. 'Name <user@example.com>').
+            
+        Returns:
+            int: The sender_id, or None if there is no From header.
+        """
+        if not from_address:
+            return None
+        sender_id = self._sender_ids.get(from_address)
+        if sender_id is None:
+            address, display_name, domain = parse_sender(from_address)
+            conn.execute(
+                "INSERT OR IGNORE INTO senders (address, display_name, domain) VALUES (?, ?, ?)",
+                (address, display_name, domain)
+            )
+            sender_id = conn.execute("SELECT sender_id FROM senders WHERE address = ?", (address,)).fetchone()[0]
+            self._sender_ids[from_address] = sender_id
+        return sender_id
+    
+    def _replace_labels(self, conn, message_labels):
+        """
+        Replace the message_labels rows of some messages.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to write to.
+            message_labels (list): (message_id, label_ids) pairs with the complete label sets.
+        """
+        conn.executemany("DELETE FROM message_labels WHERE message_id = ?",
+                         [(message_id,) for message_id, _ in message_labels])
+        conn.executemany("INSERT OR IGNORE INTO message_labels (label_id, message_id) VALUES (?, ?)",
+                         [(label_id, message_id) for message_id, label_ids in message_labels for label_id in label_ids])
+    
+    def count_missing_rich_metadata(self, conn):
+        """
+        Count the stubs that do not have rich metadata yet.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+            
+        Returns:
+            int: Number of stubs without a message_rich_metadata row.
+        """
+        return conn.execute("""
+            SELECT COUNT(*)
+            FROM message_stubs s
+            LEFT JOIN message_rich_metadata r ON s.message_id = r.message_id
+            WHERE r.message_id IS NULL
+        """).fetchone()[0]
+    
+    def iter_missing_rich_metadata(self, conn, chunk_size=500):
+        """
+        Stream the stubs that do not have rich metadata yet, in chunks.
+        
+        Uses keyset pagination on the primary key rather than one long-running cursor,
+        so no read transaction is held open while other connections write, and only
+        one chunk is in memory at a time.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+            chunk_size (int): Maximum number of rows per chunk.
+            
+        Yields:
+            list: (message_id, thread_id) tuples, in message_id order.
+        """
+        last_id = ''
+        while True:
+            rows = conn.execute("""
+                SELECT s.message_id, s.thread_id
+                FROM message_stubs s
+                LEFT JOIN message_rich_metadata r ON s.message_id = r.message_id
+                WHERE r.message_id IS NULL AND s.message_id > ?
+                ORDER BY s.message_id
+                LIMIT ?
+            """, (last_id, chunk_size)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            yield rows
+    
+    def update_message_labels(self, conn, message_id, label_ids, history_id=None):
+        """
+        Replace the cached label set of a message. The caller is responsible for committing.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to write to.
+            message_id (str): The message to update.
+            label_ids (list): The complete, current list of label IDs.
+            history_id (int, optional): History ID of the change being applied.
+                                        Older changes than the cached row are ignored.
+                                        
+        Returns:
+            int: 1 if the cached row was updated, 0 if it is missing or newer than the change.
+        """
+        if history_id is None:
+            cursor = conn.execute(
+                "UPDATE message_rich_metadata SET label_ids_json = ?, labels_checked_at = CURRENT_TIMESTAMP WHERE message_id = ?",
+                (json.dumps(label_ids), message_id)
+            )
+        else:
+            cursor = conn.execute("""
+                UPDATE message_rich_metadata
+                SET label_ids_json = ?, history_id = ?, labels_checked_at = CURRENT_TIMESTAMP
+                WHERE message_id = ? AND COALESCE(history_id, 0) <= ?
+            """, (json.dumps(label_ids), history_id, message_id, history_id))
+        if cursor.rowcount:
+            self._replace_labels(conn, [(message_id, label_ids)])
+        return cursor.rowcount
+    
+    def list_label_check_candidates(self, conn, max_age_seconds, newer_than_ms=None, limit=None):
+        """
+        List the cached messages whose labels have not been verified recently, newest first.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+            max_age_seconds (float): Messages verified (or fetched) less than this many
+                                     seconds ago are left out.
+            newer_than_ms (int, optional): Only messages with a later internal date.
+            limit (int, optional): At most this many messages.
+            
+        Returns:
+            list: Message IDs, most recent message first.
+        """
+        rows = conn.execute("""
+            SELECT message_id FROM message_rich_metadata
+            WHERE MAX(COALESCE(labels_checked_at, rich_last_fetched_at), rich_last_fetched_at) <= datetime('now', ?)
+            AND (? IS NULL OR internal_date > ?)
+            ORDER BY internal_date DESC
+            LIMIT ?
+        """, (f'-{max_age_seconds:.0f} seconds', newer_than_ms, newer_than_ms, -1 if limit is None else limit)).fetchall()
+        return [row[0] for row in rows]
+    
+    def record_label_checks(self, conn, checked):
+        """
+        Store the label sets of messages just verified against Gmail. The caller is responsible for committing.
+        
+        Only messages whose labels changed are rewritten (with their message_labels
+        rows, which keep the unread counter current); the others only get a new
+        labels_checked_at.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to write to.
+            checked (list): (message_id, label_ids, history_id) tuples with the current label sets.
+            
+        Returns:
+            int: Number of messages whose changed labels were written (a cached row
+                 newer than the check's history ID is left as it is).
+        """
+        cached = dict(conn.execute(
+            "SELECT message_id, label_ids_json FROM message_rich_metadata WHERE message_id IN (SELECT value FROM json_each(?))",
+            (json.dumps([message_id for message_id, _, _ in checked]),)
+        ).fetchall())
+        changed = 0
+        for message_id, label_ids, history_id in checked:
+            if message_id in cached and sorted(json.loads(cached[message_id] or '[]')) != sorted(label_ids):
+                changed += self.update_message_labels(conn, message_id, label_ids, history_id)
+        conn.executemany("UPDATE message_rich_metadata SET labels_checked_at = CURRENT_TIMESTAMP WHERE message_id = ?",
+                         [(message_id,) for message_id, _, _ in checked])
+        return changed
+    
+    def delete_messages(self, conn, message_ids):
+        """
+        Remove messages from both cache tables. The caller is responsible for committing.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to write to.
+            message_ids (list): IDs of the messages to remove.
+        """
+        id_rows = [(message_id,) for message_id in message_ids]
+        conn.executemany("DELETE FROM message_labels WHERE message_id = ?", id_rows)
+        conn.executemany("DELETE FROM message_rich_metadata WHERE message_id = ?", id_rows)
+        conn.executemany("DELETE FROM message_stubs WHERE message_id = ?", id_rows)
+    
+    def get_thread_message_ids(self, conn, thread_ids):
+        """
+        List the cached messages of some threads.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+            thread_ids (list): Thread IDs to look up.
+            
+        Returns:
+            list: IDs of the messages in message_stubs that belong to these threads.
+        """
+        placeholders = ','.join('?' * len(thread_ids))
+        return [row[0] for row in conn.execute(
+            f"SELECT message_id FROM message_stubs WHERE thread_id IN ({placeholders})", thread_ids
+        )]
+    
+    def get_thread_history_ids(self, conn, thread_ids):
+        """
+        Read the historyId each thread had when thread-mode sync last fetched it.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+            thread_ids (list): Thread IDs to look up.
+            
+        Returns:
+            dict: thread_id -> history_id for the threads that have one stored.
+        """
+        placeholders = ','.join('?' * len(thread_ids))
+        return dict(conn.execute(
+            f"SELECT thread_id, history_id FROM threads WHERE thread_id IN ({placeholders}) AND history_id IS NOT NULL",
+            thread_ids
+        ).fetchall())
+    
+    def clear_thread_history_ids(self, conn):
+        """
+        Forget the historyId of every thread, so the next thread-mode sync fetches them all.
+        The caller is responsible for committing.
+        
+        Needed when the synced labels widen: an unchanged thread may have members in the
+        new labels that were left out when it was fetched.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to write to.
+        """
+        conn.execute("UPDATE threads SET history_id = NULL WHERE history_id IS NOT NULL")
+    
+    def set_thread_history_ids(self, conn, thread_history_ids):
+        """
+        Record the historyId at which threads were fetched. The caller is responsible for committing.
+        
+        Threads without cached messages have no threads row and are not recorded.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to write to.
+            thread_history_ids (list): (thread_id, history_id) pairs.
+        """
+        conn.executemany(
+            "UPDATE threads SET history_id = ? WHERE thread_id = ?",
+            [(history_id, thread_id) for thread_id, history_id in thread_history_ids]
+        )
+    
+    def get_cached_message(self, conn, message_id):
+        """
+        Read a cached message in the shape of a users.messages.get resource (format 'metadata').
+        
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+            message_id (str): The message to read.
+            
+        Returns:
+            tuple: (message, age_seconds), age_seconds being the time since its rich metadata
+                   was fetched; or None if the message has no rich metadata in the cache.
+        """
+        row = conn.execute("""
+            SELECT r.message_id, s.thread_id, r.label_ids_json, r.snippet, r.history_id,
+                   r.internal_date, r.size_estimate, r.payload_headers_json,
+                   (julianday('now') - julianday(r.rich_last_fetched_at)) * 86400
+            FROM message_rich_metadata r
+            JOIN message_stubs s ON s.message_id = r.message_id
+            WHERE r.message_id = ?
+        """, (message_id,)).fetchone()
+        if not row:
+            return None
+        message = {
+            'id': row[0],
+            'threadId': row[1],
+            'labelIds': json.loads(row[2] or '[]'),
+            'snippet': row[3],
+            'historyId': str(row[4]) if row[4] is not None else None,
+            'internalDate': str(row[5]) if row[5] is not None else None,
+            'sizeEstimate': row[6],
+            'payload': {'headers': json.loads(row[7] or '[]')},
+        }
+        return message, row[8]
+    
+    def list_cached_messages(self, conn, label_ids, max_results):
+        """
+        List cached messages that carry all of the given labels, newest first.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+            label_ids (list): Label IDs every returned message must have.
+            max_results (int): Maximum number of messages.
+            
+        Returns:
+            list: Message stub dictionaries with 'id' and 'threadId' keys.
+        """
+        conditions = ' '.join(
+            "AND r.message_id IN (SELECT message_id FROM message_labels WHERE label_id = ?)" for _ in label_ids
+        )
+        rows = conn.execute(f"""
+            SELECT r.message_id, s.thread_id
+            FROM message_rich_metadata r
+            JOIN message_stubs s ON s.message_id = r.message_id
+            WHERE 1 {conditions}
+            ORDER BY r.internal_date DESC
+            LIMIT ?
+        """, [*label_ids, max_results]).fetchall()
+        return [{'id': message_id, 'threadId': thread_id} for message_id, thread_id in rows]
+    
+    def get_label_definitions(self, conn):
+        """
+        Read the label definitions stored by the last labels.list call.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+            
+        Returns:
+            tuple: (labels, age_seconds). labels are dictionaries with 'id', 'name' and 'type'
+                   keys, in the order Gmail returned them; age_seconds is None if no labels are stored.
+        """
+        rows = conn.execute("""
+            SELECT label_id, name, type, (julianday('now') - julianday(fetched_at)) * 86400
+            FROM labels ORDER BY rowid
+        """).fetchall()
+        labels = [{'id': label_id, 'name': name, 'type': label_type} for label_id, name, label_type, _ in rows]
+        return labels, max((row[3] for row in rows), default=None)
+    
+    def replace_label_definitions(self, conn, labels):
+        """
+        Replace the stored label definitions with a complete labels.list result.
+        The caller is responsible for committing.
+        
+        Args:
+            conn (sqlite3.Connection): Connection to write to.
+            labels (list): Label resources with 'id', 'name' and optionally 'type' keys.
+        """
+        conn.execute("DELETE FROM labels")
+        conn.executemany(
+            "INSERT INTO labels (label_id, name, type) VALUES (?, ?, ?)",
+            [(label['id'], label['name'], label.get('type')) for label in labels]
+        )
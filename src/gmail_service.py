@@ -0,0 +1,121 @@
+"""
+Builds Gmail API service objects from a locally cached discovery document.
+
+build('gmail', 'v1', ...) loads and parses the Gmail discovery document (about
+150 KB of JSON) every time it is called, and older client libraries download it.
+The document is instead kept in DISCOVERY_CACHE_FILENAME, parsed once per process
+and shared by every service built from it, so the main service and each worker
+service cost well under a millisecond to build.
+
+The Google client libraries take a few hundred milliseconds to import, so they are
+only imported here, when a service is actually built. Code that handles API errors
+catches gmail_service.HttpError, which imports googleapiclient on first use (in
+practice, when an API call has failed):
+
+    try:
+        scheduler.execute(request, 'messages.get')
+    except gmail_service.HttpError as error:
+        ...
+"""
+import functools
+import json
+import os
+import threading
+import time
+
+from src import metrics
+from src.config import DISCOVERY_CACHE_FILENAME, DISCOVERY_CACHE_MAX_AGE_DAYS
+
+DISCOVERY_URL = 'https://gmail.googleapis.com/$discovery/rest?version=v1'
+
+_document = None
+_document_lock = threading.Lock()
+
+
+def __getattr__(name):
+    # Module attribute hook (PEP 562): resolves HttpError lazily
+    if name == 'HttpError':
+        from googleapiclient.errors import HttpError
+        return HttpError
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def load_discovery_document(path=DISCOVERY_CACHE_FILENAME, max_age_days=DISCOVERY_CACHE_MAX_AGE_DAYS):
+    """
+    Return the parsed Gmail discovery document, from the local cache when it is fresh.
+
+    A missing or outdated cache file is refreshed from the copy bundled with
+    google-api-python-client, or downloaded if the installed version has none.
+
+    Args:
+        path (str): Location of the cached document.
+        max_age_days (float): Refresh the cached document when it is older than this.
+
+    Returns:
+        dict: The discovery document.
+    """
+    global _document
+    with _document_lock:
+        if _document is not None:
+            return _document
+        try:
+            if time.time() - os.path.getmtime(path) <= max_age_days * 86400:
+                with open(path, 'r', encoding='utf-8') as f:
+                    _document = json.load(f)
+                return _document
+        except (OSError, ValueError):
+            pass # Missing or unreadable cache file; fetch a new copy
+
+        content = _fetch_discovery_document()
+        _document = json.loads(content)
+        try:
+            # Write to a temporary file first so a concurrent reader never sees half a document
+            temporary_path = f'{path}.{os.getpid()}.tmp'
+            with open(temporary_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(temporary_path, path)
+        except OSError as e:
+            print(f"Could not cache the Gmail discovery document at {path}: {e}")
+        return _document
+
+
+def _fetch_discovery_document():
+    """Return the discovery document text, bundled with the client library or downloaded."""
+    from googleapiclient.discovery_cache import get_static_doc
+    content = get_static_doc('gmail', 'v1')
+    if content:
+        return content
+    import httplib2
+    response, content = httplib2.Http(timeout=30).request(DISCOVERY_URL)
+    if response.status != 200:
+        raise RuntimeError(f"Could not download the Gmail discovery document (HTTP {response.status})")
+    return content.decode('utf-8')
+
+
+def _counted_request(request, *args, **kwargs):
+    """Send an HTTP request and count it, and the response bytes, in the metrics."""
+    response, content = request(*args, **kwargs)
+    metrics.count('api.http_requests')
+    metrics.count('api.bytes_received', len(content or b''))
+    return response, content
+
+
+def build_gmail_service(credentials):
+    """
+    Build a Gmail API service object, like build('gmail', 'v1', credentials=...).
+
+    The service's HTTP client counts the requests it sends and the (decompressed)
+    response bytes it receives, batches counting once (see src/metrics.py).
+
+    Args:
+        credentials (google.oauth2.credentials.Credentials): The user's credentials.
+
+    Returns:
+        googleapiclient.discovery.Resource: A new Gmail API service object.
+    """
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.discovery import build_from_document
+    from googleapiclient.http import build_http
+    http = AuthorizedHttp(credentials, http=build_http())
+    http.request = functools.partial(_counted_request, http.request)
+    return build_from_document(load_discovery_document(), http=http)
@@ -0,0 +1,195 @@
+from datetime import datetime, timezone
+
+# Age buckets for the age distribution, as (label, minimum age in months)
+AGE_BUCKETS = [
+    ('< 1 month', 0),
+    ('1-6 months', 1),
+    ('6-12 months', 6),
+    ('1-2 years', 12),
+    ('2-5 years', 24),
+    ('5+ years', 60),
+]
+
+# Default threshold for the "large emails" count, in MB
+DEFAULT_LARGE_EMAIL_MB = 5
+
+
+def format_size(num_bytes):
+    """
+    Format a byte count for display (e.g. 1536 -> '1.5 KB').
+
+    Args:
+        num_bytes (int): Number of bytes.
+
+    Returns:
+        str: The size with a binary unit suffix.
+    """
+    size = float(num_bytes or 0)
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+class InsightsReport:
+    """
+    Phase One insights computed from the local cache.
+
+    Everything is read from the summary tables (sender_stats, month_stats and
+    cache_counters) that GmailCacheDB keeps current with triggers, or from
+    indexed ORDER BY ... LIMIT queries, so no query scans message_rich_metadata.
+    """
+
+    def __init__(self, db):
+        """
+        Initialize the report.
+
+        Args:
+            db (GmailCacheDB): The cache database to read from.
+        """
+        self.db = db
+
+    def totals(self, conn):
+        """
+        Return the cache-wide counters.
+
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+
+        Returns:
+            dict: 'messages', 'bytes' and 'unread' counts.
+        """
+        counters = dict(conn.execute("SELECT name, value FROM cache_counters").fetchall())
+        return {name: counters.get(name, 0) for name in ('messages', 'bytes', 'unread')}
+
+    def top_senders(self, conn, limit=10, by='count'):
+        """
+        Return the top senders by message count or by total size.
+
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+            limit (int): Number of senders to return.
+            by (str): 'count' or 'bytes'.
+
+        Returns:
+            list: (address, display_name, message_count, total_bytes) tuples.
+        """
+        order_column = 'total_bytes' if by == 'bytes' else 'message_count'
+        return conn.execute(f"""
+            SELECT COALESCE(s.address, '(unknown sender)'), s.display_name, st.message_count, st.total_bytes
+            FROM sender_stats st
+            LEFT JOIN senders s ON s.sender_id = st.sender_id
+            ORDER BY st.{order_column} DESC
+            LIMIT ?
+        """, (limit,)).fetchall()
+
+    def largest_messages(self, conn, limit=10):
+        """
+        Return the individual messages with the largest size estimate.
+
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+            limit (int): Number of messages to return.
+
+        Returns:
+            list: (message_id, size_estimate, from_address, subject, has_attachments) tuples.
+        """
+        return conn.execute("""
+            SELECT message_id, size_estimate, from_address, subject, has_attachments
+            FROM message_rich_metadata
+            ORDER BY size_estimate DESC
+            LIMIT ?
+        """, (limit,)).fetchall()
+
+    def count_large_messages(self, conn, threshold_mb=DEFAULT_LARGE_EMAIL_MB):
+        """
+        Count messages at or above a size threshold.
+
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+            threshold_mb (float): The threshold in MB.
+
+        Returns:
+            tuple: (message_count, total_bytes) of the large messages.
+        """
+        return conn.execute("""
+            SELECT COUNT(*), COALESCE(SUM(size_estimate), 0)
+            FROM message_rich_metadata
+            WHERE size_estimate >= ?
+        """, (int(threshold_mb * 1024 * 1024),)).fetchone()
+
+    def age_distribution(self, conn, now=None):
+        """
+        Bucket messages by age, using the per-month histogram.
+
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+            now (datetime, optional): Reference time. Defaults to the current UTC time.
+
+        Returns:
+            list: (bucket_label, message_count, total_bytes) tuples, from newest to oldest,
+                  followed by an 'unknown date' bucket if any message has no date.
+        """
+        now = now or datetime.now(timezone.utc)
+        current_month = now.year * 12 + now.month - 1
+        buckets = {label: [0, 0] for label, _ in AGE_BUCKETS}
+        unknown = [0, 0]
+
+        for month, message_count, total_bytes in conn.execute("SELECT month, message_count, total_bytes FROM month_stats"):
+            if month == 'unknown':
+                bucket = unknown
+            else:
+                year, month_number = (int(part) for part in month.split('-'))
+                age_months = current_month - (year * 12 + month_number - 1)
+                label = AGE_BUCKETS[0][0]
+                for bucket_label, min_age in AGE_BUCKETS:
+                    if age_months >= min_age:
+                        label = bucket_label
+                bucket = buckets[label]
+            bucket[0] += message_count
+            bucket[1] += total_bytes
+
+        result = [(label, count, size) for label, (count, size) in buckets.items()]
+        if unknown[0]:
+            result.append(('unknown date', unknown[0], unknown[1]))
+        return result
+
+    def print_report(self, top_n=10, large_mb=DEFAULT_LARGE_EMAIL_MB):
+        """
+        Print all Phase One insights to the console.
+
+        Args:
+            top_n (int): Number of rows in the top-N sections.
+            large_mb (float): Size threshold in MB for the large emails count.
+        """
+        conn = self.db.get_read_connection()
+        try:
+            totals = self.totals(conn)
+            if not totals['messages']:
+                print("The cache is empty. Run 'get-all-inbox-metadata' first.")
+                return
+
+            print("\n=== Mailbox Summary ===")
+            print(f"Messages: {totals['messages']}  Total size: {format_size(totals['bytes'])}  Unread: {totals['unread']}")
+
+            print(f"\n=== Top {top_n} Senders by Email Count ===")
+            for address, display_name, message_count, total_bytes in self.top_senders(conn, top_n, by='count'):
+                name = f"{display_name} <{address}>" if display_name else address
+                print(f"{message_count:>8}  {format_size(total_bytes):>10}  {name}")
+
+            print(f"\n=== Top {top_n} Senders by Total Size ===")
+            for address, display_name, message_count, total_bytes in self.top_senders(conn, top_n, by='bytes'):
+                name = f"{display_name} <{address}>" if display_name else address
+                print(f"{format_size(total_bytes):>10}  {message_count:>8}  {name}")
+
+            large_count, large_bytes = self.count_large_messages(conn, large_mb)
+            print(f"\n=== Top {top_n} Largest Emails ({large_count} emails >= {large_mb} MB, {format_size(large_bytes)}) ===")
+            for message_id, size_estimate, from_address, subject, has_attachments in self.largest_messages(conn, top_n):
+                attachment_marker = " [attachments]" if has_attachments else ""
+                print(f"{format_size(size_estimate):>10}  {message_id}  {from_address or 'N/A'}: {subject or '(no subject)'}{attachment_marker}")
+
+            print("\n=== Age Distribution ===")
+            for label, message_count, total_bytes in self.age_distribution(conn):
+                print(f"{label:<14}{message_count:>8}  {format_size(total_bytes):>10}")
+        finally:
+            self.db.close_connection(conn)
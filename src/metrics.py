@@ -0,0 +1,295 @@
+"""
+Process-wide metrics for syncs and cache work, and a profiler for whole commands.
+
+The hot paths record into one registry through the module functions:
+
+    start = time.perf_counter()
+    rows = extract(...)
+    metrics.add_time('extract', time.perf_counter() - start)
+    metrics.count('db.rows.rich', len(rows))
+    metrics.observe('queue.write', write_queue.qsize())
+
+Counters add up, timers keep a count, total and maximum per name, and gauges keep
+the mean and maximum of their samples. Every thread records into its own shard,
+so recording takes no lock; snapshot() adds the shards up. Recording costs well
+under a microsecond, so it is always on.
+
+Names are dotted: 'api.*' for Gmail calls (per method), quota units, retries and
+bytes received, 'quota.wait' for time spent waiting for quota, 'pipeline.*' for
+the sync stages, 'extract.*' for building cache rows from API responses, 'db.*'
+for cache writes, 'queue.*' for the depth of the pipeline queues, and 'cluster.*' and
+'classify.*' for clustering and classifying cached messages.
+"""
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+
+class _Shard:
+    """The counters, timers and gauges recorded by one thread."""
+
+    def __init__(self):
+        self.counters = {}
+        self.timers = {}  # name -> [count, seconds, max_seconds]
+        self.gauges = {}  # name -> [samples, total, max]
+
+
+class Metrics:
+    """A registry of counters, timers and gauges, recorded without locks by each thread."""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+        self.started = time.perf_counter()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def count(self, name, value=1):
+        """Add value to a counter."""
+        counters = self._shard().counters
+        counters[name] = counters.get(name, 0) + value
+
+    def add_time(self, name, seconds):
+        """Record one timed occurrence of name that took `seconds`."""
+        timers = self._shard().timers
+        entry = timers.get(name)
+        if entry is None:
+            timers[name] = [1, seconds, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+            if seconds > entry[2]:
+                entry[2] = seconds
+
+    def observe(self, name, value):
+        """Record one sample of a gauge, such as a queue depth."""
+        gauges = self._shard().gauges
+        entry = gauges.get(name)
+        if entry is None:
+            gauges[name] = [1, value, value]
+        else:
+            entry[0] += 1
+            entry[1] += value
+            if value > entry[2]:
+                entry[2] = value
+
+    def merge(self, data):
+        """
+        Add a snapshot() taken elsewhere, such as in a worker process, to this registry.
+
+        Args:
+            data (dict): The snapshot to add.
+        """
+        for name, value in data['counters'].items():
+            self.count(name, value)
+        timers = self._shard().timers
+        for name, timer_data in data['timers'].items():
+            entry = timers.setdefault(name, [0, 0.0, 0.0])
+            entry[0] += timer_data['count']
+            entry[1] += timer_data['seconds']
+            entry[2] = max(entry[2], timer_data['max_seconds'])
+        gauges = self._shard().gauges
+        for name, gauge in data['gauges'].items():
+            entry = gauges.setdefault(name, [0, 0, 0])
+            entry[0] += gauge['samples']
+            entry[1] += gauge['mean'] * gauge['samples']
+            entry[2] = max(entry[2], gauge['max'])
+
+    def reset(self):
+        """Drop everything recorded so far and restart the wall clock."""
+        with self._lock:
+            for shard in self._shards:
+                shard.counters.clear()
+                shard.timers.clear()
+                shard.gauges.clear()
+            self.started = time.perf_counter()
+
+    def snapshot(self):
+        """
+        Add up the shards of all threads.
+
+        Returns:
+            dict: 'wall_seconds' since the last reset, 'counters' by name, 'timers' by name
+                  ('count', 'seconds', 'max_seconds'), 'gauges' by name ('samples', 'mean',
+                  'max') and 'rates' derived from them (e.g. 'db.rows_per_second').
+        """
+        counters, timers, gauges = {}, {}, {}
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for name, value in list(shard.counters.items()):
+                counters[name] = counters.get(name, 0) + value
+            for name, (count, seconds, max_seconds) in list(shard.timers.items()):
+                total = timers.setdefault(name, [0, 0.0, 0.0])
+                total[0] += count
+                total[1] += seconds
+                total[2] = max(total[2], max_seconds)
+            for name, (samples, value, max_value) in list(shard.gauges.items()):
+                total = gauges.setdefault(name, [0, 0, 0])
+                total[0] += samples
+                total[1] += value
+                total[2] = max(total[2], max_value)
+
+        wall_seconds = time.perf_counter() - self.started
+        rows = counters.get('db.rows.stubs', 0) + counters.get('db.rows.rich', 0)
+        write_seconds = sum(timers.get(name, (0, 0.0))[1] for name in ('db.upsert_stubs', 'db.upsert_rich', 'db.commit'))
+        return {
+            'wall_seconds': wall_seconds,
+            'counters': dict(sorted(counters.items())),
+            'timers': {name: {'count': count, 'seconds': seconds, 'max_seconds': max_seconds}
+                       for name, (count, seconds, max_seconds) in sorted(timers.items())},
+            'gauges': {name: {'samples': samples, 'mean': value / samples, 'max': max_value}
+                       for name, (samples, value, max_value) in sorted(gauges.items())},
+            'rates': {
+                'db.rows_per_second': rows / write_seconds if write_seconds else 0.0,
+                'messages_per_second': counters.get('db.rows.rich', 0) / wall_seconds if wall_seconds else 0.0,
+                'api.bytes_received_per_second': counters.get('api.bytes_received', 0) / wall_seconds if wall_seconds else 0.0,
+            },
+        }
+
+
+# The registry the module functions record into
+registry = Metrics()
+count = registry.count
+add_time = registry.add_time
+observe = registry.observe
+merge = registry.merge
+reset = registry.reset
+snapshot = registry.snapshot
+
+
+class timer:
+    """Context manager that records the time spent in its block: `with metrics.timer('db.commit'): ...`"""
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        registry.add_time(self.name, time.perf_counter() - self.start)
+
+
+def write_json(path):
+    """Write snapshot() to a JSON file."""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot(), f, indent=2)
+
+
+def print_summary(top=12):
+    """Print the timers that took the most time, the API counters and the queue depths."""
+    data = snapshot()
+    print(f"\n{'Timer':<32} {'calls':>9} {'total s':>9} {'mean ms':>9} {'max ms':>9}")
+    timers = sorted(data['timers'].items(), key=lambda item: item[1]['seconds'], reverse=True)
+    for name, timer_data in timers[:top]:
+        print(f"{name:<32} {timer_data['count']:>9} {timer_data['seconds']:>9.2f} "
+              f"{timer_data['seconds'] / timer_data['count'] * 1000:>9.3f} {timer_data['max_seconds'] * 1000:>9.1f}")
+    counters = data['counters']
+    print(f"API calls {sum(value for name, value in counters.items() if name.startswith('api.calls.'))}, "
+          f"HTTP requests {counters.get('api.http_requests', 0)}, quota units {counters.get('api.quota_units', 0)}, "
+          f"retries {sum(value for name, value in counters.items() if name.startswith('api.retries.'))}, "
+          f"received {counters.get('api.bytes_received', 0) / 1024 / 1024:.1f} MB, "
+          f"DB {data['rates']['db.rows_per_second']:,.0f} rows/sec")
+    for name, gauge in data['gauges'].items():
+        print(f"{name} depth: mean {gauge['mean']:.1f}, max {gauge['max']}")
+
+
+class _StackSampler(threading.Thread):
+    """Samples the Python stacks of all threads at a fixed interval, counting identical stacks."""
+
+    def __init__(self, interval):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.interval = interval
+        self.stacks = {}
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            names = {thread.ident: thread.name.rstrip('0123456789').rstrip('-') for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == self.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread'))
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+@contextlib.contextmanager
+def profile_to(path, interval=0.005, top=15):
+    """
+    Profile a block with cProfile and a stack sampler, and write both for later analysis.
+
+    cProfile runs in the calling thread and in every thread started inside the block
+    (on Python 3.12 and later only one thread can be profiled at a time, so only the
+    calling thread is). Its statistics go to `path`, readable with `python -m pstats`,
+    snakeviz or gprof2dot. The sampler records the stacks of all threads every
+    `interval` seconds; `path` + '.folded' holds them in the collapsed format of
+    flamegraph.pl and speedscope, one line per stack with its sample count.
+
+    Args:
+        path (str): Where to write the cProfile statistics.
+        interval (float): Seconds between stack samples.
+        top (int): Number of functions to print, by time spent in the function itself.
+    """
+    import cProfile
+    import pstats
+
+    sampler = _StackSampler(interval)
+    sampler.start()
+    thread_profiles = []
+
+    def profile_new_thread(frame, event, arg):
+        # Called on the first profile event of each new thread; hand over to cProfile
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return # Another profiler is active (Python 3.12+)
+        thread_profiles.append(profile)
+
+    main_profile = cProfile.Profile()
+    threading.setprofile(profile_new_thread)
+    main_profile.enable()
+    try:
+        yield
+    finally:
+        main_profile.disable()
+        threading.setprofile(None)
+        sampler.stop()
+
+        stats = pstats.Stats(main_profile)
+        for profile in thread_profiles:
+            stats.add(profile)
+        stats.dump_stats(path)
+        with open(f'{path}.folded', 'w', encoding='utf-8') as f:
+            for stack, samples in sorted(sampler.stacks.items()):
+                f.write(f"{stack} {samples}\n")
+
+        print(f"\nProfile of {1 + len(thread_profiles)} threads written to {path} (python -m pstats {path}); "
+              f"{sum(sampler.stacks.values())} stack samples written to {path}.folded (flamegraph.pl, speedscope).")
+        stats.sort_stats('tottime').print_stats(top)
@@ -0,0 +1,284 @@
+import random
+import threading
+import time
+from collections import deque
+
+from src import gmail_service
+from src import metrics
+from src.config import QUOTA_UNITS_PER_SECOND, QUOTA_UNITS_PER_METHOD
+
+# HTTP statuses that mean "try again later" rather than "this request is wrong"
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+def is_retryable_error(error):
+    """
+    Decide whether an API error is transient and the request should be retried.
+
+    Args:
+        error (Exception): The exception raised by execute() or passed to a batch callback.
+
+    Returns:
+        bool: True for throttling (429, 403 rate limit reasons) and server errors (5xx).
+    """
+    if not isinstance(error, gmail_service.HttpError):
+        return False
+    status = error.resp.status
+    if status in RETRYABLE_STATUSES:
+        return True
+    # Gmail also reports per-user throttling as 403 rateLimitExceeded/userRateLimitExceeded
+    if status == 403:
+        content = error.content.decode('utf-8', errors='replace') if isinstance(error.content, bytes) else str(error.content)
+        return 'ratelimitexceeded' in content.lower()
+    return False
+
+
+def is_throttling_error(error):
+    """Return True if the error means we are sending requests too fast."""
+    return isinstance(error, gmail_service.HttpError) and (error.resp.status in (429, 403)) and is_retryable_error(error)
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket measured in Gmail quota units.
+
+    Tokens refill continuously at `rate` units per second up to `capacity`.
+    acquire() blocks until the requested number of units is available.
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        Initialize the bucket full.
+
+        Args:
+            rate (float): Refill rate in quota units per second.
+            capacity (float, optional): Maximum burst size. Defaults to one second of quota.
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self, units):
+        """
+        Block until `units` quota units can be spent, then spend them.
+
+        Requests larger than the bucket capacity are allowed once the bucket is full;
+        the bucket then goes into debt, which delays the following callers.
+
+        Args:
+            units (float): Number of quota units to spend.
+        """
+        while True:
+            with self._lock:
+                self._refill()
+                needed = min(units, self.capacity)
+                if self.tokens >= needed:
+                    self.tokens -= units
+                    return
+                wait = (needed - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class QuotaScheduler:
+    """
+    Schedules Gmail API calls under the per-user quota.
+
+    Every call spends its quota cost from a shared token bucket before it is sent.
+    Transient failures (429, 403 rate limits, 5xx) are retried with exponential
+    backoff; for batch requests only the failed sub-requests are re-queued.
+    The batch size adapts: it is halved when Gmail throttles us and grows again
+    one step at a time while batches succeed.
+
+    A single scheduler is meant to be shared by all threads syncing one account.
+    """
+
+    def __init__(self, units_per_second=QUOTA_UNITS_PER_SECOND, max_retries=6,
+                 batch_size=50, min_batch_size=5, max_batch_size=100,
+                 base_delay=1.0, max_delay=64.0):
+        """
+        Initialize the scheduler.
+
+        Args:
+            units_per_second (float): Quota units that may be spent per second.
+            max_retries (int): Retries per request (or batch sub-request) before giving up.
+            batch_size (int): Initial number of sub-requests per batch.
+            min_batch_size (int): Lower bound when shrinking the batch size.
+            max_batch_size (int): Upper bound when growing the batch size (Gmail allows 100).
+            base_delay (float): Backoff delay in seconds for the first retry.
+            max_delay (float): Upper bound for a single backoff delay in seconds.
+        """
+        self.bucket = TokenBucket(units_per_second)
+        self.max_retries = max_retries
+        self.min_batch_size = max(1, min_batch_size)
+        self.max_batch_size = max(self.min_batch_size, min(max_batch_size, 100))
+        self.batch_size = max(self.min_batch_size, min(batch_size, self.max_batch_size))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # Quota units spent so far, retries included
+        self.units_spent = 0
+        self._lock = threading.Lock()
+
+    def _backoff_delay(self, attempt, error=None):
+        """
+        Compute how long to wait before retry number `attempt` (1-based).
+
+        Honours a Retry-After header when Gmail sends one, otherwise uses
+        exponential backoff with full jitter.
+        """
+        if isinstance(error, gmail_service.HttpError):
+            retry_after = error.resp.get('retry-after')
+            if retry_after and str(retry_after).isdigit():
+                return min(float(retry_after), self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+    def _spend(self, units):
+        """Wait until `units` quota units are available and count them as spent."""
+        start = time.perf_counter()
+        self.bucket.acquire(units)
+        metrics.add_time('quota.wait', time.perf_counter() - start)
+        metrics.count('api.quota_units', units)
+        with self._lock:
+            self.units_spent += units
+
+    def _sleep_backoff(self, delay):
+        """Sleep before a retry, recording the time lost to backoff."""
+        metrics.add_time('api.backoff', delay)
+        time.sleep(delay)
+
+    def set_batch_size(self, batch_size):
+        """
+        Start batches at `batch_size` sub-requests and never grow them beyond it.
+
+        Used for a batch size the user chose (--batch-size): throttling can still
+        shrink the batches, but growing them again stops at this size.
+
+        Args:
+            batch_size (int): Sub-requests per batch request (at most 100).
+        """
+        with self._lock:
+            self.max_batch_size = max(1, min(batch_size, 100))
+            self.batch_size = self.max_batch_size
+
+    def _shrink_batch_size(self):
+        with self._lock:
+            self.batch_size = max(min(self.min_batch_size, self.max_batch_size), self.batch_size // 2)
+
+    def _grow_batch_size(self):
+        with self._lock:
+            self.batch_size = min(self.max_batch_size, self.batch_size + self.min_batch_size)
+
+    def execute(self, request, method):
+        """
+        Execute a single API request under the quota, retrying transient failures.
+
+        Args:
+            request (googleapiclient.http.HttpRequest): The request to execute.
+            method (str): The API method name used for quota accounting (e.g. 'messages.list').
+
+        Returns:
+            dict: The deserialized response.
+
+        Raises:
+            HttpError: If the error is not transient or retries are exhausted.
+        """
+        attempt = 0
+        while True:
+            self._spend(QUOTA_UNITS_PER_METHOD.get(method, 5))
+            metrics.count(f'api.calls.{method}')
+            start = time.perf_counter()
+            try:
+                return request.execute()
+            except gmail_service.HttpError as error:
+                metrics.count(f'api.errors.{error.resp.status}')
+                attempt += 1
+                if not is_retryable_error(error) or attempt > self.max_retries:
+                    raise
+                metrics.count(f'api.retries.{method}')
+                self._sleep_backoff(self._backoff_delay(attempt, error))
+            finally:
+                metrics.add_time(f'api.{method}', time.perf_counter() - start)
+
+    def execute_batch(self, service, keys, build_request, method, on_success):
+        """
+        Execute one sub-request per key as batch requests, retrying only failed sub-requests.
+
+        Args:
+            service: The Gmail API service object to build batches on.
+            keys (iterable): Identifiers of the sub-requests (e.g. message IDs).
+            build_request (callable): Called as build_request(service, key); returns the
+                                      HttpRequest for that key. Requests are rebuilt on retry.
+            method (str): The API method name used for quota accounting (e.g. 'messages.get').
+            on_success (callable): Called as on_success(key, response) for each success.
+
+        Returns:
+            dict: Keys that could not be fetched, mapped to their last error.
+        """
+        pending = deque((key, 0) for key in keys)
+        failed = {}
+        unit_cost = QUOTA_UNITS_PER_METHOD.get(method, 5)
+
+        while pending:
+            size = self.batch_size
+            chunk = [pending.popleft() for _ in range(min(size, len(pending)))]
+            retry = []
+            throttled = False
+
+            def callback_factory(key, attempts):
+                def callback(request_id, response, exception):
+                    nonlocal throttled
+                    if exception is None:
+                        on_success(key, response)
+                        return
+                    if isinstance(exception, gmail_service.HttpError):
+                        metrics.count(f'api.errors.{exception.resp.status}')
+                    if is_retryable_error(exception) and attempts < self.max_retries:
+                        throttled = throttled or is_throttling_error(exception)
+                        retry.append((key, attempts + 1, exception))
+                    else:
+                        failed[key] = exception
+                return callback
+
+            self._spend(unit_cost * len(chunk))
+            metrics.count(f'api.calls.{method}', len(chunk))
+            metrics.count(f'api.batches.{method}')
+            batch = service.new_batch_http_request()
+            for key, attempts in chunk:
+                batch.add(build_request(service, key), callback=callback_factory(key, attempts))
+            # Includes the on_success callbacks, which run as the batch response is parsed
+            start = time.perf_counter()
+            try:
+                batch.execute()
+            except gmail_service.HttpError as error:
+                # The whole batch envelope failed, so every sub-request is retried
+                metrics.count(f'api.errors.{error.resp.status}')
+                if not is_retryable_error(error):
+                    raise
+                throttled = throttled or is_throttling_error(error)
+                retry = [(key, attempts + 1, error) for key, attempts in chunk]
+                for key, attempts, err in retry:
+                    if attempts > self.max_retries:
+                        failed[key] = err
+                retry = [item for item in retry if item[1] <= self.max_retries]
+            finally:
+                metrics.add_time(f'api.batch.{method}', time.perf_counter() - start)
+
+            if throttled:
+                metrics.count('api.throttled_batches')
+                self._shrink_batch_size()
+            elif not retry:
+                self._grow_batch_size()
+
+            if retry:
+                # Wait for the most-retried sub-request's backoff, then re-queue them first
+                metrics.count(f'api.retries.{method}', len(retry))
+                self._sleep_backoff(max(self._backoff_delay(attempts, err) for _, attempts, err in retry))
+                pending.extendleft((key, attempts) for key, attempts, _ in reversed(retry))
+
+        return failed
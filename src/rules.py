@@ -0,0 +1,336 @@
+import json
+import re
+import time
+
+from src.actions import ACTIONS, build_selection
+from src.insights import format_size
+
+# Match conditions that also accept a list of values (a message matches any of them)
+LIST_CONDITIONS = {'sender', 'domain', 'label', 'subject_contains'}
+# Match conditions that take a single number or boolean
+NUMBER_CONDITIONS = {'older_than_days', 'newer_than_days', 'larger_than_mb', 'smaller_than_mb'}
+BOOLEAN_CONDITIONS = {'unread', 'has_attachments'}
+# An EXPLAIN QUERY PLAN step that reads every message ("SCAN r ..." or, before SQLite 3.36, "SCAN TABLE ... AS r")
+SCAN_STEP = re.compile(r'^SCAN (TABLE message_rich_metadata AS )?r\b')
+
+
+class Rule:
+    """A user rule: a match over the cached metadata and the action for matching messages."""
+
+    def __init__(self, name, action, match, label_id=None, now=None):
+        """
+        Initialize and compile the rule.
+
+        Args:
+            name (str): Unique rule name.
+            action (str): One of actions.ACTIONS.
+            match (dict): The match conditions (see compile_match).
+            label_id (str, optional): The label for the 'label' and 'unlabel' actions.
+            now (float, optional): Reference time for age conditions, in seconds since the epoch.
+
+        Raises:
+            ValueError: If the rule is invalid.
+        """
+        if action not in ACTIONS:
+            raise ValueError(f"Rule '{name}': unknown action '{action}'. Choose from: {', '.join(ACTIONS)}")
+        if action in ('label', 'unlabel') and not label_id:
+            raise ValueError(f"Rule '{name}': the '{action}' action needs a label_id")
+        self.name = name
+        self.action = action
+        self.match = match
+        self.label_id = label_id
+        try:
+            self.where, self.params = compile_match(match, now)
+        except ValueError as e:
+            raise ValueError(f"Rule '{name}': {e}") from None
+
+
+def compile_match(match, now=None):
+    """
+    Compile rule match conditions into a parameterised SQL predicate.
+
+    A match is an object whose conditions must all hold:
+        sender, domain, label, subject_contains: a string, or a list of strings of which any may match
+        older_than_days, newer_than_days, larger_than_mb, smaller_than_mb: a number
+        unread, has_attachments: true or false
+        all, any: a list of nested matches that must all / any hold
+        not: a nested match that must not hold
+
+    Args:
+        match (dict): The match conditions.
+        now (float, optional): Reference time for age conditions, in seconds since the epoch.
+
+    Returns:
+        tuple: (where_sql, params) over message_rich_metadata aliased r.
+
+    Raises:
+        ValueError: For unknown conditions or values of the wrong type.
+    """
+    if not isinstance(match, dict) or not match:
+        raise ValueError("a match must be a non-empty object")
+    now = now or time.time()
+    parts = []
+    for key, value in match.items():
+        if key in ('all', 'any'):
+            if not isinstance(value, list) or not value:
+                raise ValueError(f"'{key}' needs a non-empty list of matches")
+            compiled = [compile_match(nested, now) for nested in value]
+            joiner = ' AND ' if key == 'all' else ' OR '
+            sql = '(' + joiner.join(nested_sql for nested_sql, _ in compiled) + ')'
+            condition_params = [param for _, nested_params in compiled for param in nested_params]
+        elif key == 'not':
+            nested_sql, condition_params = compile_match(value, now)
+            # A NULL column makes a predicate NULL; treat that as "no match" before negating
+            sql = f"NOT COALESCE({nested_sql}, 0)"
+        elif key in LIST_CONDITIONS:
+            sql, condition_params = _compile_list_condition(key, value, now)
+        elif key in NUMBER_CONDITIONS:
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"'{key}' needs a number")
+            sql, condition_params = build_selection(**{key: value}, now=now)
+        elif key in BOOLEAN_CONDITIONS:
+            if not isinstance(value, bool):
+                raise ValueError(f"'{key}' needs true or false")
+            sql, condition_params = build_selection(**{key: value}, now=now)
+        else:
+            raise ValueError(f"unknown condition '{key}'")
+        parts.append((_condition_cost(key), sql, condition_params))
+
+    # AND stops at the first false condition, so test plain columns before subqueries and LIKE
+    parts.sort(key=lambda part: part[0])
+    return '(' + ' AND '.join(sql for _, sql, _ in parts) + ')', [param for _, _, part_params in parts for param in part_params]
+
+
+def _condition_cost(key):
+    """Rough evaluation cost of a condition per message: column tests, then lookups, then LIKE and nesting."""
+    if key in NUMBER_CONDITIONS or key == 'has_attachments':
+        return 0
+    if key in ('sender', 'domain'):
+        return 1
+    if key in ('label', 'unread'):
+        return 2
+    return 3
+
+
+def _compile_list_condition(key, value, now):
+    """Compile a sender/domain/label/subject_contains condition with one or more values."""
+    values = value if isinstance(value, list) else [value]
+    if not values or not all(isinstance(item, str) and item.strip() for item in values):
+        raise ValueError(f"'{key}' needs a string or a non-empty list of strings")
+    if len(values) == 1:
+        return build_selection(**{key: values[0]}, now=now)
+
+    placeholders = ','.join('?' * len(values))
+    if key in ('sender', 'domain'):
+        column = 'address' if key == 'sender' else 'domain'
+        return (f"r.sender_id IN (SELECT sender_id FROM senders WHERE {column} IN ({placeholders}))",
+                [item.strip().lower() for item in values])
+    if key == 'label':
+        return (f"r.message_id IN (SELECT message_id FROM message_labels WHERE label_id IN ({placeholders}))",
+                list(values))
+    compiled = [build_selection(subject_contains=item) for item in values]
+    return ('(' + ' OR '.join(sql for sql, _ in compiled) + ')',
+            [param for _, item_params in compiled for param in item_params])
+
+
+def load_rules(path, now=None):
+    """
+    Load and compile a rule file.
+
+    The file is JSON: {"rules": [{"name": ..., "action": ..., "label_id": ..., "match": {...}}, ...]}.
+
+    Args:
+        path (str): Path to the rule file.
+        now (float, optional): Reference time for age conditions, in seconds since the epoch.
+
+    Returns:
+        list: Rule objects, in file order.
+
+    Raises:
+        ValueError: If the file or one of its rules is invalid.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        try:
+            document = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"{path} is not valid JSON: {e}") from None
+    entries = document.get('rules') if isinstance(document, dict) else None
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"{path} needs a non-empty 'rules' list")
+
+    rules, names = [], set()
+    for position, entry in enumerate(entries, start=1):
+        if not isinstance(entry, dict):
+            raise ValueError(f"Rule #{position} must be an object")
+        name = entry.get('name') or f"rule-{position}"
+        if name in names:
+            raise ValueError(f"Duplicate rule name '{name}'")
+        names.add(name)
+        unknown = set(entry) - {'name', 'action', 'label_id', 'match'}
+        if unknown:
+            raise ValueError(f"Rule '{name}': unknown keys {', '.join(sorted(unknown))}")
+        rules.append(Rule(name, entry.get('action'), entry.get('match'), entry.get('label_id'), now))
+    return rules
+
+
+class RuleEngine:
+    """
+    Evaluates compiled rules against the metadata cache.
+
+    Every message is assigned to the first rule (in file order) that matches it,
+    so each message gets at most one action. Rules are evaluated in two ways,
+    chosen from SQLite's query plan for each rule:
+
+    - Rules that can seek an index (sender, domain, label, date or size
+      conditions) run as their own indexed query and only touch their matches.
+    - Rules that would scan the table (subject keywords, broad OR/NOT
+      combinations) are compatible with each other and run together in one pass
+      over the narrow idx_rich_rule_columns index, as one CASE expression.
+
+    Matches are collected in a temporary table keyed by the message's rowid (which
+    every index carries, so index-driven rules never read the row itself) that keeps
+    the lowest rule index; per-rule counts and ID lists are read from it.
+    """
+
+    def __init__(self, rules):
+        """
+        Initialize the engine.
+
+        Args:
+            rules (list): Rule objects, in priority order.
+        """
+        self.rules = rules
+
+    def explain(self, conn, rule):
+        """
+        Return SQLite's query plan for a rule evaluated on its own.
+
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+            rule (Rule): The rule to explain.
+
+        Returns:
+            list: The plan steps (EXPLAIN QUERY PLAN detail column).
+        """
+        return [row[-1] for row in conn.execute(
+            f"EXPLAIN QUERY PLAN SELECT r.message_id FROM message_rich_metadata r WHERE {rule.where}", rule.params
+        )]
+
+    def needs_scan(self, conn, rule):
+        """Return True if the rule cannot seek an index and has to scan every message."""
+        return any(SCAN_STEP.match(step) for step in self.explain(conn, rule))
+
+    def _collect_matches(self, conn):
+        """
+        Fill temp.rule_matches with each matching message's first rule.
+
+        Args:
+            conn (sqlite3.Connection): Connection to read from (temporary tables are
+                                       private to the connection, so a read-only one works).
+        """
+        conn.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS rule_matches (
+                message_rowid INTEGER PRIMARY KEY,
+                rule_index INTEGER NOT NULL
+            )
+        """)
+        conn.execute("DELETE FROM temp.rule_matches")
+
+        indexed_rules, scan_rules = [], []
+        for index, rule in enumerate(self.rules):
+            (scan_rules if self.needs_scan(conn, rule) else indexed_rules).append((index, rule))
+
+        if scan_rules:
+            # One pass for all scanning rules: the CASE picks the first one that matches
+            branches = ' '.join(f"WHEN {rule.where} THEN {index}" for index, rule in scan_rules)
+            conn.execute(f"""
+                INSERT INTO temp.rule_matches (message_rowid, rule_index)
+                SELECT message_rowid, rule_index FROM (
+                    SELECT r.rowid AS message_rowid, CASE {branches} END AS rule_index FROM message_rich_metadata r
+                )
+                WHERE rule_index IS NOT NULL
+            """, [param for _, rule in scan_rules for param in rule.params])
+
+        # Indexed rules in priority order: a message keeps the first rule that claimed it,
+        # unless this rule comes before the scanning rule that matched it
+        for index, rule in indexed_rules:
+            conn.execute(f"""
+                INSERT INTO temp.rule_matches (message_rowid, rule_index)
+                SELECT r.rowid, {index} FROM message_rich_metadata r WHERE {rule.where}
+                ON CONFLICT(message_rowid) DO UPDATE SET rule_index = excluded.rule_index
+                WHERE excluded.rule_index < rule_matches.rule_index
+            """, rule.params)
+
+    def evaluate(self, conn):
+        """
+        Count the messages and bytes each rule would act on.
+
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+
+        Returns:
+            list: (rule, message_count, total_bytes) tuples, in rule order.
+        """
+        self._collect_matches(conn)
+        counts = {
+            rule_index: (message_count, total_bytes)
+            for rule_index, message_count, total_bytes in conn.execute("""
+                SELECT m.rule_index, COUNT(*), COALESCE(SUM(r.size_estimate), 0)
+                FROM temp.rule_matches m
+                JOIN message_rich_metadata r ON r.rowid = m.message_rowid
+                GROUP BY m.rule_index
+            """)
+        }
+        return [(rule, *counts.get(index, (0, 0))) for index, rule in enumerate(self.rules)]
+
+    def matches(self, conn):
+        """
+        Return the IDs of the messages each rule would act on, oldest first.
+
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+
+        Returns:
+            list: (rule, message_ids) pairs, in rule order.
+        """
+        self._collect_matches(conn)
+        matched = [[] for _ in self.rules]
+        for message_id, rule_index in conn.execute("""
+            SELECT r.message_id, m.rule_index
+            FROM temp.rule_matches m
+            JOIN message_rich_metadata r ON r.rowid = m.message_rowid
+            ORDER BY r.internal_date
+        """):
+            matched[rule_index].append(message_id)
+        return list(zip(self.rules, matched))
+
+    def print_evaluation(self, db, explain=False):
+        """
+        Print per-rule match counts (a dry run of the rule file), optionally with explain output.
+
+        Args:
+            db (GmailCacheDB): The cache database to read from.
+            explain (bool): Also print each rule's SQL, parameters and query plan.
+        """
+        conn = db.get_read_connection()
+        try:
+            start = time.perf_counter()
+            results = self.evaluate(conn)
+            elapsed = time.perf_counter() - start
+
+            print(f"\n=== Rule Matches ({len(self.rules)} rules evaluated in {elapsed * 1000:.0f} ms) ===")
+            for rule, message_count, total_bytes in results:
+                target = f" {rule.label_id}" if rule.label_id else ""
+                print(f"{message_count:>8}  {format_size(total_bytes):>10}  {rule.name} -> {rule.action}{target}")
+                if explain:
+                    print(f"          SQL: {rule.where}")
+                    print(f"          Params: {rule.params}")
+                    mode = "shared scan with the other scanning rules" if self.needs_scan(conn, rule) else "own indexed query"
+                    print(f"          Evaluated by: {mode}")
+                    for step in self.explain(conn, rule):
+                        print(f"          Plan: {step}")
+            total_count = sum(count for _, count, _ in results)
+            total_bytes = sum(size for _, _, size in results)
+            print(f"Total: {total_count} messages ({format_size(total_bytes)}). Each message is counted for the first rule it matches.")
+        finally:
+            db.close_connection(conn)
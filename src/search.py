@@ -0,0 +1,192 @@
+import json
+import re
+import sqlite3
+import time
+from datetime import datetime, timezone
+
+from src.insights import format_size
+
+# Gmail-style column prefixes accepted in queries, mapped to message_fts columns
+COLUMN_ALIASES = {'from': 'from_address', 'subject': 'subject', 'snippet': 'snippet'}
+
+# Result orderings: newest first (like Gmail) or best match first.
+# bm25 weights are per message_fts column: subject, snippet, from_address.
+ORDERINGS = {
+    'date': 'r.internal_date DESC',
+    'relevance': 'bm25(message_fts, 5.0, 1.0, 3.0)',
+}
+
+# Above this many index matches, date-ordered searches scan the date index
+# instead of fetching and sorting every match
+DATE_SCAN_THRESHOLD = 20000
+
+_COLUMN_PREFIX = re.compile(r'(?<![\w"])(' + '|'.join(COLUMN_ALIASES) + r'):', re.IGNORECASE)
+_TOKEN = re.compile(r'"[^"]*"\*?|\S+')
+
+
+def to_match_expression(query):
+    """
+    Translate a search query into an FTS5 MATCH expression.
+
+    FTS5 syntax is passed through: keywords (all must match), prefixes (invoice*),
+    phrases ("order shipped"), OR/NOT/parentheses and column filters. The Gmail
+    prefixes from:, subject: and snippet: select a single column.
+
+    Args:
+        query (str): The query as typed by the user.
+
+    Returns:
+        str: The MATCH expression.
+    """
+    return _COLUMN_PREFIX.sub(lambda match: COLUMN_ALIASES[match.group(1).lower()] + ':', query.strip())
+
+
+def to_literal_expression(query):
+    """
+    Translate a query into a MATCH expression that treats every term as plain text.
+
+    Used when the query is not valid FTS5 syntax, typically because a term contains
+    punctuation (amazon.com, o'brien). Each term becomes a quoted phrase, keeping
+    its column prefix and a trailing * for prefix search.
+
+    Args:
+        query (str): The query as typed by the user.
+
+    Returns:
+        str: The MATCH expression.
+    """
+    terms = []
+    for token in _TOKEN.findall(to_match_expression(query)):
+        column = ''
+        column_match = re.match(r'^(\w+):(.+)$', token)
+        if column_match and column_match.group(1) in COLUMN_ALIASES.values():
+            column, token = column_match.group(1) + ':', column_match.group(2)
+        prefix = '*' if token.endswith('*') else ''
+        text = token.rstrip('*').replace('"', '')
+        if text:
+            terms.append(f'{column}"{text}"{prefix}')
+    return ' '.join(terms)
+
+
+class CacheSearch:
+    """
+    Full-text search over the local cache.
+
+    Queries run against the message_fts index (subject, snippet and sender), which
+    GmailCacheDB keeps in step with message_rich_metadata, and can be combined with
+    the filters of actions.build_selection. Nothing is sent to Gmail, so searching
+    costs no API quota and works offline.
+    """
+
+    def __init__(self, db):
+        """
+        Initialize the search.
+
+        Args:
+            db (GmailCacheDB): The cache database to search.
+        """
+        self.db = db
+
+    def search(self, conn, query, where='1', params=(), order='date', limit=20):
+        """
+        Run a search and return one page of results.
+
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+            query (str): Keywords, prefixes (term*) and phrases ("..."); see to_match_expression.
+            where (str): Extra WHERE clause over message_rich_metadata r (see build_selection).
+            params (list): Parameters of the WHERE clause.
+            order (str): One of ORDERINGS.
+            limit (int): Maximum number of results.
+
+        Returns:
+            tuple: (total_matches, rows). rows are (message_id, internal_date, size_estimate,
+                   from_address, subject, highlighted_snippet) tuples.
+
+        Raises:
+            ValueError: For an unknown order or a query that matches nothing parseable.
+        """
+        if order not in ORDERINGS:
+            raise ValueError(f"Unknown order '{order}'. Choose from: {', '.join(ORDERINGS)}")
+        try:
+            return self._run(conn, to_match_expression(query), where, params, order, limit)
+        except sqlite3.OperationalError:
+            # Syntax errors and unknown column prefixes (to:bob) fall back to plain terms
+            pass
+        expression = to_literal_expression(query)
+        if not expression:
+            raise ValueError(f"Nothing to search for in '{query}'")
+        return self._run(conn, expression, where, params, order, limit)
+
+    def _run(self, conn, expression, where, params, order, limit):
+        """Count and fetch the matches of a MATCH expression."""
+        match_count = conn.execute("SELECT COUNT(*) FROM message_fts WHERE message_fts MATCH ?", (expression,)).fetchone()[0]
+        if where == '1':
+            total = match_count
+        else:
+            total = conn.execute(f"""
+                SELECT COUNT(*)
+                FROM message_fts CROSS JOIN message_rich_metadata r ON r.rowid = message_fts.rowid
+                WHERE message_fts MATCH ? AND {where}
+            """, [expression, *params]).fetchone()[0]
+
+        columns = "r.rowid, r.message_id, r.internal_date, r.size_estimate, r.from_address, r.subject"
+        if order == 'date' and match_count > DATE_SCAN_THRESHOLD:
+            # Broad query: walk idx_rich_internal_date newest first and stop after `limit`
+            # matches, instead of sorting every match. The unary + keeps the planner from
+            # driving the query from the rowid list.
+            rows = conn.execute(f"""
+                SELECT {columns} FROM message_rich_metadata r
+                WHERE +r.rowid IN (SELECT rowid FROM message_fts WHERE message_fts MATCH ?) AND {where}
+                ORDER BY r.internal_date DESC
+                LIMIT ?
+            """, [expression, *params, limit]).fetchall()
+        else:
+            # Narrow query (or relevance order): the index finds the matching rowids and
+            # the filters are checked on those rows only. CROSS JOIN fixes the join order.
+            rows = conn.execute(f"""
+                SELECT {columns}
+                FROM message_fts CROSS JOIN message_rich_metadata r ON r.rowid = message_fts.rowid
+                WHERE message_fts MATCH ? AND {where}
+                ORDER BY {ORDERINGS[order]}
+                LIMIT ?
+            """, [expression, *params, limit]).fetchall()
+
+        # Highlighting reads the text back, so only do it for the page being shown
+        snippets = dict(conn.execute("""
+            SELECT rowid, snippet(message_fts, 1, '[', ']', '...', 12) FROM message_fts
+            WHERE message_fts MATCH ? AND rowid IN (SELECT value FROM json_each(?))
+        """, (expression, json.dumps([row[0] for row in rows]))).fetchall())
+        return total, [row[1:] + (snippets.get(row[0]),) for row in rows]
+
+    def print_results(self, query, where='1', params=(), order='date', limit=20):
+        """
+        Print a page of search results.
+
+        Args:
+            query (str): The search query.
+            where (str): Extra WHERE clause over message_rich_metadata r (see build_selection).
+            params (list): Parameters of the WHERE clause.
+            order (str): One of ORDERINGS.
+            limit (int): Maximum number of results.
+        """
+        conn = self.db.get_read_connection()
+        try:
+            start = time.perf_counter()
+            try:
+                total, rows = self.search(conn, query, where, params, order, limit)
+            except (ValueError, sqlite3.OperationalError) as e:
+                print(f"Invalid search query: {e}")
+                return
+            elapsed = time.perf_counter() - start
+
+            print(f"\n=== {total} matches for '{query}' ({elapsed * 1000:.0f} ms) ===")
+            for message_id, internal_date, size_estimate, from_address, subject, snippet in rows:
+                date = datetime.fromtimestamp((internal_date or 0) / 1000, tz=timezone.utc).strftime('%Y-%m-%d')
+                print(f"{date}  {format_size(size_estimate):>10}  {message_id}  {from_address or 'N/A'}: {subject or '(no subject)'}")
+                if snippet:
+                    print(f"            {snippet}")
+            if total > len(rows):
+                print(f"Showing {len(rows)} of {total}. Use --limit to see more.")
+        finally:
+            self.db.close_connection(conn)
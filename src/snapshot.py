@@ -0,0 +1,326 @@
+import json
+import os
+import shutil
+import time
+
+try:
+    import numpy as np
+except ImportError: # numpy is only needed for analytics snapshots
+    np = None
+
+from src.gmail_db import DEFAULT_DB_PATH
+
+# Default snapshot directory, next to the cache database
+DEFAULT_SNAPSHOT_DIR = os.path.join(os.path.dirname(DEFAULT_DB_PATH), 'snapshot')
+
+# Rows read from SQLite per chunk while exporting
+EXPORT_CHUNK_SIZE = 50000
+
+SNAPSHOT_FORMAT_VERSION = 1
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("Analytics snapshots need numpy. Install it with 'pip install numpy'.")
+
+
+def export_snapshot(db, output_dir=DEFAULT_SNAPSHOT_DIR):
+    """
+    Write the numeric and categorical columns of the cache as memory-mappable arrays.
+
+    One .npy file is written per column, plus meta.json with the dictionaries that
+    decode the categorical columns:
+
+    - message_id.npy      fixed-width bytes, the Gmail message ID
+    - internal_date.npy   int64 milliseconds since the epoch (-1 if unknown)
+    - size_estimate.npy   int64 bytes (0 if unknown)
+    - sender.npy          int32 sender_id (0 if unknown), decoded by meta['senders']
+    - sender_domain.npy   int32 domain code per sender_id, decoded by meta['domains']
+    - labels.npy          uint64 bitsets, shape (messages, words); bit i is meta['labels'][i]
+    - has_attachments.npy bool
+
+    Rows are streamed out of SQLite in chunks straight into the memory-mapped files,
+    and the snapshot replaces any previous one atomically when it is complete.
+
+    Args:
+        db (GmailCacheDB): The cache database to export.
+        output_dir (str): Directory the snapshot is written to.
+
+    Returns:
+        int: Number of messages exported.
+    """
+    _require_numpy()
+    conn = db.get_read_connection()
+    # One read transaction, so the row count and rows come from the same state
+    conn.execute("BEGIN")
+    try:
+        count = conn.execute("SELECT COUNT(*) FROM message_rich_metadata").fetchone()[0]
+        label_names = [row[0] for row in conn.execute("SELECT DISTINCT label_id FROM message_labels ORDER BY label_id")]
+        label_bits = {label_id: i for i, label_id in enumerate(label_names)}
+        label_words = max(1, (len(label_names) + 63) // 64)
+
+        senders = conn.execute("SELECT sender_id, address, display_name, domain FROM senders ORDER BY sender_id").fetchall()
+        max_sender_id = senders[-1][0] if senders else 0
+        domain_names = sorted({domain for _, _, _, domain in senders if domain})
+        domain_codes = {domain: i + 1 for i, domain in enumerate(domain_names)} # 0 = unknown
+        id_width = conn.execute("SELECT COALESCE(MAX(LENGTH(message_id)), 1) FROM message_rich_metadata").fetchone()[0]
+
+        tmp_dir = output_dir.rstrip(os.sep) + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        def open_column(name, dtype, shape):
+            return np.lib.format.open_memmap(os.path.join(tmp_dir, f'{name}.npy'), mode='w+', dtype=dtype, shape=shape)
+
+        columns = {
+            'message_id': open_column('message_id', f'S{id_width}', (count,)),
+            'internal_date': open_column('internal_date', np.int64, (count,)),
+            'size_estimate': open_column('size_estimate', np.int64, (count,)),
+            'sender': open_column('sender', np.int32, (count,)),
+            'labels': open_column('labels', np.uint64, (count, label_words)),
+            'has_attachments': open_column('has_attachments', np.bool_, (count,)),
+        }
+        sender_domain = open_column('sender_domain', np.int32, (max_sender_id + 1,))
+        for sender_id, _, _, domain in senders:
+            sender_domain[sender_id] = domain_codes.get(domain, 0)
+
+        offset = 0
+        cursor = conn.execute("""
+            SELECT message_id, internal_date, size_estimate, sender_id, has_attachments, label_ids_json
+            FROM message_rich_metadata
+        """)
+        while offset < count:
+            rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+            if not rows:
+                break
+            end = offset + len(rows)
+            message_ids, internal_dates, sizes, sender_ids, attachments, label_json = zip(*rows)
+            columns['message_id'][offset:end] = [message_id.encode('ascii') for message_id in message_ids]
+            columns['internal_date'][offset:end] = [-1 if value is None else int(value) for value in internal_dates]
+            columns['size_estimate'][offset:end] = [value or 0 for value in sizes]
+            columns['sender'][offset:end] = [value or 0 for value in sender_ids]
+            columns['has_attachments'][offset:end] = [bool(value) for value in attachments]
+
+            bitsets = []
+            for labels_json in label_json:
+                words = [0] * label_words
+                for label_id in json.loads(labels_json or '[]'):
+                    bit = label_bits.get(label_id)
+                    if bit is not None:
+                        words[bit // 64] |= 1 << (bit % 64)
+                bitsets.append(words)
+            columns['labels'][offset:end] = np.array(bitsets, dtype=np.uint64)
+            offset = end
+    finally:
+        conn.rollback()
+        db.close_connection(conn)
+
+    for column in list(columns.values()) + [sender_domain]:
+        column.flush()
+    del columns, sender_domain
+
+    meta = {
+        'format_version': SNAPSHOT_FORMAT_VERSION,
+        'created_at': time.time(),
+        'messages': offset,
+        'labels': label_names,
+        'domains': [None] + domain_names,
+        'senders': {str(sender_id): [address, display_name] for sender_id, address, display_name, _ in senders},
+    }
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as meta_file:
+        json.dump(meta, meta_file)
+
+    # Swap the finished snapshot in; readers of the old files keep their mappings
+    old_dir = output_dir.rstrip(os.sep) + '.old'
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(output_dir):
+        os.rename(output_dir, old_dir)
+    os.rename(tmp_dir, output_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return offset
+
+
+class Snapshot:
+    """
+    Vectorized, read-only queries over a snapshot written by export_snapshot.
+
+    Columns are opened with np.load(mmap_mode='r'), so loading is instant, data is
+    paged in on demand, and several processes reading the same snapshot share the
+    same pages in the OS page cache.
+
+    Filters return boolean masks that can be combined with & and |; aggregates take
+    an optional mask. Example:
+
+        snap = Snapshot()
+        promo = snap.mask(label='CATEGORY_PROMOTIONS', older_than_days=365)
+        snap.group_by('domain', promo, agg='bytes', limit=10)
+    """
+
+    def __init__(self, path=DEFAULT_SNAPSHOT_DIR):
+        """
+        Open a snapshot.
+
+        Args:
+            path (str): The snapshot directory.
+        """
+        _require_numpy()
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as meta_file:
+            self.meta = json.load(meta_file)
+
+        def load(name):
+            return np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+
+        self.message_id = load('message_id')
+        self.internal_date = load('internal_date')
+        self.size_estimate = load('size_estimate')
+        self.sender = load('sender')
+        self.sender_domain = load('sender_domain')
+        self.labels = load('labels')
+        self.has_attachments = load('has_attachments')
+        self.label_bits = {label_id: i for i, label_id in enumerate(self.meta['labels'])}
+        self.domain_codes = {domain: i for i, domain in enumerate(self.meta['domains']) if domain}
+
+    def __len__(self):
+        return self.meta['messages']
+
+    def _label_mask(self, label_id):
+        bit = self.label_bits.get(label_id)
+        if bit is None:
+            return np.zeros(len(self), dtype=np.bool_)
+        return (self.labels[:, bit // 64] & np.uint64(1 << (bit % 64))) != 0
+
+    def mask(self, label=None, without_label=None, domain=None, sender_id=None, after=None, before=None,
+             older_than_days=None, min_size=None, max_size=None, has_attachments=None):
+        """
+        Build a boolean mask of the messages matching all given filters.
+
+        Args:
+            label (str, optional): Messages with this label ID.
+            without_label (str, optional): Messages without this label ID.
+            domain (str, optional): Messages from this sender domain.
+            sender_id (int, optional): Messages from this sender_id.
+            after (datetime, optional): Messages received at or after this time.
+            before (datetime, optional): Messages received before this time.
+            older_than_days (float, optional): Messages received more than this many days ago.
+            min_size (int, optional): Minimum size estimate in bytes.
+            max_size (int, optional): Maximum size estimate in bytes.
+            has_attachments (bool, optional): Filter on the attachment flag.
+
+        Returns:
+            numpy.ndarray: Boolean mask with one entry per message.
+        """
+        result = np.ones(len(self), dtype=np.bool_)
+        if label is not None:
+            result &= self._label_mask(label)
+        if without_label is not None:
+            result &= ~self._label_mask(without_label)
+        if domain is not None:
+            domain_code = self.domain_codes.get(domain.lower(), -1)
+            result &= self.sender_domain[self.sender] == domain_code
+        if sender_id is not None:
+            result &= self.sender == sender_id
+        if after is not None:
+            result &= self.internal_date >= int(after.timestamp() * 1000)
+        if before is not None:
+            result &= (self.internal_date < int(before.timestamp() * 1000)) & (self.internal_date >= 0)
+        if older_than_days is not None:
+            cutoff = int((time.time() - older_than_days * 86400) * 1000)
+            result &= (self.internal_date < cutoff) & (self.internal_date >= 0)
+        if min_size is not None:
+            result &= self.size_estimate >= min_size
+        if max_size is not None:
+            result &= self.size_estimate <= max_size
+        if has_attachments is not None:
+            result &= self.has_attachments == bool(has_attachments)
+        return result
+
+    def count(self, mask=None):
+        """Number of messages in the mask (or in the snapshot)."""
+        return int(mask.sum()) if mask is not None else len(self)
+
+    def total_bytes(self, mask=None):
+        """Sum of size estimates over the mask (or the snapshot)."""
+        sizes = self.size_estimate if mask is None else self.size_estimate[mask]
+        return int(sizes.sum())
+
+    def group_by(self, key, mask=None, agg='count', limit=None):
+        """
+        Aggregate messages per sender, domain, month or label.
+
+        Args:
+            key (str): 'sender', 'domain', 'month' or 'label'.
+            mask (numpy.ndarray, optional): Only aggregate the messages in this mask.
+            agg (str): 'count' or 'bytes'.
+            limit (int, optional): Return only the largest groups.
+
+        Returns:
+            list: (group, value) pairs sorted by value, largest first. Groups are the
+                  sender address, domain, 'YYYY-MM' month or label ID.
+        """
+        selected = np.ones(len(self), dtype=np.bool_) if mask is None else mask
+        weights = self.size_estimate[selected].astype(np.float64) if agg == 'bytes' else None
+
+        if key == 'label':
+            values = [
+                (label_id, int(self.size_estimate[selected & self._label_mask(label_id)].sum()) if agg == 'bytes'
+                 else int((selected & self._label_mask(label_id)).sum()))
+                for label_id in self.meta['labels']
+            ]
+        else:
+            if key == 'sender':
+                codes = self.sender[selected]
+                names = lambda code: (self.meta['senders'].get(str(code)) or ['(unknown sender)'])[0]
+            elif key == 'domain':
+                codes = self.sender_domain[self.sender[selected]]
+                names = lambda code: self.meta['domains'][code] or '(unknown domain)'
+            elif key == 'month':
+                dates = self.internal_date[selected]
+                known = dates >= 0
+                months = dates.astype('datetime64[ms]').astype('datetime64[M]').astype(np.int64)
+                first_month = int(months[known].min()) if known.any() else 0
+                codes = np.where(known, months - first_month + 1, 0)
+                names = lambda code: (str(np.datetime64(code - 1 + first_month, 'M')) if code else 'unknown')
+            else:
+                raise ValueError(f"Unknown group_by key: {key}")
+            totals = np.bincount(codes, weights=weights)
+            nonzero = np.nonzero(totals)[0]
+            values = [(names(int(code)), int(totals[code])) for code in nonzero]
+
+        values.sort(key=lambda item: item[1], reverse=True)
+        return values[:limit] if limit else values
+
+    def size_histogram(self, bins=20, mask=None, log=True):
+        """
+        Histogram of size estimates.
+
+        Args:
+            bins (int): Number of bins.
+            mask (numpy.ndarray, optional): Only include the messages in this mask.
+            log (bool): Use logarithmically spaced bins, which suits email sizes.
+
+        Returns:
+            tuple: (counts, bin_edges) as returned by numpy.histogram.
+        """
+        sizes = self.size_estimate if mask is None else self.size_estimate[mask]
+        sizes = sizes[sizes > 0]
+        if log and len(sizes):
+            edges = np.logspace(np.log10(sizes.min()), np.log10(sizes.max() + 1), bins + 1)
+            return np.histogram(sizes, bins=edges)
+        return np.histogram(sizes, bins=bins)
+
+    def message_ids(self, mask, limit=None):
+        """
+        Message IDs of the messages in a mask, for feeding back into SQL or the API.
+
+        Args:
+            mask (numpy.ndarray): Boolean mask.
+            limit (int, optional): Maximum number of IDs to return.
+
+        Returns:
+            list: Message ID strings.
+        """
+        indexes = np.flatnonzero(mask)
+        if limit is not None:
+            indexes = indexes[:limit]
+        return [message_id.decode('ascii') for message_id in self.message_id[indexes]]
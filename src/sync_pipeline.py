@@ -0,0 +1,510 @@
+import queue
+import threading
+import time
+
+from src import gmail_service
+from src import metrics
+from src.gmail_db import in_sync_scope
+
+
+class MetadataPipeline:
+    """
+    A staged pipeline that fetches rich message metadata concurrently.
+
+    The pipeline is made of three stages joined by bounded queues:
+
+    1. A producer (the calling thread) that walks pages of message stubs,
+       hands them to the writer and queues the IDs that still lack rich metadata.
+    2. N fetch workers, each with its own Gmail service object (the HTTP client
+       is not thread-safe), that run batch `messages.get` requests.
+    3. A single writer thread that stores stubs and rich metadata on the shared
+       writer connection, grouping them into large transactions.
+
+    Because the producer queues IDs as soon as each page is listed, rich metadata
+    fetching starts with the first page of stubs instead of after the full listing.
+
+    Each stage records its busy time ('pipeline.list', 'pipeline.fetch',
+    'pipeline.write') and its idle time waiting for work in src/metrics.py, and
+    the queue depths are sampled on every put ('queue.fetch', 'queue.write'):
+    a full queue in front of a busy stage marks the bottleneck.
+    """
+
+    def __init__(self, db, service_factory, build_request, extract_metadata, scheduler, workers=4, batch_size=50,
+                 commit_rows=5000, commit_interval=2.0):
+        """
+        Initialize the pipeline.
+
+        Args:
+            db (GmailCacheDB): The cache database to write to.
+            service_factory (callable): Returns a new Gmail service object; called once per worker.
+            build_request (callable): Called as build_request(service, message_id); returns the
+                                      messages.get request for one message.
+            extract_metadata (callable): Turns (message_id, messages.get response) into a
+                                         message_rich_metadata row.
+            scheduler (QuotaScheduler): Shared scheduler that rate-limits and retries the batches.
+            workers (int): Number of concurrent batch-get workers.
+            batch_size (int): Number of message IDs handed to a worker at a time. The scheduler
+                              may split them into smaller batch requests while throttled, and
+                              never sends more per batch than its own limit (set from the same
+                              --batch-size by the sync commands).
+            commit_rows (int): The writer commits once this many rows are in its transaction.
+            commit_interval (float): The writer commits at least this often, in seconds.
+        """
+        self.db = db
+        self.service_factory = service_factory
+        self.build_request = build_request
+        self.extract_metadata = extract_metadata
+        self.scheduler = scheduler
+        self.workers = max(1, workers)
+        self.batch_size = batch_size
+        self.commit_rows = commit_rows
+        self.commit_interval = commit_interval
+
+        # Bounded queues keep memory flat: a slow stage applies back-pressure upstream
+        self.fetch_queue = queue.Queue(maxsize=self.workers * 2)
+        self.write_queue = queue.Queue(maxsize=self.workers * 4)
+
+        self.errors = []
+        self.pages_listed = 0
+        self.stubs_listed = 0
+        self.ids_queued = 0
+        self.rich_saved = 0
+        self.failed_ids = []
+        self._pending_saved = 0 # Rich rows written in the writer's open transaction
+        self._lock = threading.Lock()
+
+    def run(self, stub_pages, store_stubs=True, checkpoint_label=None):
+        """
+        Run the pipeline to completion.
+
+        Args:
+            stub_pages (iterable): (stubs, next_page_token) pairs, where stubs is a list of
+                                   message stub dictionaries ('id', 'threadId'). Iterated on
+                                   the calling thread, so a generator that performs the list
+                                   API calls acts as the producer.
+            store_stubs (bool): Whether the stubs themselves should be written to the
+                                database (False when they come from the database already).
+            checkpoint_label (str, optional): If set, the writer advances this label's sync
+                                              checkpoint in the same transaction as each write.
+
+        Returns:
+            int: Number of messages whose rich metadata was saved.
+
+        Raises:
+            Exception: The first unexpected error raised by any stage.
+        """
+        writer = threading.Thread(target=self._writer_loop, args=(checkpoint_label,), name="metadata-writer", daemon=True)
+        writer.start()
+        fetchers = [
+            threading.Thread(target=self._fetch_loop, name=f"metadata-fetch-{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+        for fetcher in fetchers:
+            fetcher.start()
+
+        # Producer stage runs on the calling thread
+        read_conn = self.db.get_read_connection()
+        try:
+            pages = iter(stub_pages)
+            while True:
+                # Time spent waiting for the next page, i.e. listing it
+                start = time.perf_counter()
+                page = next(pages, None)
+                metrics.add_time('pipeline.list', time.perf_counter() - start)
+                if page is None:
+                    break
+                stubs, next_page_token = page
+                if self.errors:
+                    break # A later stage failed, stop listing
+                self.pages_listed += 1
+                if not stubs:
+                    continue
+                self.stubs_listed += len(stubs)
+                if store_stubs:
+                    self._put(self.write_queue, 'queue.write', ('stubs', stubs, next_page_token))
+                missing_ids = self._ids_to_fetch(read_conn, stubs)
+                for i in range(0, len(missing_ids), self.batch_size):
+                    self._put(self.fetch_queue, 'queue.fetch', missing_ids[i:i + self.batch_size])
+                self.ids_queued += len(missing_ids)
+        except Exception as e:
+            self._record_error(e)
+        finally:
+            self.db.close_connection(read_conn)
+
+            # Shut the stages down in order: fetchers first, then the writer
+            for _ in fetchers:
+                self.fetch_queue.put(None)
+            for fetcher in fetchers:
+                fetcher.join()
+            self.write_queue.put(None)
+            writer.join()
+
+        if self.errors:
+            raise self.errors[0]
+        return self.rich_saved
+
+    def _ids_to_fetch(self, conn, stubs):
+        """
+        Return the IDs from a listed page that need fetching.
+
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+            stubs (list): The page of stubs, in listing order.
+
+        Returns:
+            list: The IDs to queue for the fetch workers, in listing order.
+        """
+        return self._missing_ids(conn, [msg['id'] for msg in stubs])
+
+    def _missing_ids(self, conn, message_ids):
+        """
+        Return the subset of message_ids that has no rich metadata cached yet.
+
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+            message_ids (list): Candidate message IDs, in listing order.
+
+        Returns:
+            list: The IDs without a message_rich_metadata row, in the original order.
+        """
+        placeholders = ','.join('?' * len(message_ids))
+        cached = {
+            row[0] for row in conn.execute(
+                f"SELECT message_id FROM message_rich_metadata WHERE message_id IN ({placeholders})",
+                message_ids
+            )
+        }
+        return [message_id for message_id in message_ids if message_id not in cached]
+
+    def _put(self, target_queue, name, item):
+        """Put an item on a stage queue, sampling the queue's depth first."""
+        metrics.observe(name, target_queue.qsize())
+        target_queue.put(item)
+
+    def _record_error(self, error):
+        """Remember an unexpected stage error so run() can re-raise it."""
+        with self._lock:
+            self.errors.append(error)
+
+    def _fetch_loop(self):
+        """Fetch worker: turns batches of message IDs into rich metadata rows."""
+        service = None
+        while True:
+            start = time.perf_counter()
+            batch_ids = self.fetch_queue.get()
+            metrics.add_time('pipeline.fetch_idle', time.perf_counter() - start)
+            if batch_ids is None:
+                break
+            # After a fatal error keep draining the queue so the producer never blocks
+            if self.errors:
+                continue
+            try:
+                if service is None:
+                    service = self.service_factory()
+                with metrics.timer('pipeline.fetch'):
+                    item = self._fetch_batch(service, batch_ids)
+                if item:
+                    self._put(self.write_queue, 'queue.write', item)
+            except Exception as e:
+                self._record_error(e)
+
+    def _fetch_batch(self, service, batch_ids):
+        """
+        Fetch the rich metadata for a group of messages through the scheduler.
+
+        Args:
+            service: The worker's Gmail API service object.
+            batch_ids (list): Message IDs to fetch.
+
+        Returns:
+            tuple: A ('rich', rows, None) write queue item with the message_rich_metadata
+                   rows of the messages fetched successfully, or None if there are none.
+        """
+        rows = []
+        failed = self.scheduler.execute_batch(
+            service,
+            batch_ids,
+            self.build_request,
+            'messages.get',
+            lambda msg_id, response: rows.append(self.extract_metadata(msg_id, response))
+        )
+        for msg_id, exception in failed.items():
+            print(f"Error fetching message {msg_id}: {exception}")
+        with self._lock:
+            self.failed_ids.extend(failed)
+        return ('rich', rows, None) if rows else None
+
+    def _writer_loop(self, checkpoint_label):
+        """
+        Writer stage: the only thread that writes to the database while the pipeline runs.
+
+        Items are grouped into one transaction until commit_rows rows have been written
+        or commit_interval seconds have passed, so a large sync costs a handful of
+        commits instead of one per page and per batch.
+        """
+        done = False
+        while not done:
+            start = time.perf_counter()
+            item = self.write_queue.get()
+            metrics.add_time('pipeline.write_idle', time.perf_counter() - start)
+            if item is None:
+                break
+            if self.errors:
+                continue # Keep draining so upstream stages never block
+            try:
+                with self.db.write_transaction() as conn:
+                    pending_rows = 0
+                    deadline = time.monotonic() + self.commit_interval
+                    while True:
+                        with metrics.timer('pipeline.write'):
+                            pending_rows += self._write_item(conn, item, checkpoint_label)
+                        remaining = deadline - time.monotonic()
+                        if pending_rows >= self.commit_rows or remaining <= 0:
+                            break
+                        try:
+                            item = self.write_queue.get(timeout=remaining)
+                        except queue.Empty:
+                            break
+                        if item is None:
+                            done = True
+                            break
+                if self._pending_saved:
+                    self.rich_saved += self._pending_saved
+                    print(f"Saved rich metadata for {self._pending_saved} messages. (Total: {self.rich_saved})")
+                    self._pending_saved = 0
+            except Exception as e:
+                self._record_error(e)
+
+    def _write_item(self, conn, item, checkpoint_label):
+        """
+        Write one queued item inside the current transaction.
+
+        Args:
+            conn (sqlite3.Connection): The writer connection.
+            item (tuple): (kind, rows, next_page_token) with kind 'stubs' or 'rich'.
+            checkpoint_label (str): Label whose checkpoint to advance, or None.
+
+        Returns:
+            int: Number of rows written.
+        """
+        kind, rows, next_page_token = item
+        if kind == 'stubs':
+            self.db.upsert_stubs(conn, rows)
+            if checkpoint_label:
+                self.db.checkpoint_page(conn, checkpoint_label, next_page_token, len(rows))
+        else:
+            self.db.upsert_rich_metadata(conn, rows)
+            if checkpoint_label:
+                self.db.checkpoint_batch(conn, checkpoint_label)
+            self._pending_saved += len(rows)
+        return len(rows)
+
+
+class ThreadPipeline(MetadataPipeline):
+    """
+    A MetadataPipeline that lists and fetches whole conversations instead of messages.
+
+    The producer walks pages of threads.list results. Threads whose historyId equals
+    the one stored when they were last fetched have not changed and are skipped; the
+    others are fetched with batch `threads.get` requests, which return every member
+    message in one call. Each fetched thread is written in one go: stubs and rich
+    metadata for its members in the synced labels, removal of cached members that
+    are no longer in them (archived or deleted), and the thread's new historyId.
+    """
+
+    def __init__(self, db, service_factory, build_request, extract_metadata, scheduler, sync_labels=('INBOX',), **kwargs):
+        """
+        Initialize the pipeline.
+
+        Args:
+            db (GmailCacheDB): The cache database to write to.
+            service_factory (callable): Returns a new Gmail service object; called once per worker.
+            build_request (callable): Called as build_request(service, thread_id); returns the
+                                      threads.get request for one thread.
+            extract_metadata (callable): Turns (message_id, message resource) into a
+                                         message_rich_metadata row.
+            scheduler (QuotaScheduler): Shared scheduler that rate-limits and retries the batches.
+            sync_labels (list): Labels the cache mirrors; only member messages in them are
+                                cached (see gmail_db.in_sync_scope).
+            **kwargs: workers, batch_size, commit_rows and commit_interval, as for MetadataPipeline.
+        """
+        super().__init__(db, service_factory, build_request, extract_metadata, scheduler, **kwargs)
+        self.sync_labels = list(sync_labels)
+        self.threads_skipped = 0
+        self.threads_fetched = 0
+        self.messages_fetched = 0 # Member messages returned, in the synced labels or not
+
+    def _ids_to_fetch(self, conn, threads):
+        """
+        Return the IDs of the listed threads that changed since they were last fetched.
+
+        Args:
+            conn (sqlite3.Connection): Connection to read from.
+            threads (list): The page of thread dictionaries ('id', 'historyId'), in listing order.
+
+        Returns:
+            list: The thread IDs to fetch, in listing order.
+        """
+        stored = self.db.get_thread_history_ids(conn, [thread['id'] for thread in threads])
+        changed = [thread['id'] for thread in threads if stored.get(thread['id']) != int(thread.get('historyId') or 0)]
+        self.threads_skipped += len(threads) - len(changed)
+        return changed
+
+    def _fetch_batch(self, service, batch_ids):
+        """
+        Fetch a group of threads through the scheduler and extract their member messages.
+
+        Args:
+            service: The worker's Gmail API service object.
+            batch_ids (list): Thread IDs to fetch.
+
+        Returns:
+            tuple: A ('threads', (stubs, rows, thread_history_ids, thread_ids), None) write
+                   queue item for the threads fetched successfully, or None if there are none.
+        """
+        stubs, rows, thread_history_ids = [], [], []
+        message_count = 0
+
+        def store_thread(thread_id, response):
+            nonlocal message_count
+            for message in response.get('messages', []):
+                message_count += 1
+                if in_sync_scope(message.get('labelIds', []), self.sync_labels):
+                    stubs.append({'id': message['id'], 'threadId': thread_id})
+                    rows.append(self.extract_metadata(message['id'], message))
+            thread_history_ids.append((thread_id, int(response['historyId'])))
+
+        failed = self.scheduler.execute_batch(service, batch_ids, self.build_request, 'threads.get', store_thread)
+        for thread_id, exception in failed.items():
+            print(f"Error fetching thread {thread_id}: {exception}")
+        with self._lock:
+            self.failed_ids.extend(failed)
+            self.threads_fetched += len(thread_history_ids)
+            self.messages_fetched += message_count
+        if not thread_history_ids:
+            return None
+        return ('threads', (stubs, rows, thread_history_ids, [thread_id for thread_id, _ in thread_history_ids]), None)
+
+    def _write_item(self, conn, item, checkpoint_label):
+        """
+        Write one queued item inside the current transaction.
+
+        Args:
+            conn (sqlite3.Connection): The writer connection.
+            item (tuple): (kind, payload, next_page_token); 'threads' items are handled here,
+                          the others by MetadataPipeline.
+            checkpoint_label (str): Label whose checkpoint to advance, or None.
+
+        Returns:
+            int: Number of rows written.
+        """
+        kind, payload, _ = item
+        if kind != 'threads':
+            return super()._write_item(conn, item, checkpoint_label)
+        stubs, rows, thread_history_ids, thread_ids = payload
+        kept_ids = {stub['id'] for stub in stubs}
+        stale_ids = [message_id for message_id in self.db.get_thread_message_ids(conn, thread_ids)
+                     if message_id not in kept_ids]
+        if stale_ids:
+            self.db.delete_messages(conn, stale_ids)
+        self.db.upsert_stubs(conn, stubs)
+        self.db.upsert_rich_metadata(conn, rows)
+        # After the rows, so that threads seen for the first time have their threads row
+        self.db.set_thread_history_ids(conn, thread_history_ids)
+        self._pending_saved += len(rows)
+        return len(rows)
+
+
+class LabelRefreshPipeline(MetadataPipeline):
+    """
+    A MetadataPipeline that re-validates the label sets of cached messages.
+
+    The producer hands over pages of cached message IDs; every one of them is fetched
+    with batch `messages.get` requests in format='minimal', which returns the labels
+    and historyId without headers or payload. The writer stores the labels that
+    changed and each message's labels_checked_at. Messages that left the synced labels
+    or no longer exist (404) are removed from the cache, as after an incremental sync.
+    """
+
+    def __init__(self, db, service_factory, build_request, scheduler, sync_labels=('INBOX',), **kwargs):
+        """
+        Initialize the pipeline.
+
+        Args:
+            db (GmailCacheDB): The cache database to write to.
+            service_factory (callable): Returns a new Gmail service object; called once per worker.
+            build_request (callable): Called as build_request(service, message_id); returns the
+                                      format='minimal' messages.get request for one message.
+            scheduler (QuotaScheduler): Shared scheduler that rate-limits and retries the batches.
+            sync_labels (list): Labels the cache mirrors (see gmail_db.in_sync_scope).
+            **kwargs: workers, batch_size, commit_rows and commit_interval, as for MetadataPipeline.
+        """
+        super().__init__(db, service_factory, build_request, None, scheduler, **kwargs)
+        self.sync_labels = list(sync_labels)
+        self.messages_checked = 0
+        self.labels_changed = 0
+        self.messages_removed = 0
+
+    def _ids_to_fetch(self, conn, stubs):
+        """Every listed message is checked, so return all IDs in listing order."""
+        return [msg['id'] for msg in stubs]
+
+    def _fetch_batch(self, service, batch_ids):
+        """
+        Fetch the current labels of a group of messages through the scheduler.
+
+        Args:
+            service: The worker's Gmail API service object.
+            batch_ids (list): Message IDs to check.
+
+        Returns:
+            tuple: A ('labels', (checked, removed_ids), None) write queue item, where checked
+                   holds (message_id, label_ids, history_id) for messages still in the synced
+                   labels, or None if nothing was fetched.
+        """
+        checked, removed_ids = [], []
+
+        def store_labels(msg_id, response):
+            label_ids = response.get('labelIds', [])
+            if in_sync_scope(label_ids, self.sync_labels):
+                checked.append((msg_id, label_ids, int(response['historyId']) if response.get('historyId') else None))
+            else:
+                removed_ids.append(msg_id)
+
+        failed = self.scheduler.execute_batch(service, batch_ids, self.build_request, 'messages.get', store_labels)
+        for msg_id, exception in failed.items():
+            if isinstance(exception, gmail_service.HttpError) and exception.resp.status == 404:
+                removed_ids.append(msg_id) # Deleted in Gmail
+                continue
+            print(f"Error checking labels of message {msg_id}: {exception}")
+            with self._lock:
+                self.failed_ids.append(msg_id)
+        if not checked and not removed_ids:
+            return None
+        return ('labels', (checked, removed_ids), None)
+
+    def _write_item(self, conn, item, checkpoint_label):
+        """
+        Write one queued item inside the current transaction.
+
+        Args:
+            conn (sqlite3.Connection): The writer connection.
+            item (tuple): (kind, payload, next_page_token); 'labels' items are handled here,
+                          the others by MetadataPipeline.
+            checkpoint_label (str): Label whose checkpoint to advance, or None.
+
+        Returns:
+            int: Number of messages written.
+        """
+        kind, payload, _ = item
+        if kind != 'labels':
+            return super()._write_item(conn, item, checkpoint_label)
+        checked, removed_ids = payload
+        if removed_ids:
+            self.db.delete_messages(conn, removed_ids)
+        changed = self.db.record_label_checks(conn, checked) if checked else 0
+        self.messages_checked += len(checked) + len(removed_ids)
+        self.labels_changed += changed
+        self.messages_removed += len(removed_ids)
+        metrics.count('db.rows.labels', changed)
+        return len(checked) + len(removed_ids)